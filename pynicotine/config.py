@@ -226,6 +226,8 @@ class Config:
                 "rescanonstartup": True,
                 "rescan_shares_daily": True,
                 "rescan_shares_hour": 0,
+                "scan_metadata_threads": 4,
+                "watch_shares": False,
                 "enablefilters": False,
                 "downloadfilters": [
                     ["*.DS_Store", 1],
@@ -324,7 +326,11 @@ class Config:
                 "search_results": True,
                 "max_displayed_results": 2500,
                 "min_search_chars": 3,
-                "private_search_results": False
+                "private_search_results": False,
+                "search_request_threads": 2,
+                "max_pending_search_requests": 100,
+                "user_search_work_rate": 20,
+                "total_search_work_rate": 200
             },
             "ui": {
                 "language": "",
@@ -226,6 +226,12 @@ class Plugin(BasePlugin):
                 "group": _CommandGroup.SHARES,
                 "parameters": ["[force|rebuild]"]
             },
+            "searchstats": {
+                "callback": self.search_statistics_command,
+                "description": _("Show statistics of incoming search requests"),
+                "group": _CommandGroup.SHARES,
+                "parameters": ["[clear]"]
+            },
             "search": {
                 "aliases": ["s"],
                 "callback": self.search_command,
@@ -553,6 +559,59 @@ class Plugin(BasePlugin):
             "num_total": num_total
         })
 
+    def search_statistics_command(self, args, **_unused):
+
+        statistics = self.core.search.search_request_statistics
+
+        if args == "clear":
+            statistics.clear()
+            return
+
+        search_request_statistics = statistics.as_dict()
+        counters = search_request_statistics["counters"]
+
+        self.output(_("Incoming search requests: %(num)s (%(rate).2f per second)") % {
+            "num": counters["received"],
+            "rate": search_request_statistics["requests_per_second"]
+        })
+        self.output(_("Responses: %(num)s (%(num_results)s results, %(num_cache_hits)s from cache)") % {
+            "num": counters["responses"],
+            "num_results": counters["results"],
+            "num_cache_hits": counters["cache_hits"]
+        })
+        self.output(_("Ignored requests:"))
+
+        for counter, label in (
+            ("duplicate", _("Duplicate requests")),
+            ("disabled", _("Search results disabled")),
+            ("shutting_down", _("Waiting to quit")),
+            ("too_short", _("Search term too short")),
+            ("banned", _("Banned users")),
+            ("unmatched_words", _("Words not in shares")),
+            ("rate_limited", _("Rate limited")),
+            ("dropped", _("Too many pending requests")),
+            ("outdated", _("Shares changed during lookup")),
+            ("no_results", _("No results"))
+        ):
+            self.output(f"• {label}: {counters[counter]}")
+
+        self.output(_("Latency in milliseconds (50th, 90th and 99th percentile):"))
+        latencies = search_request_statistics["latencies"]
+
+        for stage, label in (
+            ("parse", _("Parsing")),
+            ("intersect", _("Word lookup")),
+            ("fetch", _("Result lookup")),
+            ("queue", _("Queueing response"))
+        ):
+            percentiles = latencies[stage]
+
+            if percentiles is None:
+                self.output(f"• {label}: -")
+                continue
+
+            self.output(f"• {label}: " + " / ".join(f"{duration:.3f}" for duration in percentiles.values()))
+
     def share_command(self, args, **_unused):
 
         permission_level, folder_path = args.split(maxsplit=1)
@@ -8,9 +8,14 @@
 
 import json
 import os
+import re
 import time
 
-from itertools import islice
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from heapq import nlargest
 from operator import itemgetter
 from shlex import shlex
 
@@ -19,6 +24,7 @@ from pynicotine.core import core
 from pynicotine.events import events
 from pynicotine.logfacility import log
 from pynicotine.shares import PermissionLevel
+from pynicotine.shares import ShareStore
 from pynicotine.slskmessages import AddAllowedResponse
 from pynicotine.slskmessages import FileSearch
 from pynicotine.slskmessages import FileSearchResponse
@@ -106,11 +112,124 @@ class WishSearchRequest(SearchRequest):
         }
 
 
+class SearchRequestStatistics:
+    """Counters and latencies of incoming search requests we respond to,
+    used to tune share and search settings."""
+
+    __slots__ = ("counters", "latencies", "_request_times")
+
+    LATENCY_SAMPLE_SIZE = 1000
+    REQUEST_RATE_INTERVAL = 60
+    STAGES = ("parse", "intersect", "fetch", "queue")
+    COUNTERS = (
+        "received", "duplicate", "disabled", "shutting_down", "too_short", "banned", "unmatched_words",
+        "rate_limited", "dropped", "outdated", "cache_hits", "no_results", "responses", "results"
+    )
+
+    def __init__(self):
+
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.latencies = {stage: deque(maxlen=self.LATENCY_SAMPLE_SIZE) for stage in self.STAGES}
+        self._request_times = deque()
+
+    def _remove_old_request_times(self, current_time):
+
+        request_times = self._request_times
+        oldest_time = (current_time - self.REQUEST_RATE_INTERVAL)
+
+        while request_times and request_times[0] < oldest_time:
+            request_times.popleft()
+
+    def add_request(self):
+
+        current_time = time.monotonic()
+
+        self.counters["received"] += 1
+        self._request_times.append(current_time)
+        self._remove_old_request_times(current_time)
+
+    def add_latency(self, stage, duration):
+        self.latencies[stage].append(duration)
+
+    @staticmethod
+    def get_percentiles(durations):
+        """Returns the 50th, 90th and 99th percentile of durations, in
+        milliseconds."""
+
+        if not durations:
+            return None
+
+        durations = sorted(durations)
+        last_index = (len(durations) - 1)
+
+        return {
+            percentile: durations[round(last_index * percentile / 100)] * 1000
+            for percentile in (50, 90, 99)
+        }
+
+    def get_requests_per_second(self):
+
+        self._remove_old_request_times(time.monotonic())
+        return len(self._request_times) / self.REQUEST_RATE_INTERVAL
+
+    def as_dict(self):
+
+        return {
+            "counters": self.counters.copy(),
+            "requests_per_second": self.get_requests_per_second(),
+            "latencies": {stage: self.get_percentiles(durations) for stage, durations in self.latencies.items()}
+        }
+
+    def clear(self):
+
+        for counter in self.counters:
+            self.counters[counter] = 0
+
+        for durations in self.latencies.values():
+            durations.clear()
+
+        self._request_times.clear()
+
+
+class SearchWorkBudget:
+    """Token bucket limiting the amount of work spent on incoming search
+    requests. Work units are refilled at a fixed rate per second, and can be
+    saved up for a short burst of requests."""
+
+    __slots__ = ("work_units", "last_update_time")
+
+    BURST_DURATION = 10
+
+    def __init__(self, rate, current_time):
+        self.work_units = (rate * self.BURST_DURATION)
+        self.last_update_time = current_time
+
+    def refill(self, rate, current_time):
+        """Adds work units for the time passed since the last update, and
+        returns the maximum number of work units that can be saved up."""
+
+        capacity = (rate * self.BURST_DURATION)
+        self.work_units = min(self.work_units + ((current_time - self.last_update_time) * rate), capacity)
+        self.last_update_time = current_time
+
+        return capacity
+
+
 class Search:
     __slots__ = ("searches", "excluded_phrases", "wishlist", "wishlist_file_path", "wishlist_interval",
-                 "_token", "_own_tokens", "_allow_saving_wishlist", "_wishlist_timer_id")
+                 "_token", "_own_tokens", "_allow_saving_wishlist", "_wishlist_timer_id", "_search_request_pool",
+                 "_num_pending_search_requests", "_search_response_cache", "_search_response_cache_generation",
+                 "_excluded_phrase_pattern", "_lowercase_excluded_phrases", "_recent_search_requests",
+                 "search_request_statistics",
+                 "_user_search_work_budgets", "_total_search_work_budget")
 
     SEARCH_HISTORY_LIMIT = 200
+    SEARCH_RESPONSE_CACHE_SIZE = 100
+    RECENT_SEARCH_REQUEST_INTERVAL = 60
+    RECENT_SEARCH_REQUESTS_LIMIT = 10000
+    USER_SEARCH_WORK_BUDGETS_LIMIT = 1000
+    SEARCH_WORK_INDICES_PER_UNIT = 1000
+    PARTIAL_WORD_WORK_UNITS = 20
     RESULT_FILTER_HISTORY_LIMIT = 50
     REMOVED_SEARCH_CHARACTERS = [
         "!", '"', "#", "$", "%", "&", "'", "(", ")", "*", "+", ",", "-", ".", "/", ":", ";",
@@ -123,6 +242,8 @@ class Search:
 
         self.searches = {}
         self.excluded_phrases = []
+        self._excluded_phrase_pattern = None
+        self._lowercase_excluded_phrases = {}
         self.wishlist = {}
         self.wishlist_file_path = os.path.join(config.data_folder_path, "wishlist.json")
         self.wishlist_interval = 0
@@ -131,6 +252,14 @@ class Search:
         self._own_tokens = set()
         self._allow_saving_wishlist = False
         self._wishlist_timer_id = None
+        self._search_request_pool = None
+        self._num_pending_search_requests = 0
+        self._search_response_cache = {}
+        self._search_response_cache_generation = 0
+        self._recent_search_requests = {}
+        self.search_request_statistics = SearchRequestStatistics()
+        self._user_search_work_budgets = {}
+        self._total_search_work_budget = None
 
         for event_name, callback in (
             ("excluded-search-phrases", self._excluded_search_phrases),
@@ -141,6 +270,7 @@ class Search:
             ("server-disconnect", self._server_disconnect),
             ("server-login", self._server_login),
             ("set-wishlist-interval", self._set_wishlist_interval),
+            ("shares-ready", self._clear_search_response_cache),
             ("start", self._start)
         ):
             events.connect(event_name, callback)
@@ -150,6 +280,13 @@ class Search:
         self._load_wishlist()
         self._allow_saving_wishlist = True
 
+        # Look up results for incoming search requests outside the main thread
+        self._num_pending_search_requests = 0
+        self._search_request_pool = ThreadPoolExecutor(
+            max_workers=max(config.sections["searches"]["search_request_threads"], 1),
+            thread_name_prefix="SearchRequestWorker"
+        )
+
         # Save wishlist every 3 minutes
         events.schedule(delay=180, callback=self._save_wishlist, repeat=True)
 
@@ -159,6 +296,10 @@ class Search:
         self.remove_all_searches()
         self._allow_saving_wishlist = False
 
+        if self._search_request_pool is not None:
+            self._search_request_pool.shutdown(cancel_futures=True)
+            self._search_request_pool = None
+
     def _server_login(self, msg):
 
         if not msg.success:
@@ -170,8 +311,9 @@ class Search:
 
     def _server_disconnect(self, _msg):
 
-        self.excluded_phrases.clear()
+        self._set_excluded_phrases([])
         self._own_tokens.clear()
+        self._recent_search_requests.clear()
 
         events.cancel_scheduled(self._wishlist_timer_id)
         self.wishlist_interval = 0
@@ -595,13 +737,33 @@ class Search:
             self._wishlist_timer_id = events.schedule(
                 delay=self.wishlist_interval, callback=self._do_next_wishlist_search, repeat=True)
 
+    def _set_excluded_phrases(self, phrases):
+        """Compile phrases excluded from the search network into a single
+        pattern, matched once against each lowercase file path in search
+        results."""
+
+        lowercase_excluded_phrases = self._lowercase_excluded_phrases
+        lowercase_excluded_phrases.clear()
+
+        for phrase in phrases:
+            if phrase:
+                lowercase_excluded_phrases.setdefault(phrase.lower(), phrase)
+
+        self.excluded_phrases = phrases
+        self._excluded_phrase_pattern = (
+            re.compile("|".join(map(re.escape, lowercase_excluded_phrases))) if lowercase_excluded_phrases else None
+        )
+
+        self._clear_search_response_cache()
+
     def _excluded_search_phrases(self, msg):
         """Server code 160."""
 
         if self.excluded_phrases and self.excluded_phrases != msg.phrases:
             log.add_search("Previous list of excluded search phrases: %s", self.excluded_phrases)
 
-        self.excluded_phrases = msg.phrases
+        self._set_excluded_phrases(msg.phrases)
+
         log.add_search(
             ngettext(
                 "Server provided %(num_phrases)s excluded search phrase: %(phrases)s",
@@ -644,185 +806,284 @@ class Search:
     def _file_search_request_server(self, msg):
         """Server code 26."""
 
+        self.search_request_statistics.add_request()
+
+        if self._is_duplicate_search_request(msg.searchterm, msg.search_username, msg.token):
+            return
+
         self._process_search_request(msg.searchterm, msg.search_username, msg.token)
         core.pluginhandler.search_request_notification(msg.searchterm, msg.search_username, msg.token)
 
     def _file_search_request_distributed(self, msg):
         """Distrib code 3."""
 
+        self.search_request_statistics.add_request()
+
+        if self._is_duplicate_search_request(msg.searchterm, msg.search_username, msg.token):
+            return
+
         self._process_search_request(msg.searchterm, msg.search_username, msg.token)
         core.pluginhandler.distrib_search_notification(msg.searchterm, msg.search_username, msg.token)
 
     # Incoming Search Requests #
 
-    def _append_file_info(self, file_list, fileinfo):
+    def _is_duplicate_search_request(self, search_term, username, token):
+        """Checks if the same search request was received recently. Copies of
+        a request can reach us through both the server and the distributed
+        network, or several times after our parent changes."""
 
-        file_path, *_unused = fileinfo
-        file_path_lower = file_path.lower()
-        excluded_phrase = next((phrase for phrase in self.excluded_phrases if phrase in file_path_lower), None)
+        recent_search_requests = self._recent_search_requests
+        current_time = time.monotonic()
 
-        # Check if file path contains phrase excluded from the search network
-        if excluded_phrase:
-            log.add_search(('Excluding file %(file)s from search response because server '
-                            'disallowed phrase "%(phrase)s"'), {
-                "file": file_path,
-                "phrase": excluded_phrase
-            })
-            return
+        # Forget requests received before the time window. Requests are stored
+        # in the order they were received.
+        while recent_search_requests:
+            oldest_request_key = next(iter(recent_search_requests))
+
+            if recent_search_requests[oldest_request_key] > current_time:
+                break
+
+            del recent_search_requests[oldest_request_key]
+
+        request_key = (username, token, search_term)
+
+        if request_key in recent_search_requests:
+            self.search_request_statistics.counters["duplicate"] += 1
+            return True
+
+        recent_search_requests[request_key] = (current_time + self.RECENT_SEARCH_REQUEST_INTERVAL)
+
+        if len(recent_search_requests) > self.RECENT_SEARCH_REQUESTS_LIMIT:
+            del recent_search_requests[next(iter(recent_search_requests))]
+
+        return False
+
+    def _is_excluded_file(self, virtual_path):
+        """Checks if a file path contains a phrase excluded from the search
+        network."""
+
+        excluded_phrase_pattern = self._excluded_phrase_pattern
 
-        file_list.append(fileinfo)
+        if excluded_phrase_pattern is None:
+            return False
 
-    def _create_file_info_list(self, results, max_results, permission_level):
-        """Given a list of file indices, retrieve the file information for each index."""
+        excluded_phrase_match = excluded_phrase_pattern.search(virtual_path.lower())
+
+        if excluded_phrase_match is None:
+            return False
+
+        log.add_search(('Excluding file %(file)s from search response because server '
+                        'disallowed phrase "%(phrase)s"'), {
+            "file": virtual_path,
+            "phrase": self._lowercase_excluded_phrases[excluded_phrase_match.group()]
+        })
+        return True
+
+    def _rank_search_results(self, results, max_results, share_store):
+        """Returns the file index and packed search result record of the
+        highest scoring results, ordered by score. Files containing phrases
+        excluded from the search network are skipped.
+
+        Scores (audio quality and folder depth) are stored as a single byte
+        per file, allowing us to rank all results using a heap without
+        decoding their records. Only records of the top results are decoded,
+        and excluded files are replaced by the next best results.
+        """
+
+        ranked_results = []
+        virtual_folder_paths = {}
+        num_checked_results = 0
+        num_candidates = max_results
+
+        while True:
+            # Results with equal scores keep their order, so each larger list of
+            # candidates starts with the candidates we already checked
+            candidates = nlargest(num_candidates, results, key=share_store.get_file_score)
+
+            for index in candidates[num_checked_results:]:
+                record = share_store.get_file_record(index, virtual_folder_paths)
+
+                if self._is_excluded_file(ShareStore.get_virtual_path(record)):
+                    continue
+
+                ranked_results.append((index, record))
+
+                if len(ranked_results) >= max_results:
+                    return ranked_results
+
+            if len(candidates) < num_candidates:
+                return ranked_results
+
+            num_checked_results = len(candidates)
+            num_candidates *= 2
+
+    def _create_file_record_list(self, results, max_results, permission_level, share_store):
+        """Given a sorted list of file indices, retrieve the packed search
+        result record of the highest scoring files, sorted by virtual path."""
 
         reveal_buddy_shares = config.sections["transfers"]["reveal_buddy_shares"]
         reveal_trusted_shares = config.sections["transfers"]["reveal_trusted_shares"]
         is_buddy = (permission_level == PermissionLevel.BUDDY)
         is_trusted = (permission_level == PermissionLevel.TRUSTED)
+        include_buddy_files = (is_buddy or reveal_buddy_shares)
+        include_trusted_files = (is_trusted or reveal_trusted_shares)
 
-        fileinfos = []
-        private_fileinfos = []
-        num_fileinfos = 0
+        records = []
+        private_records = []
 
-        public_files = core.shares.share_dbs["public_files"]
-        buddy_files = core.shares.share_dbs["buddy_files"]
-        trusted_files = core.shares.share_dbs["trusted_files"]
+        # File indices are assigned to public, buddy and trusted files in that order
+        num_public_files = share_store.get_num_files(PermissionLevel.PUBLIC)
+        num_public_buddy_files = (num_public_files + share_store.get_num_files(PermissionLevel.BUDDY))
 
-        for index in islice(results, min(len(results), max_results)):
-            file_path = core.shares.file_path_index[index]
+        # Only rank files visible to the user. Files of each permission level are
+        # consecutive in the sorted result list.
+        visible_results = results[:bisect_left(
+            results, num_public_buddy_files if include_buddy_files else num_public_files)]
 
-            if file_path in public_files:
-                self._append_file_info(fileinfos, public_files[file_path])
-                continue
+        if include_trusted_files:
+            visible_results += results[bisect_left(results, num_public_buddy_files):]
 
-            if (is_buddy or reveal_buddy_shares) and file_path in buddy_files:
-                fileinfo = buddy_files[file_path]
+        for index, record in self._rank_search_results(visible_results, max_results, share_store):
+            if index < num_public_files:
+                record_list = records
 
-                if is_buddy:
-                    self._append_file_info(fileinfos, fileinfo)
-                else:
-                    self._append_file_info(private_fileinfos, fileinfo)
-                continue
+            elif index < num_public_buddy_files:
+                record_list = records if is_buddy else private_records
 
-            if (is_trusted or reveal_trusted_shares) and file_path in trusted_files:
-                fileinfo = trusted_files[file_path]
-
-                if is_trusted:
-                    self._append_file_info(fileinfos, fileinfo)
-                else:
-                    self._append_file_info(private_fileinfos, fileinfo)
+            else:
+                record_list = records if is_trusted else private_records
 
-        results.clear()
+            record_list.append((ShareStore.get_virtual_path(record), record))
 
-        if fileinfos:
-            fileinfos.sort(key=itemgetter(0))
+        if records:
+            records.sort(key=itemgetter(0))
 
-        if private_fileinfos:
-            private_fileinfos.sort(key=itemgetter(0))
+        if private_records:
+            private_records.sort(key=itemgetter(0))
 
-        num_fileinfos = len(fileinfos) + len(private_fileinfos)
-        return num_fileinfos, fileinfos, private_fileinfos
+        num_records = len(records) + len(private_records)
+        return (
+            num_records,
+            [record for _virtual_path, record in records],
+            [record for _virtual_path, record in private_records]
+        )
 
     @staticmethod
-    def _update_search_results(results, word_indices, excluded=False):
-        """Updates the search result list with indices for a new word."""
+    def _find_index_position(indices, index, position):
+        """Returns the position of the first item in a sorted list of file
+        indices that is not smaller than the provided index, starting the
+        search at a previous position. Gallops ahead exponentially before
+        bisecting, allowing us to skip large parts of long lists."""
 
-        if not word_indices:
-            if excluded:
-                # We don't care if an excluded word doesn't exist in our DB
-                return results
+        num_indices = len(indices)
+        bound = 1
 
-            # Included word does not exist in our DB, no results
-            return set()
+        while position + bound < num_indices and indices[position + bound] < index:
+            bound *= 2
 
-        if results is None:
-            if excluded:
-                # No results yet, but word is excluded. Bail.
-                return set()
+        return bisect_left(indices, index, position, min(position + bound + 1, num_indices))
 
-            # First match for included word, return results
-            return set(word_indices)
+    def _iter_common_indices(self, included_indices, excluded_indices):
+        """Yields file indices present in all included lists, and absent from
+        all excluded lists. All lists must be sorted, and the list of included
+        lists must start with the smallest one."""
 
-        if excluded:
-            # Remove results for excluded word
-            results.difference_update(word_indices)
-        else:
-            # Only retain common results for all words so far
-            results.intersection_update(word_indices)
+        start_indices, *included_indices = included_indices
+        included_positions = [0] * len(included_indices)
+        excluded_positions = [0] * len(excluded_indices)
 
-        return results
+        for index in start_indices:
+            is_match = True
 
-    def _create_search_result_list(self, included_words, excluded_words, partial_words, max_results, word_index):
-        """Returns a list of common file indices for each word in a search
-        term."""
+            for list_number, indices in enumerate(included_indices):
+                position = included_positions[list_number] = self._find_index_position(
+                    indices, index, included_positions[list_number])
 
-        for word in included_words:
-            if word not in word_index:
-                # No results
-                return None
+                if position >= len(indices):
+                    # No more common indices
+                    return
+
+                if indices[position] != index:
+                    is_match = False
+                    break
+
+            if not is_match:
+                continue
+
+            for list_number, indices in enumerate(excluded_indices):
+                position = excluded_positions[list_number] = self._find_index_position(
+                    indices, index, excluded_positions[list_number])
 
-        start_word = next(iter(included_words), None)
+                if position < len(indices) and indices[position] == index:
+                    is_match = False
+                    break
 
-        if not start_word:
+            if is_match:
+                yield index
+
+    def _intersect_indices(self, indices, other_indices):
+        """Returns the file indices present in both sorted lists."""
+
+        if len(indices) > len(other_indices):
+            indices, other_indices = other_indices, indices
+
+        return array("I", self._iter_common_indices((indices, other_indices), ()))
+
+    def _create_search_result_list(self, included_words, excluded_words, partial_words, word_index,
+                                   word_suffixes=None):
+        """Returns a sorted list of common file indices for each word in a
+        search term.
+
+        Posting lists in the word index are sorted arrays of file indices.
+        We walk the smallest list and skip ahead in the others, without
+        building sets of every index in a list.
+        """
+
+        if not included_words:
             # Require at least one complete word to return results. Matches official clients.
             return None
 
-        results = None
-        has_single_word = (len(included_words) + len(excluded_words) + len(partial_words) == 1)
-        included_words.discard(start_word)
+        included_indices = []
 
         # Included search words (e.g. hello)
-        start_results = word_index[start_word]
+        for word in included_words:
+            indices = word_index.get(word)
+
+            if not indices:
+                # No results
+                return None
 
-        if has_single_word:
-            # Attempt to avoid large memory usage if someone searches for e.g. "flac"
-            start_results = start_results[:max_results]
+            included_indices.append(indices)
 
-        results = self._update_search_results(results, start_results)
+        # Excluded search words (e.g. -hello). We don't care if an excluded word doesn't exist in our DB.
+        excluded_indices = [indices for indices in map(word_index.get, excluded_words) if indices]
 
-        for included_word in included_words:
-            results = self._update_search_results(results, word_index[included_word])
+        included_indices.sort(key=len)
+        common_indices = self._iter_common_indices(included_indices, excluded_indices)
 
-            if not results:
-                return None
+        results = array("I", common_indices)
+
+        if not partial_words:
+            return results or None
 
         # Partial search words (e.g. *ello)
         for partial_word in partial_words:
-            partial_word_len = len(partial_word)
             partial_results = set()
 
-            for complete_word in word_index:
-                if len(complete_word) < partial_word_len or not complete_word.endswith(partial_word):
-                    continue
-
-                indices = {i for i in word_index[complete_word] if i in results}
+            if word_suffixes is not None:
+                complete_words = word_suffixes.iter_words(partial_word)
+            else:
+                complete_words = (word for word in word_index if word.endswith(partial_word))
 
-                if indices:
-                    partial_results.update(indices)
+            for complete_word in complete_words:
+                partial_results.update(self._intersect_indices(results, word_index[complete_word]))
 
             if not partial_results:
                 return None
 
-            results = self._update_search_results(results, partial_results)
-
-            if not results:
-                return None
-
-        # Excluded search words (e.g. -hello)
-        if results:
-            for excluded_word in excluded_words:
-                if excluded_word not in word_index:
-                    continue
-
-                results = self._update_search_results(results, word_index[excluded_word], excluded=True)
-
-                if not results:
-                    return None
-
-        if not results:
-            return None
+            results = array("I", (index for index in results if index in partial_results))
 
-        return results
+        return results or None
 
     def _process_search_request(self, search_term, username, token):
         """This section is accessed every time a search request arrives,
@@ -834,12 +1095,16 @@ class Search:
         if not search_term:
             return
 
+        statistics = self.search_request_statistics
+
         if not config.sections["searches"]["search_results"]:
             # Don't return _any_ results when this option is disabled
+            statistics.counters["disabled"] += 1
             return
 
         if core.uploads.pending_shutdown:
             # Don't return results when waiting to quit after finishing uploads
+            statistics.counters["shutting_down"] += 1
             return
 
         local_username = core.users.login_username
@@ -855,22 +1120,127 @@ class Search:
         max_results = config.sections["searches"]["maxresults"]
 
         if max_results <= 0:
+            statistics.counters["disabled"] += 1
             return
 
         if len(search_term) < config.sections["searches"]["min_search_chars"]:
             # Don't send search response if search term contains too few characters
+            statistics.counters["too_short"] += 1
             return
 
         permission_level, _reject_reason = core.shares.check_user_permission(username)
 
         if permission_level == PermissionLevel.BANNED:
+            statistics.counters["banned"] += 1
             return
 
-        if "words" not in core.shares.share_dbs:
+        share_store = core.shares.share_store
+
+        if share_store is None:
             return
 
-        word_index = core.shares.share_dbs["words"]
-        original_search_term = search_term
+        start_time = time.perf_counter()
+        search_words = self._parse_search_term(search_term)
+        included_words, *_unused = search_words
+        word_filter = share_store.word_filter
+
+        # Require at least one complete word to return results. Matches official clients.
+        # Most search requests don't match our shares, reject them early.
+        has_unmatched_words = (not included_words or any(word not in word_filter for word in included_words))
+        statistics.add_latency("parse", time.perf_counter() - start_time)
+
+        if has_unmatched_words:
+            statistics.counters["unmatched_words"] += 1
+            return
+
+        # Search results also depend on the visibility of buddy and trusted shares
+        cache_key = (
+            search_words, permission_level, max_results,
+            config.sections["transfers"]["reveal_buddy_shares"], config.sections["transfers"]["reveal_trusted_shares"]
+        )
+        cached_response = self._search_response_cache.pop(cache_key, None)
+
+        if cached_response is not None:
+            # Popular search term, reuse results and mark them as recently used
+            self._search_response_cache[cache_key] = cached_response
+            statistics.counters["cache_hits"] += 1
+            self._send_search_response(search_term, username, token, *cached_response)
+            return
+
+        work_units = self._estimate_search_work(search_words, share_store.word_index)
+
+        if not self._admit_search_request(username, work_units):
+            statistics.counters["rate_limited"] += 1
+            log.add_search(('Rate limiting search request "%(query)s" from user %(user)s, '
+                            'estimated work units: %(num_units)s'), {
+                "query": search_term,
+                "user": username,
+                "num_units": work_units
+            })
+            return
+
+        self._queue_search_request(search_term, username, token, cache_key, share_store)
+
+    def _estimate_search_work(self, search_words, word_index):
+        """Returns the estimated number of work units needed to look up results
+        for a search request. Common file indices are found by walking the
+        smallest posting list of the included words. Every partial word
+        requires a vocabulary lookup."""
+
+        included_words, _excluded_words, partial_words = search_words
+        num_candidates = min(word_index.get_num_indices(word) for word in included_words)
+
+        return (
+            1 + ((num_candidates * len(included_words)) // self.SEARCH_WORK_INDICES_PER_UNIT)
+            + (len(partial_words) * self.PARTIAL_WORD_WORK_UNITS)
+        )
+
+    def _admit_search_request(self, username, work_units):
+        """Checks if the search work budgets of a user and all users allow us
+        to look up results for a search request, and takes work units from
+        them if so."""
+
+        user_rate = config.sections["searches"]["user_search_work_rate"]
+        total_rate = config.sections["searches"]["total_search_work_rate"]
+        current_time = time.monotonic()
+        budgets = []
+
+        if user_rate > 0:
+            # Budgets are ordered by last use. Forget the least recently active user when
+            # there are too many budgets.
+            user_budgets = self._user_search_work_budgets
+            user_budget = user_budgets.pop(username, None)
+
+            if user_budget is None:
+                user_budget = SearchWorkBudget(user_rate, current_time)
+
+                if len(user_budgets) >= self.USER_SEARCH_WORK_BUDGETS_LIMIT:
+                    del user_budgets[next(iter(user_budgets))]
+
+            user_budgets[username] = user_budget
+            budgets.append((user_budget, user_rate))
+
+        if total_rate > 0:
+            if self._total_search_work_budget is None:
+                self._total_search_work_budget = SearchWorkBudget(total_rate, current_time)
+
+            budgets.append((self._total_search_work_budget, total_rate))
+
+        for budget, rate in budgets:
+            capacity = budget.refill(rate, current_time)
+
+            # Expensive requests are allowed once the budget is full
+            if budget.work_units < min(work_units, capacity):
+                return False
+
+        for budget, _rate in budgets:
+            budget.work_units -= work_units
+
+        return True
+
+    def _parse_search_term(self, search_term):
+        """Returns included, excluded and partial words in a search term."""
+
         search_term = search_term.lower()
 
         # Extract included/excluded/partial words from search term
@@ -899,30 +1269,130 @@ class Search:
         search_term = search_term.translate(TRANSLATE_PUNCTUATION).strip()
         included_words = (set(search_term.split()) - excluded_words - partial_words)
 
-        # Find common file matches for each word in search term
-        results = self._create_search_result_list(
-            included_words, excluded_words, partial_words, max_results, word_index)
+        return frozenset(included_words), frozenset(excluded_words), frozenset(partial_words)
+
+    def _clear_search_response_cache(self, *_args):
+
+        self._search_response_cache.clear()
+        self._search_response_cache_generation += 1
+
+    def _queue_search_request(self, search_term, username, token, cache_key, share_store):
+        """Pass a search request to the worker threads, along with the share
+        store that was loaded when the request arrived. Returns False if the
+        request was dropped due to too many pending requests."""
+
+        if self._search_request_pool is None:
+            return False
+
+        if self._num_pending_search_requests >= config.sections["searches"]["max_pending_search_requests"]:
+            # Overloaded, drop new requests until pending ones are processed
+            self.search_request_statistics.counters["dropped"] += 1
+            log.add_search('Dropping search request "%(query)s" from user %(user)s, too many pending requests', {
+                "query": search_term,
+                "user": username
+            })
+            return False
 
-        if not results:
+        self._num_pending_search_requests += 1
+        self._search_request_pool.submit(
+            self._find_search_results, search_term, username, token, cache_key, share_store,
+            self._search_response_cache_generation
+        )
+        return True
+
+    def _find_search_results(self, search_term, username, token, cache_key, share_store, cache_generation):
+        """Runs in a worker thread. The share store is memory-mapped and only
+        read here, but can be closed by the main thread at any time when
+        rescanning shares. All lookups use the same share store, since file
+        indices differ between share stores."""
+
+        search_words, permission_level, max_results, *_unused = cache_key
+        included_words, excluded_words, partial_words = search_words
+
+        latencies = []
+
+        try:
+            # Find common file matches for each word in search term
+            start_time = time.perf_counter()
+            results = self._create_search_result_list(
+                included_words, excluded_words, partial_words, share_store.word_index, share_store.word_suffixes)
+            search_response = (0, None, None)
+            latencies.append(("intersect", time.perf_counter() - start_time))
+
+            if results:
+                # Get packed search result record of the highest scoring file indices in result list
+                start_time = time.perf_counter()
+                search_response = self._create_file_record_list(results, max_results, permission_level, share_store)
+                latencies.append(("fetch", time.perf_counter() - start_time))
+
+        except Exception as error:
+            log.add_debug("Failed to look up search results for %(query)s: %(error)s", {
+                "query": search_term,
+                "error": error
+            })
+            search_response = None
+
+        events.invoke_main_thread(
+            self._search_results_found, search_term, username, token, cache_key, share_store, cache_generation,
+            search_response, latencies
+        )
+
+    def _search_results_found(self, search_term, username, token, cache_key, share_store, cache_generation,
+                              search_response, latencies=()):
+
+        self._num_pending_search_requests -= 1
+
+        for stage, duration in latencies:
+            self.search_request_statistics.add_latency(stage, duration)
+
+        if search_response is None:
+            return
+
+        if (share_store is not core.shares.share_store
+                or cache_generation != self._search_response_cache_generation):
+            # Shares were rescanned or excluded phrases changed while looking up results.
+            # Records could point to files no longer shared.
+            self.search_request_statistics.counters["outdated"] += 1
+            log.add_search('Dropping search response for "%(query)s" to user %(user)s, shares changed', {
+                "query": search_term,
+                "user": username
+            })
             return
 
-        # Get file information for each file index in result list
-        num_results, fileinfos, private_fileinfos = self._create_file_info_list(
-            results, max_results, permission_level)
+        search_response_cache = self._search_response_cache
+        search_response_cache[cache_key] = search_response
+
+        if len(search_response_cache) > self.SEARCH_RESPONSE_CACHE_SIZE:
+            del search_response_cache[next(iter(search_response_cache))]
+
+        self._send_search_response(search_term, username, token, *search_response)
+
+    def _send_search_response(self, search_term, username, token, num_results, records, private_records):
+
+        statistics = self.search_request_statistics
 
         if not num_results:
+            statistics.counters["no_results"] += 1
             return
 
+        # Only building and queueing the response is measured. The network thread packs
+        # and compresses it later.
+        start_time = time.perf_counter()
+
         core.send_message_to_peer(username, FileSearchResponse(
-            search_username=local_username,
+            search_username=core.users.login_username,
             token=token,
-            shares=fileinfos,
+            shares=records,
             freeulslots=core.uploads.is_new_upload_accepted(),
             ulspeed=core.uploads.upload_speed,
             inqueue=core.uploads.get_upload_queue_size(username),
-            private_shares=private_fileinfos
+            private_shares=private_records
         ))
 
+        statistics.add_latency("queue", time.perf_counter() - start_time)
+        statistics.counters["responses"] += 1
+        statistics.counters["results"] += num_results
+
         log.add_search(
             ngettext(
                 'User %(user)s is searching for "%(query)s", found %(num)s result',
@@ -930,7 +1400,7 @@ class Search:
                 num_results
             ), {
                 "user": username,
-                "query": original_search_term,
+                "query": search_term,
                 "num": humanize(num_results)
             }
         )
@@ -5,26 +5,30 @@
 # SPDX-FileCopyrightText: 2009 daelstorm <daelstorm@gmail.com>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import gc
+import errno
 import mmap
 import os
 import re
+import select
+import shutil
 import stat
 import sys
 import time
 
+from array import array
 from collections import defaultdict
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
-from itertools import chain
-from os import SEEK_END
+from functools import partial
 from os import SEEK_SET
-from pickle import HIGHEST_PROTOCOL
-from pickle import dumps
 from pickle import Unpickler
 from pickle import UnpicklingError
 from struct import Struct
 from threading import Thread
+from zlib import crc32
 
 from pynicotine import rename_process
 from pynicotine.config import config
@@ -97,131 +101,1036 @@ class DatabaseVersionError(DatabaseError):
     pass
 
 
-class Database:
-    """Custom key-value database format for Nicotine+ shares."""
+class LegacyDatabase:
+    """Reader for pickle-based share databases (version 3), used to migrate
+    file metadata of previous versions without reading every file again."""
 
-    __slots__ = ("_value_offsets", "_file_handle", "_file_offset", "_overwrite")
+    __slots__ = ("_content", "_value_offsets")
 
     FILE_SIGNATURE = b"DBN+"
     VERSION = 3
+    HEADER_SIZE = 5
     LENGTH_DATA_SIZE = 8
-    PACK_LENGTHS = Struct("!II").pack
     UNPACK_LENGTHS = Struct("!II").unpack_from
-    PICKLE_PROTOCOL = min(HIGHEST_PROTOCOL, 5)  # Use version 5 when available
 
-    def __init__(self, file_path, overwrite=True):
+    def __init__(self, file_path):
 
-        folder_path = os.path.dirname(file_path)
-        mode = "ab+" if overwrite else "rb"
+        self._value_offsets = {}
 
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
+        with open(file_path, "rb") as file_handle:
+            file_size = os.fstat(file_handle.fileno()).st_size
 
-        if overwrite and os.path.exists(file_path):
-            os.remove(file_path)
+            if file_size <= self.HEADER_SIZE:
+                raise DatabaseError("Not a database file")
 
-        self._value_offsets = self._load_value_offsets(file_path, mode)
+            self._content = mmap.mmap(file_handle.fileno(), length=0, access=mmap.ACCESS_READ)
 
-        if overwrite:
-            self._file_handle = open(file_path, mode)  # pylint: disable=consider-using-with
-        else:
-            with open(file_path, mode) as file_handle:
-                self._file_handle = mmap.mmap(file_handle.fileno(), length=0, access=mmap.ACCESS_READ)
+        try:
+            self._parse_content(file_size)
 
-        self._file_offset = self._file_handle.seek(0, SEEK_END)
-        self._overwrite = overwrite
+        except Exception:
+            self._content.close()
+            raise
 
-    def _parse_content(self, content, total_size):
+    def _parse_content(self, file_size):
 
-        value_offsets = {}
+        content = self._content
         file_signature_length = len(self.FILE_SIGNATURE)
 
         if content[:file_signature_length] != self.FILE_SIGNATURE:
             raise DatabaseError("Not a database file")
 
-        if content[file_signature_length:file_signature_length + 1][0] != self.VERSION:
+        if content[file_signature_length] != self.VERSION:
             raise DatabaseVersionError("Incompatible version")
 
-        current_offset = (file_signature_length + 1)
+        current_offset = self.HEADER_SIZE
 
-        while current_offset < total_size:
+        while current_offset < file_size:
             key_offset = (current_offset + self.LENGTH_DATA_SIZE)
-            key_length, value_length = self.UNPACK_LENGTHS(content[current_offset:key_offset])
+            key_length, value_length = self.UNPACK_LENGTHS(content, current_offset)
             value_offset = (key_offset + key_length)
-            key = content[key_offset:value_offset].tobytes().decode("utf-8")
 
-            value_offsets[key] = value_offset
+            self._value_offsets[content[key_offset:value_offset].decode("utf-8")] = value_offset
             current_offset = (value_offset + value_length)
 
-        return value_offsets
+    def get(self, key, default=None):
+
+        value_offset = self._value_offsets.get(key)
+
+        if value_offset is None:
+            return default
+
+        self._content.seek(value_offset, SEEK_SET)
+        return RestrictedUnpickler(self._content).load()
+
+    def close(self):
+        self._content.close()
+
+
+class WordSuffixIndex:
+    """Sorted list of reversed words in the word index, stored in a section
+    of the share store.
+
+    Allows us to find all words ending with a partial search word (e.g.
+    *ello) by looking up a range of reversed words, instead of scanning the
+    entire vocabulary. The position of a word in the list is also its word
+    number in the word index.
+    """
+
+    __slots__ = ("_content", "_num_words", "_offsets_offset", "_blob_offset")
+
+    OFFSET_SIZE = 4
+    PACK_NUM_WORDS = Struct("!I").pack
+    UNPACK_NUM_WORDS = Struct("!I").unpack_from
+    UNPACK_WORD_OFFSETS = Struct("!II").unpack_from
+
+    def __init__(self, content, offset):
+
+        self._content = content
+        self._num_words, = self.UNPACK_NUM_WORDS(content, offset)
+        self._offsets_offset = (offset + self.OFFSET_SIZE)
+        self._blob_offset = (self._offsets_offset + ((self._num_words + 1) * self.OFFSET_SIZE))
+
+        if self._blob_offset > len(content):
+            raise DatabaseError("Incomplete word suffix index")
+
+    @classmethod
+    def write(cls, file_handle, reversed_words):
+        """Write a sorted list of reversed, encoded words."""
+
+        word_offsets = array("I", [0])
+        current_offset = 0
+
+        for reversed_word in reversed_words:
+            current_offset += len(reversed_word)
+            word_offsets.append(current_offset)
+
+        if sys.byteorder == "little":
+            # Network byte order
+            word_offsets.byteswap()
+
+        file_handle.write(cls.PACK_NUM_WORDS(len(reversed_words)))
+        file_handle.write(word_offsets.tobytes())
+        file_handle.write(b"".join(reversed_words))
+
+    def _get_reversed_word(self, word_number):
+
+        start_offset, end_offset = self.UNPACK_WORD_OFFSETS(
+            self._content, self._offsets_offset + (word_number * self.OFFSET_SIZE))
+
+        return self._content[self._blob_offset + start_offset:self._blob_offset + end_offset]
+
+    def _find_word_number(self, reversed_prefix):
+        """Returns the number of the first reversed word not smaller than the
+        provided prefix."""
+
+        low = 0
+        high = self._num_words
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._get_reversed_word(middle) < reversed_prefix:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def get_word_number(self, word):
+        """Returns the number of a word, or None if the word is not in the
+        index."""
+
+        reversed_word = word[::-1].encode("utf-8")
+        word_number = self._find_word_number(reversed_word)
+
+        if word_number < self._num_words and self._get_reversed_word(word_number) == reversed_word:
+            return word_number
+
+        return None
+
+    def iter_words(self, suffix):
+        """Yields all words ending with the provided suffix."""
+
+        prefix = suffix[::-1].encode("utf-8")
+
+        for word_number in range(self._find_word_number(prefix), self._num_words):
+            reversed_word = self._get_reversed_word(word_number)
+
+            if not reversed_word.startswith(prefix):
+                break
+
+            yield reversed_word.decode("utf-8")[::-1]
+
+    def __iter__(self):
+        for word_number in range(self._num_words):
+            yield self._get_reversed_word(word_number).decode("utf-8")[::-1]
+
+    def __len__(self):
+        return self._num_words
+
+
+class WordIndex:
+    """Sorted file indices of each word in the virtual paths of shared files,
+    stored in a section of the share store in the order of the word suffix
+    index."""
+
+    __slots__ = ("_content", "_word_suffixes", "_offsets_offset", "_blob_offset")
+
+    OFFSET_SIZE = 8
+    UNPACK_INDICES_OFFSETS = Struct("!QQ").unpack_from
+
+    def __init__(self, content, offset, word_suffixes):
+
+        self._content = content
+        self._word_suffixes = word_suffixes
+        self._offsets_offset = offset
+        self._blob_offset = (offset + ((len(word_suffixes) + 1) * self.OFFSET_SIZE))
+
+        if self._blob_offset > len(content):
+            raise DatabaseError("Incomplete word index")
+
+    @classmethod
+    def write(cls, file_handle, word_indices):
+        """Write lists of file indices, ordered by word number."""
+
+        indices_offsets = array("Q", [0])
+        current_offset = 0
+
+        for indices in word_indices:
+            current_offset += len(indices) * indices.itemsize
+            indices_offsets.append(current_offset)
+
+        if sys.byteorder == "little":
+            # Network byte order
+            indices_offsets.byteswap()
+
+        file_handle.write(indices_offsets.tobytes())
+
+        for indices in word_indices:
+            file_handle.write(indices.tobytes())
+
+    def _find_indices(self, word):
+        """Returns the start and end offset of the file indices of a word, or
+        None if the word is not in the index."""
+
+        word_number = self._word_suffixes.get_word_number(word)
+
+        if word_number is None:
+            return None
+
+        start_offset, end_offset = self.UNPACK_INDICES_OFFSETS(
+            self._content, self._offsets_offset + (word_number * self.OFFSET_SIZE))
+
+        return (self._blob_offset + start_offset), (self._blob_offset + end_offset)
+
+    def get(self, word, default=None):
+
+        indices_offsets = self._find_indices(word)
 
-    def _load_value_offsets(self, file_path, mode):
+        if indices_offsets is None:
+            return default
 
-        value_offsets = {}
+        start_offset, end_offset = indices_offsets
+        indices = array("I")
+        indices.frombytes(self._content[start_offset:end_offset])
 
-        with open(file_path, mode) as file_handle:  # pylint: disable=unspecified-encoding
+        return indices
+
+    def get_num_indices(self, word):
+        """Returns the number of files containing a word, without reading
+        their file indices."""
+
+        indices_offsets = self._find_indices(word)
+
+        if indices_offsets is None:
+            return 0
+
+        start_offset, end_offset = indices_offsets
+        return (end_offset - start_offset) // array("I").itemsize
+
+    def __contains__(self, word):
+        return self._find_indices(word) is not None
+
+    def __getitem__(self, word):
+
+        indices = self.get(word)
+
+        if indices is None:
+            raise KeyError(word)
+
+        return indices
+
+    def __iter__(self):
+        return iter(self._word_suffixes)
+
+    def __len__(self):
+        return len(self._word_suffixes)
+
+
+class WordFilter:
+    """Bloom filter over the words in the word index, stored in a section of
+    the share store.
+
+    Allows us to reject incoming search requests for words that are not in
+    our shares, without looking up words in the word index or passing the
+    request to a worker thread. Words can be falsely reported as present,
+    but never as absent.
+    """
+
+    __slots__ = ("_content", "_bits_offset", "_num_bits", "_num_hashes")
+
+    HEADER_SIZE = 5
+    BITS_PER_WORD = 10
+    NUM_HASHES = 7
+    HASH_SEED = 0x9E3779B9
+    PACK_HEADER = Struct("!IB").pack
+    UNPACK_HEADER = Struct("!IB").unpack_from
+
+    def __init__(self, content, offset):
+
+        self._content = content
+        self._num_bits, self._num_hashes = self.UNPACK_HEADER(content, offset)
+        self._bits_offset = (offset + self.HEADER_SIZE)
+
+        if not self._num_bits or self._bits_offset + (self._num_bits // 8) > len(content):
+            raise DatabaseError("Incomplete word filter")
+
+    @classmethod
+    def _iter_bit_positions(cls, word, num_bits, num_hashes):
+        """Yields the bit positions of a word, using double hashing."""
+
+        encoded_word = word.encode("utf-8")
+        hash1 = crc32(encoded_word)
+        hash2 = (crc32(encoded_word, cls.HASH_SEED) | 1)
+
+        for hash_number in range(num_hashes):
+            yield (hash1 + (hash_number * hash2)) % num_bits
+
+    @classmethod
+    def write(cls, file_handle, words):
+
+        # Round up to whole bytes
+        num_bits = max(len(words) * cls.BITS_PER_WORD, 64)
+        num_bits += (-num_bits % 8)
+        bits = bytearray(num_bits // 8)
+
+        for word in words:
+            for bit_position in cls._iter_bit_positions(word, num_bits, cls.NUM_HASHES):
+                bits[bit_position >> 3] |= (1 << (bit_position & 7))
+
+        file_handle.write(cls.PACK_HEADER(num_bits, cls.NUM_HASHES))
+        file_handle.write(bits)
+
+    def __contains__(self, word):
+
+        content = self._content
+        bits_offset = self._bits_offset
+
+        for bit_position in self._iter_bit_positions(word, self._num_bits, self._num_hashes):
+            if not content[bits_offset + (bit_position >> 3)] & (1 << (bit_position & 7)):
+                return False
+
+        return True
+
+
+class SharedFolderStreams:
+    """Packed file lists of the folders in a permission level of the share
+    store, used to build the compressed list of our shares."""
+
+    __slots__ = ("_share_store", "_permission_level")
+
+    def __init__(self, share_store, permission_level):
+        self._share_store = share_store
+        self._permission_level = permission_level
+
+    def items(self):
+        return self._share_store.iter_folder_streams(self._permission_level)
+
+    def __len__(self):
+        return self._share_store.get_num_folders(self._permission_level)
+
+
+class ShareStore:
+    """Memory-mapped store of our shares, written by the scanner once a scan
+    is complete.
+
+    All shares are kept in a single file, split into sections:
+
+    - streams: packed file list of each folder, as sent to other users
+    - names: folder names, referenced by folder records
+    - folders: fixed-size folder records, pointing to their parent folder,
+      name and stream
+    - folder_order: folder numbers sorted by lowercase virtual path
+    - files: fixed-size file records, pointing to the file's entry in the
+      folder stream
+    - file_scores: one-byte ranking score of each file
+    - inode_order: file indices sorted by inode, to find moved files
+    - word_suffixes, word_indices, word_filter: the word index
+
+    Paths are never stored in full. The path of a folder is made up of its
+    own name and the names of its parent folders, and the path of a file of
+    its folder path and the name in its stream entry. Search result records
+    are built from stream entries when needed.
+
+    Folders and files are numbered in the order they were scanned. Public
+    folders and files come first, followed by buddy and trusted ones.
+    Section offsets and the number of folders and files in each permission
+    level are stored in a trailer at the end of the file.
+    """
+
+    __slots__ = ("_content", "_names_offset", "_folders_offset", "_folder_order_offset", "_files_offset",
+                 "_file_scores_offset", "_inode_order_offset", "_num_inodes", "_num_folders", "_num_files",
+                 "word_suffixes", "word_index", "word_filter")
+
+    FILE_SIGNATURE = b"SHR+"
+    VERSION = 1
+    HEADER_SIZE = 5
+    PERMISSION_LEVELS = (PermissionLevel.PUBLIC, PermissionLevel.BUDDY, PermissionLevel.TRUSTED)
+
+    NUM_SECTION_OFFSETS = 9
+    TRAILER_SIZE = 100
+    PACK_TRAILER = Struct("!9Q6I").pack
+    UNPACK_TRAILER = Struct("!9Q6I").unpack_from
+
+    NO_PARENT_FOLDER = 0xFFFFFFFF
+    FOLDER_IS_COMPLETE = 1
+    FOLDER_HAS_FULL_VIRTUAL_PATH = 2
+    FOLDER_SIZE = 61
+    PACK_FOLDER = Struct("!IIIIIQIIIqQIB").pack
+    UNPACK_FOLDER = Struct("!IIIIIQIIIqQIB").unpack_from
+    UNPACK_FOLDER_NAME = Struct("!III").unpack_from
+    UNPACK_FOLDER_STREAM = Struct("!QIII").unpack_from
+    UNPACK_FOLDER_MTIME = Struct("!q").unpack_from
+    FOLDER_STREAM_OFFSET = 20
+    FOLDER_MTIME_OFFSET = 40
+
+    FILE_SIZE = 28
+    PACK_FILE = Struct("!IIIqQ").pack
+    UNPACK_FILE = Struct("!IIIqQ").unpack_from
+    ORDER_ITEM_SIZE = 4
+    UNPACK_ORDER_ITEM = Struct("!I").unpack_from
+
+    # Stream entries are packed the way they are sent to other users
+    ENTRY_NAME_OFFSET = 5
+    PACK_UINT32_LE = Struct("<I").pack
+    UNPACK_UINT32_LE = Struct("<I").unpack_from
+    UNPACK_UINT64_LE = Struct("<Q").unpack_from
+    UNPACK_ATTRIBUTE = Struct("<II").unpack_from
+
+    def __init__(self, file_path):
+
+        with open(file_path, "rb") as file_handle:
             file_size = os.fstat(file_handle.fileno()).st_size
 
-            if not file_size:
-                file_handle.write(self.FILE_SIGNATURE)
-                file_handle.write(bytes([self.VERSION]))
-                return value_offsets
+            if file_size < self.HEADER_SIZE + self.TRAILER_SIZE:
+                raise DatabaseError("Not a share store file")
+
+            self._content = mmap.mmap(file_handle.fileno(), length=0, access=mmap.ACCESS_READ)
+
+        try:
+            self._load_sections(file_size)
+
+        except Exception:
+            self._content.close()
+            raise
+
+    def _load_sections(self, file_size):
+
+        content = self._content
+        file_signature_length = len(self.FILE_SIGNATURE)
+
+        if content[:file_signature_length] != self.FILE_SIGNATURE:
+            raise DatabaseError("Not a share store file")
+
+        if content[file_signature_length] != self.VERSION:
+            raise DatabaseVersionError("Incompatible version")
+
+        if content[file_size - file_signature_length:] != self.FILE_SIGNATURE:
+            raise DatabaseError("Incomplete share store file")
+
+        trailer_offset = (file_size - self.TRAILER_SIZE)
+        trailer = self.UNPACK_TRAILER(content, trailer_offset)
+        section_offsets = trailer[:self.NUM_SECTION_OFFSETS]
+        self._num_folders = trailer[self.NUM_SECTION_OFFSETS:self.NUM_SECTION_OFFSETS + 3]
+        self._num_files = trailer[self.NUM_SECTION_OFFSETS + 3:]
+
+        boundaries = (self.HEADER_SIZE, *section_offsets, trailer_offset)
+
+        if any(start_offset > end_offset for start_offset, end_offset in zip(boundaries, boundaries[1:])):
+            raise DatabaseError("Corrupted share store file")
+
+        (self._names_offset, self._folders_offset, self._folder_order_offset, self._files_offset,
+         self._file_scores_offset, self._inode_order_offset, word_suffixes_offset, word_indices_offset,
+         word_filter_offset) = section_offsets
+
+        num_folders = sum(self._num_folders)
+        num_files = sum(self._num_files)
+        self._num_inodes = (word_suffixes_offset - self._inode_order_offset) // self.ORDER_ITEM_SIZE
+
+        if (self._folder_order_offset - self._folders_offset != num_folders * self.FOLDER_SIZE
+                or self._files_offset - self._folder_order_offset != num_folders * self.ORDER_ITEM_SIZE
+                or self._file_scores_offset - self._files_offset != num_files * self.FILE_SIZE
+                or self._inode_order_offset - self._file_scores_offset != num_files):
+            raise DatabaseError("Corrupted share store file")
+
+        self.word_suffixes = WordSuffixIndex(content, word_suffixes_offset)
+        self.word_index = WordIndex(content, word_indices_offset, self.word_suffixes)
+        self.word_filter = WordFilter(content, word_filter_offset)
+
+    @classmethod
+    def calculate_file_score(cls, entry, virtual_folder_path):
+        """Returns a score between 0 and 255 for a packed file entry, used to
+        rank search results. Lossless and high bitrate files rank higher,
+        followed by files in shallow folders."""
+
+        name_length, = cls.UNPACK_UINT32_LE(entry, 1)
+        offset = (cls.ENTRY_NAME_OFFSET + name_length + 8)
+        extension_length, = cls.UNPACK_UINT32_LE(entry, offset)
+        offset += 4 + extension_length
+        num_attributes, = cls.UNPACK_UINT32_LE(entry, offset)
+        offset += 4
+        quality_score = 0
+
+        for _ in range(num_attributes):
+            code, value = cls.UNPACK_ATTRIBUTE(entry, offset)
+            offset += 8
+
+            if code == 5:
+                # Only lossless files have a bit depth
+                quality_score = 15
+                break
+
+            if code == 0:
+                quality_score = min(value // 32, 14)
+
+        depth_score = max(14 - virtual_folder_path.count("\\"), 0)
+        return (quality_score << 4) | depth_score
+
+    @classmethod
+    def get_entry_name(cls, entry):
+        """Returns the escaped basename in a packed file entry."""
+
+        name_length, = cls.UNPACK_UINT32_LE(entry, 1)
+        return entry[cls.ENTRY_NAME_OFFSET:cls.ENTRY_NAME_OFFSET + name_length].decode("utf-8", "replace")
+
+    @classmethod
+    def get_entry_size(cls, entry):
+        """Returns the file size in a packed file entry."""
+
+        name_length, = cls.UNPACK_UINT32_LE(entry, 1)
+        size, = cls.UNPACK_UINT64_LE(entry, cls.ENTRY_NAME_OFFSET + name_length)
+        return size
+
+    @classmethod
+    def rename_entry(cls, entry, name):
+        """Returns a packed file entry with a different basename."""
+
+        name_length, = cls.UNPACK_UINT32_LE(entry, 1)
+        encoded_name = name.encode("utf-8")
+
+        return (entry[:1] + cls.PACK_UINT32_LE(len(encoded_name)) + encoded_name
+                + entry[cls.ENTRY_NAME_OFFSET + name_length:])
+
+    @classmethod
+    def get_virtual_path(cls, record):
+        """Returns the virtual path stored in a packed search result record."""
+
+        path_length, = cls.UNPACK_UINT32_LE(record, 1)
+        return record[cls.ENTRY_NAME_OFFSET:cls.ENTRY_NAME_OFFSET + path_length].decode("utf-8", "replace")
+
+    def _get_name(self, name_offset, name_length):
+
+        start_offset = (self._names_offset + name_offset)
+        return self._content[start_offset:start_offset + name_length].decode("utf-8")
+
+    def _get_level_range(self, counts, permission_level):
+
+        level_number = self.PERMISSION_LEVELS.index(permission_level)
+        start = sum(counts[:level_number])
+
+        return start, (start + counts[level_number])
+
+    @staticmethod
+    def _get_permission_level(counts, number):
+
+        end = 0
+
+        for permission_level, count in zip(ShareStore.PERMISSION_LEVELS, counts):
+            end += count
+
+            if number < end:
+                return permission_level
+
+        raise IndexError("Number out of range")
+
+    def get_num_folders(self, permission_level=None):
+
+        if permission_level is None:
+            return sum(self._num_folders)
+
+        start, end = self._get_level_range(self._num_folders, permission_level)
+        return end - start
+
+    def get_num_files(self, permission_level=None):
+
+        if permission_level is None:
+            return sum(self._num_files)
+
+        start, end = self._get_level_range(self._num_files, permission_level)
+        return end - start
+
+    def get_folder_permission_level(self, folder_id):
+        return self._get_permission_level(self._num_folders, folder_id)
+
+    def get_file_permission_level(self, file_index):
+        return self._get_permission_level(self._num_files, file_index)
+
+    def get_folder(self, folder_id):
+        """Returns the modification time (ns), device, settings hash and
+        completeness of a folder, as recorded when it was scanned."""
+
+        if folder_id < 0 or folder_id >= sum(self._num_folders):
+            raise IndexError("Folder number out of range")
+
+        (_parent_folder_id, _real_name_offset, _real_name_length, _virtual_name_offset, _virtual_name_length,
+         _stream_offset, _stream_length, _first_file_index, _num_files, mtime_ns, device, settings_hash,
+         flags) = self.UNPACK_FOLDER(self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE))
+
+        return mtime_ns, device, settings_hash, bool(flags & self.FOLDER_IS_COMPLETE)
+
+    def get_folder_mtime(self, folder_id):
+        """Returns the modification time (ns) of a folder, as recorded when it
+        was scanned."""
+
+        mtime_ns, = self.UNPACK_FOLDER_MTIME(
+            self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE) + self.FOLDER_MTIME_OFFSET)
+        return mtime_ns
+
+    def get_folder_path(self, folder_id):
+        """Returns the real path of a folder."""
+
+        names = []
+
+        while True:
+            parent_folder_id, name_offset, name_length = self.UNPACK_FOLDER_NAME(
+                self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE))
+            names.append(self._get_name(name_offset, name_length))
+
+            if parent_folder_id == self.NO_PARENT_FOLDER:
+                break
+
+            folder_id = parent_folder_id
+
+        return os.path.join(*reversed(names))
+
+    def get_virtual_folder_path(self, folder_id):
+        """Returns the virtual path of a folder."""
+
+        names = []
+
+        while True:
+            (parent_folder_id, _real_name_offset, _real_name_length, name_offset, name_length, *_unused,
+             flags) = self.UNPACK_FOLDER(self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE))
+            names.append(self._get_name(name_offset, name_length))
+
+            if parent_folder_id == self.NO_PARENT_FOLDER or flags & self.FOLDER_HAS_FULL_VIRTUAL_PATH:
+                break
+
+            folder_id = parent_folder_id
+
+        return "\\".join(reversed(names))
+
+    def _get_folder_stream(self, folder_id):
+        """Returns the stream offset and length, and file index range of a
+        folder."""
+
+        stream_offset, stream_length, first_file_index, num_files = self.UNPACK_FOLDER_STREAM(
+            self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE) + self.FOLDER_STREAM_OFFSET)
+
+        return stream_offset, stream_length, first_file_index, (first_file_index + num_files)
+
+    def get_folder_stream(self, folder_id):
+        """Returns the packed file list of a folder."""
+
+        stream_offset, stream_length, *_unused = self._get_folder_stream(folder_id)
+        return self._content[stream_offset:stream_offset + stream_length]
+
+    def get_folder_files(self, folder_id):
+        """Returns the packed entry, modification time (ns) and inode of each
+        file in a folder."""
+
+        stream_offset, _stream_length, first_file_index, end_file_index = self._get_folder_stream(folder_id)
+        content = self._content
+        folder_files = []
+
+        for file_index in range(first_file_index, end_file_index):
+            _folder_id, entry_offset, entry_length, mtime_ns, inode = self.UNPACK_FILE(
+                content, self._files_offset + (file_index * self.FILE_SIZE))
+            entry_offset += stream_offset
+
+            folder_files.append((content[entry_offset:entry_offset + entry_length], mtime_ns, inode))
+
+        return folder_files
+
+    def iter_folders(self):
+        """Yields the number, parent folder number and real path of each
+        folder. Parent folders are always yielded before their subfolders.
+        The parent folder number of shared folders is None."""
+
+        folder_paths = []
+
+        for folder_id in range(sum(self._num_folders)):
+            parent_folder_id, name_offset, name_length = self.UNPACK_FOLDER_NAME(
+                self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE))
+            folder_path = self._get_name(name_offset, name_length)
+
+            if parent_folder_id == self.NO_PARENT_FOLDER:
+                parent_folder_id = None
+            else:
+                folder_path = os.path.join(folder_paths[parent_folder_id], folder_path)
+
+            folder_paths.append(folder_path)
+            yield folder_id, parent_folder_id, folder_path
+
+    def iter_folder_streams(self, permission_level):
+        """Yields the virtual path and packed file list of each folder in a
+        permission level."""
+
+        start_folder_id, end_folder_id = self._get_level_range(self._num_folders, permission_level)
+        virtual_folder_paths = []
+
+        for folder_id in range(start_folder_id, end_folder_id):
+            (parent_folder_id, _real_name_offset, _real_name_length, name_offset, name_length, stream_offset,
+             stream_length, *_unused, flags) = self.UNPACK_FOLDER(
+                self._content, self._folders_offset + (folder_id * self.FOLDER_SIZE))
+            virtual_folder_path = self._get_name(name_offset, name_length)
+
+            # Subfolders are always in the same permission level as their parent folder
+            if parent_folder_id != self.NO_PARENT_FOLDER and not flags & self.FOLDER_HAS_FULL_VIRTUAL_PATH:
+                parent_virtual_folder_path = virtual_folder_paths[parent_folder_id - start_folder_id]
+                virtual_folder_path = f"{parent_virtual_folder_path}\\{virtual_folder_path}"
+
+            virtual_folder_paths.append(virtual_folder_path)
+            yield virtual_folder_path, self._content[stream_offset:stream_offset + stream_length]
+
+    def get_folder_streams(self, permission_level):
+        return SharedFolderStreams(self, permission_level)
+
+    def _iter_matching_folder_ids(self, virtual_folder_path):
+        """Yields the number of each folder with a matching virtual path,
+        ignoring case."""
+
+        virtual_folder_path = virtual_folder_path.lower()
+        content = self._content
+        folder_order_offset = self._folder_order_offset
+        num_folders = sum(self._num_folders)
+        low = 0
+        high = num_folders
+
+        while low < high:
+            middle = (low + high) // 2
+            folder_id, = self.UNPACK_ORDER_ITEM(content, folder_order_offset + (middle * self.ORDER_ITEM_SIZE))
+
+            if self.get_virtual_folder_path(folder_id).lower() < virtual_folder_path:
+                low = middle + 1
+            else:
+                high = middle
+
+        for position in range(low, num_folders):
+            folder_id, = self.UNPACK_ORDER_ITEM(content, folder_order_offset + (position * self.ORDER_ITEM_SIZE))
+
+            if self.get_virtual_folder_path(folder_id).lower() != virtual_folder_path:
+                break
+
+            yield folder_id
+
+    def find_folder(self, virtual_folder_path):
+        """Returns the number of the folder with a virtual path, or None if
+        the folder is not shared."""
+
+        for folder_id in self._iter_matching_folder_ids(virtual_folder_path):
+            if self.get_virtual_folder_path(folder_id) == virtual_folder_path:
+                return folder_id
+
+        return None
+
+    def iter_matching_files(self, virtual_path):
+        """Yields the index of each file with a matching virtual path,
+        ignoring case."""
+
+        virtual_folder_path, _separator, basename = virtual_path.rpartition("\\")
+        basename = basename.lower()
+
+        for folder_id in self._iter_matching_folder_ids(virtual_folder_path):
+            _stream_offset, _stream_length, first_file_index, end_file_index = self._get_folder_stream(folder_id)
+
+            for file_index in range(first_file_index, end_file_index):
+                if self.get_entry_name(self.get_file_entry(file_index)).lower() == basename:
+                    yield file_index
+
+    def _get_file(self, file_index):
+
+        if file_index < 0 or file_index >= sum(self._num_files):
+            raise IndexError("File index out of range")
+
+        folder_id, entry_offset, entry_length, mtime_ns, inode = self.UNPACK_FILE(
+            self._content, self._files_offset + (file_index * self.FILE_SIZE))
+        stream_offset, *_unused = self._get_folder_stream(folder_id)
+        entry_offset += stream_offset
+
+        return folder_id, self._content[entry_offset:entry_offset + entry_length], mtime_ns, inode
+
+    def get_file_entry(self, file_index):
+        """Returns the packed entry of a file in its folder stream."""
+
+        _folder_id, entry, _mtime_ns, _inode = self._get_file(file_index)
+        return entry
+
+    def get_file_size(self, file_index):
+        return self.get_entry_size(self.get_file_entry(file_index))
+
+    def get_file_score(self, file_index):
+        return self._content[self._file_scores_offset + file_index]
+
+    def get_real_path(self, file_index):
+        """Returns the real path of a file."""
+
+        folder_id, entry, _mtime_ns, _inode = self._get_file(file_index)
+        basename = self.get_entry_name(entry).replace(Shares.BACKSLASH_SENTINEL, "\\")
+
+        return os.path.join(self.get_folder_path(folder_id), basename)
+
+    def get_file_record(self, file_index, virtual_folder_paths=None):
+        """Returns the packed search result record of a file. Encoded virtual
+        folder paths are cached in the provided dictionary, if any."""
+
+        folder_id, entry, _mtime_ns, _inode = self._get_file(file_index)
+        encoded_virtual_folder_path = None
+
+        if virtual_folder_paths is not None:
+            encoded_virtual_folder_path = virtual_folder_paths.get(folder_id)
+
+        if encoded_virtual_folder_path is None:
+            encoded_virtual_folder_path = (self.get_virtual_folder_path(folder_id) + "\\").encode("utf-8")
+
+            if virtual_folder_paths is not None:
+                virtual_folder_paths[folder_id] = encoded_virtual_folder_path
+
+        name_length, = self.UNPACK_UINT32_LE(entry, 1)
+        name_end_offset = (self.ENTRY_NAME_OFFSET + name_length)
+        virtual_path = encoded_virtual_folder_path + entry[self.ENTRY_NAME_OFFSET:name_end_offset]
+
+        return entry[:1] + self.PACK_UINT32_LE(len(virtual_path)) + virtual_path + entry[name_end_offset:]
+
+    def find_moved_file(self, device, inode, size, mtime_ns):
+        """Returns the packed entry of a previously scanned file with the same
+        identity, or None if there is no such file. The identity of a file is
+        unchanged if it's renamed or moved, as long as its contents are
+        unchanged."""
+
+        content = self._content
+        inode_order_offset = self._inode_order_offset
+        low = 0
+        high = self._num_inodes
+
+        while low < high:
+            middle = (low + high) // 2
+            file_index, = self.UNPACK_ORDER_ITEM(content, inode_order_offset + (middle * self.ORDER_ITEM_SIZE))
+
+            if self._get_file(file_index)[3] < inode:
+                low = middle + 1
+            else:
+                high = middle
+
+        for position in range(low, self._num_inodes):
+            file_index, = self.UNPACK_ORDER_ITEM(content, inode_order_offset + (position * self.ORDER_ITEM_SIZE))
+            folder_id, entry, file_mtime_ns, file_inode = self._get_file(file_index)
+
+            if file_inode != inode:
+                break
+
+            if (file_mtime_ns == mtime_ns and self.get_entry_size(entry) == size
+                    and self.get_folder(folder_id)[1] == device):
+                return entry
+
+        return None
+
+    def close(self):
+        self._content.close()
+
+
+class ShareStoreWriter:
+    """Writes a new share store while scanning shares. Folder streams are
+    written as folders are added, and the remaining sections once the scan is
+    complete. The new store atomically replaces the previous one when closed,
+    ensuring the previous shares remain intact if a scan is interrupted."""
+
+    __slots__ = ("_file_path", "_temp_file_path", "_file_handle", "_stream_offset", "_names", "_folders",
+                 "_files", "_file_inodes", "_file_scores", "_virtual_folder_paths", "_level_number",
+                 "_num_folders", "_num_files")
+
+    def __init__(self, file_path):
+
+        self._file_path = file_path
+        self._temp_file_path = file_path + b".new"
+        self._file_handle = open(self._temp_file_path, "wb")  # pylint: disable=consider-using-with
+        self._file_handle.write(ShareStore.FILE_SIGNATURE)
+        self._file_handle.write(bytes([ShareStore.VERSION]))
+
+        self._stream_offset = ShareStore.HEADER_SIZE
+        self._names = bytearray()
+        self._folders = bytearray()
+        self._files = bytearray()
+        self._file_inodes = array("Q")
+        self._file_scores = bytearray()
+        self._virtual_folder_paths = []
+        self._level_number = 0
+        self._num_folders = [0, 0, 0]
+        self._num_files = [0, 0, 0]
+
+    @property
+    def num_files(self):
+        return len(self._file_scores)
+
+    def _add_name(self, name):
+
+        encoded_name = name.encode("utf-8")
+        name_offset = len(self._names)
+        self._names += encoded_name
+
+        return name_offset, len(encoded_name)
+
+    def add_folder(self, permission_level, folder_path, virtual_folder_path, parent_folder_id=None, mtime_ns=None,
+                   device=None, settings_hash=0, is_complete=True, files=()):
+        """Add a folder and its files to the store, and return the folder
+        number. Files are provided as tuples of packed entry, modification
+        time (ns) and inode. Folders must be added in permission level order,
+        and subfolders after their parent folder."""
+
+        level_number = ShareStore.PERMISSION_LEVELS.index(permission_level)
+
+        if level_number < self._level_number:
+            raise DatabaseError("Folders are not in permission level order")
+
+        folder_id = len(self._virtual_folder_paths)
+        first_file_index = len(self._file_scores)
+        flags = ShareStore.FOLDER_IS_COMPLETE if is_complete else 0
+
+        if parent_folder_id is None:
+            parent_folder_id = ShareStore.NO_PARENT_FOLDER
+            real_name_offset, real_name_length = self._add_name(folder_path)
+            virtual_name_offset, virtual_name_length = self._add_name(virtual_folder_path)
+        else:
+            # Subfolders share their name with their virtual name, unless they
+            # are mapped to a different virtual folder
+            folder_name = os.path.basename(folder_path)
+            real_name_offset, real_name_length = virtual_name_offset, virtual_name_length = self._add_name(folder_name)
+
+            if virtual_folder_path != f"{self._virtual_folder_paths[parent_folder_id]}\\{folder_name}":
+                flags |= ShareStore.FOLDER_HAS_FULL_VIRTUAL_PATH
+                virtual_name_offset, virtual_name_length = self._add_name(virtual_folder_path)
+
+        stream = bytearray(FileListMessage.pack_uint32(len(files)))
+
+        for entry, file_mtime_ns, inode in files:
+            self._files += ShareStore.PACK_FILE(folder_id, len(stream), len(entry), file_mtime_ns, inode or 0)
+            self._file_inodes.append(inode or 0)
+            self._file_scores.append(ShareStore.calculate_file_score(entry, virtual_folder_path))
+            stream += entry
+
+        self._file_handle.write(stream)
+        self._folders += ShareStore.PACK_FOLDER(
+            parent_folder_id, real_name_offset, real_name_length, virtual_name_offset, virtual_name_length,
+            self._stream_offset, len(stream), first_file_index, len(files), mtime_ns or 0, device or 0,
+            settings_hash, flags
+        )
+        self._stream_offset += len(stream)
+        self._virtual_folder_paths.append(virtual_folder_path)
+        self._level_number = level_number
+        self._num_folders[level_number] += 1
+        self._num_files[level_number] += len(files)
+
+        return folder_id
+
+    @staticmethod
+    def _write_order(file_handle, numbers):
 
-            file_handle.seek(0)
+        numbers = array("I", numbers)
 
-            with mmap.mmap(file_handle.fileno(), length=0, access=mmap.ACCESS_READ) as content:
-                value_offsets = self._parse_content(memoryview(content), file_size)
+        if sys.byteorder == "little":
+            # Network byte order
+            numbers.byteswap()
 
-        return value_offsets
+        file_handle.write(numbers.tobytes())
 
-    def __contains__(self, key):
-        return key in self._value_offsets
+    def close(self, word_index):
+        """Write the remaining sections, and replace the previous store.
+        The word index maps words to sorted arrays of file indices."""
 
-    def __iter__(self):
-        yield from self._value_offsets
+        file_handle = self._file_handle
+        section_offsets = []
 
-    def __len__(self):
-        return len(self._value_offsets)
+        section_offsets.append(file_handle.tell())
+        file_handle.write(self._names)
 
-    def __getitem__(self, key):
+        section_offsets.append(file_handle.tell())
+        file_handle.write(self._folders)
 
-        value_offset = self._value_offsets[key]
+        section_offsets.append(file_handle.tell())
+        lowercase_virtual_folder_paths = [virtual_folder_path.lower()
+                                          for virtual_folder_path in self._virtual_folder_paths]
+        self._write_order(
+            file_handle, sorted(range(len(lowercase_virtual_folder_paths)),
+                                key=lowercase_virtual_folder_paths.__getitem__))
+        lowercase_virtual_folder_paths.clear()
 
-        self._file_handle.seek(value_offset, SEEK_SET)
-        return RestrictedUnpickler(self._file_handle).load()
+        section_offsets.append(file_handle.tell())
+        file_handle.write(self._files)
 
-    def __setitem__(self, key, value):
+        section_offsets.append(file_handle.tell())
+        file_handle.write(self._file_scores)
 
-        encoded_key = key.encode("utf-8")
-        pickled_value = dumps(value, protocol=self.PICKLE_PROTOCOL)
+        section_offsets.append(file_handle.tell())
+        file_inodes = self._file_inodes
+        self._write_order(
+            file_handle, sorted((file_index for file_index, inode in enumerate(file_inodes) if inode),
+                                key=file_inodes.__getitem__))
 
-        key_length = len(encoded_key)
-        length_data = self.PACK_LENGTHS(key_length, len(pickled_value))
-        item_data = (length_data + encoded_key + pickled_value)
+        words = sorted((word[::-1].encode("utf-8"), word) for word in word_index)
 
-        self._file_handle.write(item_data)
+        section_offsets.append(file_handle.tell())
+        WordSuffixIndex.write(file_handle, [reversed_word for reversed_word, _word in words])
 
-        self._value_offsets[key] = self._file_offset + self.LENGTH_DATA_SIZE + key_length
-        self._file_offset += len(item_data)
+        section_offsets.append(file_handle.tell())
+        WordIndex.write(file_handle, [word_index[word] for _reversed_word, word in words])
 
-    def get(self, key, default=None):
+        section_offsets.append(file_handle.tell())
+        WordFilter.write(file_handle, [word for _reversed_word, word in words])
 
-        if key in self._value_offsets:
-            return self[key]
+        file_handle.write(ShareStore.PACK_TRAILER(*section_offsets, *self._num_folders, *self._num_files))
+        file_handle.write(ShareStore.FILE_SIGNATURE)
 
-        return default
+        file_handle.flush()
+        os.fsync(file_handle)
+        file_handle.close()
 
-    def update(self, obj):
-        for key, value in obj.items():
-            self[key] = value
+        os.replace(self._temp_file_path, self._file_path)
 
-    def close(self):
+    def abort(self):
+        """Discard the new store, keeping the previous one."""
 
-        if self._overwrite:
-            os.fsync(self._file_handle)
+        if self._file_handle.closed:
+            return
 
         self._file_handle.close()
 
+        try:
+            os.remove(self._temp_file_path)
+
+        except OSError:
+            pass
+
 
 class ScannerState:
     INITIALIZED = "initialized"
@@ -240,40 +1149,51 @@ class Scanner:
     """Separate process responsible for building shares.
 
     It handles scanning of folders and files, as well as building
-    databases and writing them to disk.
+    the share store and writing it to disk.
     """
 
-    __slots__ = ("writer", "share_groups", "share_dbs", "share_db_paths", "init",
-                 "rescan", "rebuild", "reveal_buddy_shares", "reveal_trusted_shares",
-                 "files", "streams", "mtimes", "word_index", "processed_share_names",
-                 "processed_share_paths", "current_file_index", "current_folder_count",
-                 "lowercase_paths", "share_filters", "file_filter_regex", "folder_filter_regex")
+    __slots__ = ("writer", "share_groups", "share_store_path", "legacy_db_paths", "init", "rescan", "rebuild",
+                 "reveal_buddy_shares", "reveal_trusted_shares", "share_store", "store_writer", "legacy_dbs",
+                 "word_index", "processed_share_names", "processed_share_paths", "current_folder_count",
+                 "share_filters", "file_filter_regex", "folder_filter_regex", "metadata_threads", "metadata_pool",
+                 "pending_folders", "num_pending_files", "settings_hash", "changed_folder_paths",
+                 "virtual_folder_paths", "folder_ids", "old_folder_ids", "old_subfolder_paths")
 
-    def __init__(self, writer, share_groups, share_db_paths, init=False, rescan=True,
+    MAX_PENDING_FILES_PER_THREAD = 64
+
+    def __init__(self, writer, share_groups, share_store_path, legacy_db_paths, init=False, rescan=True,
                  rebuild=False, reveal_buddy_shares=False, reveal_trusted_shares=False,
-                 share_filters=None):
+                 share_filters=None, metadata_threads=1, changed_folder_paths=None):
 
         self.writer = writer
         self.share_groups = share_groups
-        self.share_dbs = {}
-        self.share_db_paths = share_db_paths
+        self.share_store_path = share_store_path
+        self.legacy_db_paths = legacy_db_paths
         self.init = init
         self.rescan = rescan
         self.rebuild = rebuild
         self.reveal_buddy_shares = reveal_buddy_shares
         self.reveal_trusted_shares = reveal_trusted_shares
         self.share_filters = share_filters
-        self.files = {}
-        self.streams = {}
-        self.mtimes = {}
-        self.lowercase_paths = defaultdict(dict)
-        self.word_index = defaultdict(list)
+        self.share_store = None
+        self.store_writer = None
+        self.legacy_dbs = []
+        self.word_index = defaultdict(partial(array, "I"))
         self.processed_share_names = set()
         self.processed_share_paths = set()
-        self.current_file_index = 0
         self.current_folder_count = 0
         self.file_filter_regex = None
         self.folder_filter_regex = None
+        self.metadata_threads = metadata_threads
+        self.metadata_pool = None
+        self.pending_folders = deque()
+        self.num_pending_files = 0
+        self.settings_hash = 0
+        self.changed_folder_paths = changed_folder_paths
+        self.virtual_folder_paths = set()
+        self.folder_ids = {}
+        self.old_folder_ids = {}
+        self.old_subfolder_paths = defaultdict(list)
 
     def run(self):
 
@@ -282,22 +1202,17 @@ class Scanner:
 
             if self.init:
                 try:
+                    self.share_store = ShareStore(encode_path(self.share_store_path))
                     self.create_compressed_shares()
-                    self.create_file_path_index()
-
-                    # Attempt to load remaining dbs
-                    Shares.load_shares(
-                        self.share_dbs, self.share_db_paths, destinations={"words", "lowercase_paths"}
-                    )
-                    Shares.close_shares(self.share_dbs)
-
-                except DatabaseVersionError:
-                    # Database version mismatch, rebuild
-                    self.rescan = self.rebuild = True
 
-                except Exception:
-                    # Failed to load shares, rescan
+                except Exception as error:
+                    # Failed to load shares, rescan. Rebuild on a version mismatch.
                     self.rescan = True
+                    self.rebuild = isinstance(error, DatabaseVersionError)
+
+                    if not os.path.exists(encode_path(self.share_store_path)):
+                        # Previous versions store shares in separate databases, reuse their file metadata
+                        self.open_legacy_shares()
 
                 self.writer.send(ScannerState.INITIALIZED)
 
@@ -306,13 +1221,13 @@ class Scanner:
                     ScannerLogMessage(_("Rebuilding shares…") if self.rebuild else _("Rescanning shares…"))
                 )
                 self.load_filters()
+                self.load_old_shares()
+
+                if self.metadata_threads > 1:
+                    self.metadata_pool = ThreadPoolExecutor(
+                        max_workers=self.metadata_threads, thread_name_prefix="ShareScannerMetadata")
 
-                # Delete previous word index and lowercase path databases. This ensures that we don't
-                # end up with inconsistent data in case the scanner process is terminated. A rescan
-                # will also be attempted on startup due to the missing databases.
-                for destination in ("words", "lowercase_paths"):
-                    share_db_path = self.share_db_paths[destination]
-                    Shares.remove_db_file(share_db_path)
+                self.store_writer = ShareStoreWriter(encode_path(self.share_store_path))
 
                 # Scan shares
                 for permission_level in (
@@ -322,12 +1237,14 @@ class Scanner:
                 ):
                     self.rescan_dirs(permission_level)
 
-                self.set_shares(word_index=self.word_index, lowercase_paths=self.lowercase_paths)
+                # Replace the previous shares at once
+                self.close_old_shares()
+                self.store_writer.close(self.word_index)
                 self.word_index.clear()
-                self.lowercase_paths.clear()
+                self.remove_legacy_shares()
 
+                self.share_store = ShareStore(encode_path(self.share_store_path))
                 self.create_compressed_shares()
-                self.create_file_path_index()
 
                 self.writer.send(
                     ScannerLogMessage(
@@ -350,14 +1267,21 @@ class Scanner:
                     _("Serious error occurred while rescanning shares. If this problem persists, "
                       "delete %(dir)s/*.dbn and try again. If that doesn't help, please file a bug "
                       "report with this stack trace included: %(trace)s"), {
-                        "dir": os.path.dirname(next(iter(self.share_db_paths.values()))),
+                        "dir": os.path.dirname(self.share_store_path),
                         "trace": "\n" + format_exc()
                     }
                 )
             )
 
         finally:
-            Shares.close_shares(self.share_dbs)
+            if self.metadata_pool is not None:
+                self.metadata_pool.shutdown(cancel_futures=True)
+                self.metadata_pool = None
+
+            if self.store_writer is not None:
+                self.store_writer.abort()
+
+            self.close_old_shares()
             self.writer.close()
 
     def load_filters(self):
@@ -365,6 +1289,9 @@ class Scanner:
         if not self.share_filters:
             return
 
+        # Folders scanned with different filters are not reused during rescans
+        self.settings_hash = crc32("\n".join(sorted(self.share_filters)).encode("utf-8"))
+
         file_filters = []
         folder_filters = []
 
@@ -383,13 +1310,82 @@ class Scanner:
         if folder_filters:
             self.folder_filter_regex = re.compile("(\\\\(" + "|".join(folder_filters) + ")$)", flags=re.IGNORECASE)
 
+    def open_legacy_shares(self):
+        """Open pickle-based databases of previous versions, allowing us to
+        reuse the metadata of unchanged files during the first scan."""
+
+        for permission_level in (PermissionLevel.PUBLIC, PermissionLevel.BUDDY, PermissionLevel.TRUSTED):
+            legacy_files = legacy_mtimes = None
+
+            try:
+                legacy_files = LegacyDatabase(encode_path(self.legacy_db_paths[f"{permission_level}_files"]))
+                legacy_mtimes = LegacyDatabase(encode_path(self.legacy_db_paths[f"{permission_level}_mtimes"]))
+
+            except Exception:
+                # Not a legacy database, metadata is read again during the scan
+                if legacy_files is not None:
+                    legacy_files.close()
+
+                continue
+
+            self.legacy_dbs.append((legacy_files, legacy_mtimes))
+
+    def remove_legacy_shares(self):
+        """Remove databases of previous versions once the share store is
+        written. Their file metadata was reused during the scan."""
+
+        for legacy_db_path in self.legacy_db_paths.values():
+            try:
+                Shares.remove_db_file(legacy_db_path)
+
+            except OSError:
+                # Removed during the next scan
+                pass
+
+    def load_old_shares(self):
+        """Open the shares of the previous scan, allowing us to reuse unchanged
+        folders and file metadata."""
+
+        if self.rebuild:
+            self.close_old_shares()
+            return
+
+        if self.share_store is None:
+            try:
+                self.share_store = ShareStore(encode_path(self.share_store_path))
+
+            except Exception:
+                # No previous shares
+                return
+
+        for folder_id, parent_folder_id, folder_path in self.share_store.iter_folders():
+            self.old_folder_ids[folder_path] = folder_id
+
+            if parent_folder_id is not None:
+                self.old_subfolder_paths[parent_folder_id].append(folder_path)
+
+    def close_old_shares(self):
+
+        for legacy_files, legacy_mtimes in self.legacy_dbs:
+            legacy_files.close()
+            legacy_mtimes.close()
+
+        self.legacy_dbs.clear()
+
+        if self.share_store is not None:
+            self.share_store.close()
+            self.share_store = None
+
+        self.old_folder_ids.clear()
+        self.old_subfolder_paths.clear()
+
     def create_compressed_shares_message(self, permission_level):
         """Create a message that will later contain a compressed list of our
         shares."""
 
-        public_streams = self.share_dbs["public_streams"]
-        buddy_streams = self.share_dbs["buddy_streams"]
-        trusted_streams = self.share_dbs["trusted_streams"]
+        public_streams = self.share_store.get_folder_streams(PermissionLevel.PUBLIC)
+        buddy_streams = self.share_store.get_folder_streams(PermissionLevel.BUDDY)
+        trusted_streams = self.share_store.get_folder_streams(PermissionLevel.TRUSTED)
 
         if permission_level == PermissionLevel.PUBLIC and not self.reveal_buddy_shares:
             buddy_streams = None
@@ -407,31 +1403,9 @@ class Scanner:
         self.writer.send(compressed_shares)
 
     def create_compressed_shares(self):
-
-        Shares.load_shares(
-            self.share_dbs, self.share_db_paths, destinations={"public_streams", "buddy_streams", "trusted_streams"}
-        )
-
         for permission_level in (PermissionLevel.PUBLIC, PermissionLevel.BUDDY, PermissionLevel.TRUSTED):
             self.create_compressed_shares_message(permission_level)
 
-        Shares.close_shares(self.share_dbs)
-
-    def create_file_path_index(self):
-
-        Shares.load_shares(
-            self.share_dbs, self.share_db_paths, destinations={"public_files", "buddy_files", "trusted_files"}
-        )
-
-        file_path_index = tuple(chain(
-            self.share_dbs["public_files"],
-            self.share_dbs["buddy_files"],
-            self.share_dbs["trusted_files"]
-        ))
-        self.writer.send(file_path_index)
-
-        Shares.close_shares(self.share_dbs)
-
     def real2virtual(self, real_path):
 
         real_path = real_path.replace("/", "\\")
@@ -453,33 +1427,6 @@ class Scanner:
 
         raise ValueError(f"Cannot find virtual path for {real_path}")
 
-    def set_shares(self, permission_level=None, files=None, streams=None, mtimes=None, word_index=None,
-                   lowercase_paths=None):
-
-        for source, destination in (
-            (files, "files"),
-            (streams, "streams"),
-            (mtimes, "mtimes"),
-            (word_index, "words"),
-            (lowercase_paths, "lowercase_paths")
-        ):
-            if source is None:
-                continue
-
-            if destination not in {"words", "lowercase_paths"}:
-                destination = f"{permission_level}_{destination}"
-
-            share_db = None
-
-            try:
-                share_db_path = self.share_db_paths[destination]
-                share_db = Shares.create_db_file(share_db_path)
-                share_db.update(source)
-
-            finally:
-                if share_db is not None:
-                    share_db.close()
-
     def rescan_dirs(self, permission_level):
 
         shared_public_folders, shared_buddy_folders, shared_trusted_folders = self.share_groups
@@ -493,18 +1440,6 @@ class Scanner:
         else:
             shared_folder_paths = sorted(shared_public_folders)
 
-        try:
-            Shares.load_shares(
-                self.share_dbs, self.share_db_paths,
-                destinations={f"{permission_level}_files", f"{permission_level}_mtimes"})
-
-        except Exception:
-            # No previous share databases, create them later
-            pass
-
-        old_files = self.share_dbs.get(f"{permission_level}_files")
-        old_mtimes = self.share_dbs.get(f"{permission_level}_mtimes")
-
         for virtual_name, folder_path, *_unused in shared_folder_paths:
             if virtual_name in self.processed_share_names:
                 # No duplicate names
@@ -514,20 +1449,11 @@ class Scanner:
                 # No duplicate folder paths
                 continue
 
-            self.scan_shared_folder(folder_path, old_mtimes, old_files)
+            self.scan_shared_folder(permission_level, folder_path)
 
             self.processed_share_names.add(virtual_name)
             self.processed_share_paths.add(folder_path)
 
-        # Save data to databases
-        Shares.close_shares(self.share_dbs)
-        self.set_shares(permission_level, files=self.files, streams=self.streams, mtimes=self.mtimes)
-
-        for dictionary in (self.files, self.streams, self.mtimes):
-            dictionary.clear()
-
-        gc.collect()
-
     @classmethod
     def is_hidden(cls, folder, filename=None, entry=None):
         """Stop sharing any hidden folders/files."""
@@ -550,16 +1476,28 @@ class Scanner:
 
         return False
 
-    def scan_shared_folder(self, shared_folder_path, old_mtimes, old_files):
-        """Scan a shared folder for all subfolders, files and their metadata."""
+    def scan_shared_folder(self, permission_level, shared_folder_path):
+        """Scan a shared folder for all subfolders, files and their metadata.
 
-        folder_paths = [shared_folder_path]
+        Folders with an unchanged modification time are not listed again.
+        Their previous subfolders, files and metadata are reused instead.
+        If the paths of changed folders are known from watching shares,
+        other folders are reused without checking their modification time.
+        """
+
+        # Folders to scan, and their parent folder
+        folder_paths = [(shared_folder_path, None)]
+        max_pending_files = 0
+
+        if self.metadata_pool is not None:
+            # Keep metadata workers busy while we continue walking folders
+            max_pending_files = (self.metadata_threads * self.MAX_PENDING_FILES_PER_THREAD)
 
         while folder_paths:
-            folder_path = folder_paths.pop()
+            folder_path, parent_folder_path = folder_paths.pop()
             virtual_folder_path = self.real2virtual(folder_path)
 
-            if virtual_folder_path in self.streams:
+            if virtual_folder_path in self.virtual_folder_paths:
                 # Sharing a folder twice, no go
                 continue
 
@@ -568,93 +1506,237 @@ class Scanner:
                     and self.folder_filter_regex.search(f"\\{virtual_folder_path}\\") is not None):
                 continue
 
-            self.writer.send(self.current_folder_count)
+            self.virtual_folder_paths.add(virtual_folder_path)
 
-            file_list = []
-            virtual_folder_path_lower = virtual_folder_path.lower()
-            virtual_folder_words = virtual_folder_path_lower.translate(TRANSLATE_PUNCTUATION).split()
+            old_folder_id = self.old_folder_ids.get(folder_path)
+            folder_mtime = folder_device = None
+            is_changed_folder = False
 
-            try:
-                with os.scandir(encode_path(folder_path, prefix=False)) as entries:
-                    for entry in entries:
-                        basename = basename_escaped = entry.name.decode("utf-8", "replace")
+            if self.changed_folder_paths is not None and old_folder_id is not None:
+                is_changed_folder = (folder_path in self.changed_folder_paths)
+
+                if not is_changed_folder:
+                    folder_mtime, folder_device, *_unused = self.share_store.get_folder(old_folder_id)
 
-                        if "\\" in basename:
-                            # Substitute backslashes with backslash sentinels in basenames. This is necessary
-                            # due to the Soulseek network using backslashes as path separators, conflicting
-                            # with non-Windows systems where backslashes are valid (but uncommon) file name
-                            # characters. We restore the original backslash later when a user downloads the file.
-                            basename_escaped = basename.replace("\\", Shares.BACKSLASH_SENTINEL)
+            if folder_mtime is None:
+                try:
+                    folder_stat = os.stat(encode_path(folder_path))
+                    folder_mtime = folder_stat.st_mtime_ns
+                    folder_device = folder_stat.st_dev
 
-                        path = os.path.join(folder_path, basename)
+                except OSError:
+                    # Error is logged when scanning the folder
+                    pass
 
-                        if entry.is_dir():
-                            if self.is_hidden(path, entry=entry):
-                                continue
+            folder_files = None
+            is_complete = (folder_mtime is not None)
 
-                            folder_paths.append(path)
-                            continue
+            if old_folder_id is not None and folder_mtime is not None and not is_changed_folder:
+                folder_files = self.reuse_folder(folder_path, old_folder_id, folder_mtime, folder_paths)
 
-                        try:
-                            if path in self.files:
-                                # Two files with slightly different names, but utf-8 decoded paths become
-                                # identical. Only process one of the files to prevent corrupting the file index.
-                                continue
+            if folder_files is None:
+                folder_files, is_complete = self.scan_folder(
+                    folder_path, virtual_folder_path, folder_device, old_folder_id, folder_paths, is_complete)
 
-                            if self.is_hidden(folder_path, basename, entry):
-                                continue
+            self.pending_folders.append((
+                permission_level, folder_path, virtual_folder_path, parent_folder_path, folder_mtime, folder_device,
+                is_complete, folder_files
+            ))
+            self.num_pending_files += len(folder_files)
 
-                            virtual_file_path = f"{virtual_folder_path}\\{basename_escaped}"
+            while self.pending_folders and self.num_pending_files >= max_pending_files:
+                self.process_pending_folder()
 
-                            if (self.file_filter_regex
-                                    and self.file_filter_regex.search("\\" + virtual_file_path) is not None):
-                                continue
+        while self.pending_folders:
+            self.process_pending_folder()
 
-                            file_stat = entry.stat()
-                            self.mtimes[path] = file_mtime = file_stat.st_mtime
+    def reuse_folder(self, folder_path, old_folder_id, folder_mtime, folder_paths):
+        """Returns the files of a folder from the previous scan, if the
+        folder's modification time is unchanged. Adding, removing or renaming
+        entries in a folder updates its modification time, so files are not
+        checked individually. Files edited in place are picked up when the
+        share watcher reports their folder, or when rebuilding shares."""
 
-                            if (not self.rebuild and old_mtimes and old_files
-                                    and file_mtime == old_mtimes.get(path) and path in old_files):
-                                full_path_file_data = old_files[path]
-                                full_path_file_data[0] = virtual_file_path  # Virtual name might have changed
-                            else:
-                                full_path_file_data = self.get_file_info(virtual_file_path, path, file_stat)
+        old_folder_mtime, _device, settings_hash, is_complete = self.share_store.get_folder(old_folder_id)
+
+        if old_folder_mtime != folder_mtime or settings_hash != self.settings_hash or not is_complete:
+            return None
+
+        # Subfolders are popped in reverse order, keep the order of the previous scan
+        for subfolder_path in reversed(self.old_subfolder_paths.get(old_folder_id, ())):
+            folder_paths.append((subfolder_path, folder_path))
+
+        return self.share_store.get_folder_files(old_folder_id)
+
+    def get_old_file_entry(self, old_files, basename_escaped, file_stat, folder_device):
+        """Returns the packed entry of a file from the previous scan, if the
+        file is unchanged. Files renamed or moved since the previous scan are
+        found by their identity."""
+
+        if old_files:
+            old_file = old_files.get(basename_escaped)
+
+            if old_file is not None:
+                entry, file_mtime, _inode = old_file
+
+                if file_mtime == file_stat.st_mtime_ns and self.share_store.get_entry_size(entry) == file_stat.st_size:
+                    return entry
+
+        if self.share_store is None or not file_stat.st_ino:
+            return None
+
+        entry = self.share_store.find_moved_file(
+            folder_device or 0, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+        if entry is not None:
+            entry = self.share_store.rename_entry(entry, basename_escaped)
+
+        return entry
 
-                            basename_file_data = full_path_file_data[:]
-                            basename_file_data[0] = basename_escaped
-                            file_list.append(basename_file_data)
+    def get_legacy_file_info(self, file_path, file_stat):
+        """Returns the file metadata of an unchanged file in the databases of
+        previous versions."""
 
-                            file_index = self.current_file_index
-                            basename_escaped_lower = basename_escaped.lower()
+        for legacy_files, legacy_mtimes in self.legacy_dbs:
+            if legacy_mtimes.get(file_path) != file_stat.st_mtime:
+                continue
+
+            fileinfo = legacy_files.get(file_path)
+
+            if fileinfo is not None:
+                return fileinfo
+
+        return None
+
+    def scan_folder(self, folder_path, virtual_folder_path, folder_device, old_folder_id, folder_paths,
+                    is_complete=True):
+        """Returns a list of files in a folder, and whether all files could be
+        listed. Metadata of new and modified files is read by metadata worker
+        threads, if enabled."""
+
+        folder_files = []
+        basenames = set()
+        old_files = None
+
+        if old_folder_id is not None:
+            old_files = {
+                self.share_store.get_entry_name(old_file[0]): old_file
+                for old_file in self.share_store.get_folder_files(old_folder_id)
+            }
+
+        try:
+            with os.scandir(encode_path(folder_path, prefix=False)) as entries:
+                for entry in entries:
+                    basename = basename_escaped = entry.name.decode("utf-8", "replace")
+
+                    if "\\" in basename:
+                        # Substitute backslashes with backslash sentinels in basenames. This is necessary
+                        # due to the Soulseek network using backslashes as path separators, conflicting
+                        # with non-Windows systems where backslashes are valid (but uncommon) file name
+                        # characters. We restore the original backslash later when a user downloads the file.
+                        basename_escaped = basename.replace("\\", Shares.BACKSLASH_SENTINEL)
+
+                    path = os.path.join(folder_path, basename)
+
+                    if entry.is_dir():
+                        if self.is_hidden(path, entry=entry):
+                            continue
+
+                        folder_paths.append((path, folder_path))
+                        continue
+
+                    try:
+                        if basename in basenames:
+                            # Two files with slightly different names, but utf-8 decoded paths become
+                            # identical. Only process one of the files to prevent corrupting the file index.
+                            continue
 
-                            for k in set(
-                                virtual_folder_words + basename_escaped_lower.translate(TRANSLATE_PUNCTUATION).split()
-                            ):
-                                self.word_index[k].append(file_index)
+                        if self.is_hidden(folder_path, basename, entry):
+                            continue
+
+                        if (self.file_filter_regex
+                                and self.file_filter_regex.search(f"\\{virtual_folder_path}\\{basename_escaped}")
+                                is not None):
+                            continue
+
+                        file_stat = entry.stat()
+                        file_data = self.get_old_file_entry(old_files, basename_escaped, file_stat, folder_device)
 
-                            self.files[path] = full_path_file_data
-                            self.lowercase_paths[virtual_folder_path_lower][basename_escaped_lower] = file_index
+                        if file_data is None and self.legacy_dbs:
+                            fileinfo = self.get_legacy_file_info(path, file_stat)
 
-                            self.current_file_index += 1
+                            if fileinfo is not None:
+                                fileinfo[0] = basename_escaped
+                                file_data = FileListMessage.pack_file_info(fileinfo)
 
-                        except OSError as error:
-                            self.writer.send(
-                                ScannerLogMessage(
-                                    _("Error while scanning file %(path)s: %(error)s"),
-                                    {"path": path, "error": error}
-                                )
+                        if file_data is None:
+                            if self.metadata_pool is not None:
+                                file_data = self.metadata_pool.submit(
+                                    self.get_file_info, basename_escaped, path, file_stat)
+                            else:
+                                file_data = self.get_file_info(basename_escaped, path, file_stat)
+
+                        folder_files.append((file_data, file_stat.st_mtime_ns, file_stat.st_ino))
+                        basenames.add(basename)
+
+                    except OSError as error:
+                        is_complete = False
+                        self.writer.send(
+                            ScannerLogMessage(
+                                _("Error while scanning file %(path)s: %(error)s"),
+                                {"path": path, "error": error}
                             )
+                        )
 
-            except OSError as error:
-                self.writer.send(
-                    ScannerLogMessage(
-                        _("Error while scanning folder %(path)s: %(error)s"),
-                        {"path": folder_path, "error": error}
-                    )
+        except OSError as error:
+            is_complete = False
+            self.writer.send(
+                ScannerLogMessage(
+                    _("Error while scanning folder %(path)s: %(error)s"),
+                    {"path": folder_path, "error": error}
                 )
+            )
+
+        return folder_files, is_complete
+
+    def process_pending_folder(self):
+        """Add the oldest scanned folder and its files to the share store, in
+        the order folders were scanned. Waits for metadata workers if
+        necessary, ensuring file indices are assigned deterministically."""
 
-            self.streams[virtual_folder_path] = self.get_folder_stream(file_list)
-            self.current_folder_count += 1
+        (permission_level, folder_path, virtual_folder_path, parent_folder_path, folder_mtime, folder_device,
+         is_complete, folder_files) = self.pending_folders.popleft()
+        self.num_pending_files -= len(folder_files)
+        self.writer.send(self.current_folder_count)
+
+        files = []
+        virtual_folder_words = virtual_folder_path.lower().translate(TRANSLATE_PUNCTUATION).split()
+
+        for file_index, (entry, file_mtime, inode) in enumerate(folder_files, start=self.store_writer.num_files):
+            if isinstance(entry, Future):
+                entry = entry.result()
+
+            if isinstance(entry, tuple):
+                fileinfo, error_message = entry
+
+                if error_message is not None:
+                    self.writer.send(error_message)
+
+                entry = FileListMessage.pack_file_info(fileinfo)
+
+            basename_words = ShareStore.get_entry_name(entry).lower().translate(TRANSLATE_PUNCTUATION).split()
+
+            for k in set(virtual_folder_words + basename_words):
+                self.word_index[k].append(file_index)
+
+            files.append((entry, file_mtime, inode))
+
+        self.folder_ids[folder_path] = self.store_writer.add_folder(
+            permission_level, folder_path, virtual_folder_path,
+            parent_folder_id=self.folder_ids.get(parent_folder_path), mtime_ns=folder_mtime,
+            device=folder_device, settings_hash=self.settings_hash, is_complete=is_complete, files=files
+        )
+        self.current_folder_count += 1
 
     def get_audio_tag(self, file_path, size):
 
@@ -671,10 +1753,12 @@ class Scanner:
 
         return tag
 
-    def get_file_info(self, virtual_file_path, file_path, file_stat):
-        """Get file metadata."""
+    def get_file_info(self, basename, file_path, file_stat):
+        """Get file metadata. Also called from metadata worker threads, so
+        errors are returned instead of being sent to the main process."""
 
         tag = None
+        error_message = None
         quality = None
         duration = None
         size = file_stat.st_size
@@ -685,11 +1769,9 @@ class Scanner:
                 tag = self.get_audio_tag(file_path, size)
 
             except Exception as error:
-                self.writer.send(
-                    ScannerLogMessage(
-                        _("Error while scanning metadata for file %(path)s: %(error)s"),
-                        {"path": file_path, "error": error}
-                    )
+                error_message = ScannerLogMessage(
+                    _("Error while scanning metadata for file %(path)s: %(error)s"),
+                    {"path": file_path, "error": error}
                 )
 
         if tag is not None:
@@ -724,31 +1806,251 @@ class Scanner:
 
             quality = (bitrate, int(tag.is_vbr), samplerate, bitdepth)
 
-        return [virtual_file_path, size, quality, duration]
+        return [basename, size, quality, duration], error_message
 
-    @staticmethod
-    def get_folder_stream(file_list):
-        """Pack all files and metadata in folder."""
 
-        stream = bytearray()
-        stream += FileListMessage.pack_uint32(len(file_list))
+class ShareWatcher(Thread):
+    """Thread watching shared folders for changes after a scan. Once changes
+    have settled, the paths of changed folders are reported, allowing the
+    scanner to only list these folders again.
+
+    Uses inotify on GNU/Linux, and falls back to periodically checking the
+    modification time of folders on other systems, or if the inotify watch
+    limit is reached.
+    """
+
+    # Report changes after no new changes for QUIET_DELAY seconds, or at most
+    # MAX_DELAY seconds after the first change
+    QUIET_DELAY = 5
+    MAX_DELAY = 60
+    POLL_INTERVAL = 60
+    READ_BUFFER_SIZE = 65536
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ONLYDIR = 0x01000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER_SIZE = 16
+    UNPACK_EVENT_HEADER = Struct("iIII").unpack_from
+
+    def __init__(self, share_store_path, callback):
+
+        super().__init__(name="ShareWatcher", daemon=True)
+
+        self.share_store_path = share_store_path
+        self.callback = callback
+
+        self._folder_mtimes = {}
+        self._watched_folder_paths = defaultdict(list)
+        self._changed_folder_paths = set()
+        self._first_change_time = self._last_change_time = None
+        self._wakeup_reader, self._wakeup_writer = os.pipe()
+        self._inotify_fd = None
+        self._want_abort = False
+
+    def run(self):
+
+        try:
+            self._load_folder_mtimes()
+            self._init_inotify()
+
+            # Catch changes made before we started watching
+            self._poll_folders()
+
+            self._watch_folders()
+
+        except Exception as error:
+            log.add_debug("Share watcher stopped due to an error: %s", error)
+
+        finally:
+            if self._inotify_fd is not None:
+                os.close(self._inotify_fd)
+                self._inotify_fd = None
+
+    def stop(self):
+        """Stop watching folders. Safe to call multiple times."""
+
+        if self._want_abort:
+            return
+
+        self._want_abort = True
+        os.write(self._wakeup_writer, b"\0")
+        self.join()
+
+        os.close(self._wakeup_reader)
+        os.close(self._wakeup_writer)
+
+    def _load_folder_mtimes(self):
+
+        share_store = ShareStore(encode_path(self.share_store_path))
+
+        try:
+            for folder_id, _parent_folder_id, folder_path in share_store.iter_folders():
+                if self._want_abort:
+                    return
+
+                self._folder_mtimes[folder_path] = share_store.get_folder_mtime(folder_id)
+
+        finally:
+            share_store.close()
+
+    def _init_inotify(self):
+
+        if not sys.platform.startswith("linux"):
+            return
+
+        import ctypes
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            add_watch = libc.inotify_add_watch
+            add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        except Exception as error:
+            log.add_debug("inotify is unavailable, polling shared folders for changes: %s", error)
+            return
+
+        if inotify_fd < 0:
+            log.add_debug("Failed to initialize inotify, polling shared folders for changes: %s",
+                          os.strerror(ctypes.get_errno()))
+            return
+
+        # Closed when the watcher stops
+        self._inotify_fd = inotify_fd
+
+        for folder_path in self._folder_mtimes:
+            if self._want_abort:
+                return
+
+            watch_descriptor = add_watch(inotify_fd, encode_path(folder_path), self.WATCH_MASK)
+
+            if watch_descriptor >= 0:
+                self._watched_folder_paths[watch_descriptor].append(folder_path)
+                continue
+
+            error_code = ctypes.get_errno()
+
+            if error_code in {errno.ENOENT, errno.ENOTDIR}:
+                # Folder was removed after scanning it
+                self._add_changed_folder(folder_path)
+                continue
+
+            # Most likely reached the inotify watch limit (ENOSPC)
+            log.add_debug("Failed to watch shared folder %s, polling shared folders for changes: %s",
+                          (folder_path, os.strerror(error_code)))
+            os.close(inotify_fd)
+            self._inotify_fd = None
+            self._watched_folder_paths.clear()
+            return
+
+    def _watch_folders(self):
+
+        while not self._want_abort:
+            current_time = time.monotonic()
+
+            if self._changed_folder_paths:
+                report_time = min(self._last_change_time + self.QUIET_DELAY,
+                                  self._first_change_time + self.MAX_DELAY)
+
+                if current_time >= report_time:
+                    self.callback(self, self._changed_folder_paths)
+                    return
+
+                timeout = report_time - current_time
 
-        for fileinfo in file_list:
-            stream += FileListMessage.pack_file_info(fileinfo)
+            elif self._inotify_fd is None:
+                timeout = self.POLL_INTERVAL
 
-        return bytes(stream)
+            else:
+                timeout = None
+
+            fds = [self._wakeup_reader]
+
+            if self._inotify_fd is not None:
+                fds.append(self._inotify_fd)
+
+            readable_fds, _writable, _errored = select.select(fds, (), (), timeout)
+
+            if self._wakeup_reader in readable_fds:
+                return
+
+            if self._inotify_fd in readable_fds:
+                if not self._read_inotify_events():
+                    # Event queue overflowed, changes were lost
+                    self.callback(self, None)
+                    return
+
+            elif self._inotify_fd is None:
+                self._poll_folders()
+
+    def _add_changed_folder(self, folder_path):
+
+        current_time = time.monotonic()
+
+        if not self._changed_folder_paths:
+            self._first_change_time = current_time
+
+        self._changed_folder_paths.add(folder_path)
+        self._last_change_time = current_time
+
+    def _poll_folders(self):
+
+        for folder_path, folder_mtime in self._folder_mtimes.items():
+            if self._want_abort:
+                return
+
+            try:
+                current_folder_mtime = os.stat(encode_path(folder_path)).st_mtime_ns
+
+            except OSError:
+                current_folder_mtime = None
+
+            if current_folder_mtime != folder_mtime:
+                self._folder_mtimes[folder_path] = current_folder_mtime
+                self._add_changed_folder(folder_path)
+
+    def _read_inotify_events(self):
+
+        try:
+            content = os.read(self._inotify_fd, self.READ_BUFFER_SIZE)
+
+        except BlockingIOError:
+            return True
+
+        offset = 0
+        content_length = len(content)
+
+        while offset < content_length:
+            watch_descriptor, mask, _cookie, name_length = self.UNPACK_EVENT_HEADER(content, offset)
+            offset += self.EVENT_HEADER_SIZE + name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                return False
+
+            for folder_path in self._watched_folder_paths.get(watch_descriptor, ()):
+                self._add_changed_folder(folder_path)
+
+        return True
 
 
 class Shares:
-    __slots__ = ("share_dbs", "initialized", "compressed_shares", "share_db_paths",
-                 "file_path_index", "_scanner_process", "_scanner_reader", "_rescan_daily_timer_id",
-                 "_requested_share_times")
+    __slots__ = ("share_store", "initialized", "compressed_shares", "share_store_path", "legacy_db_paths",
+                 "_scanner_process", "_scanner_reader", "_rescan_daily_timer_id",
+                 "_requested_share_times", "_share_watcher")
 
     BACKSLASH_SENTINEL = "@@BACKSLASH@@"
 
     def __init__(self):
 
-        self.share_dbs = {}
+        self.share_store = None
         self.initialized = False
         self.compressed_shares = {
             PermissionLevel.PUBLIC: SharedFileListResponse(permission_level=PermissionLevel.PUBLIC),
@@ -756,25 +2058,36 @@ class Shares:
             PermissionLevel.TRUSTED: SharedFileListResponse(permission_level=PermissionLevel.TRUSTED),
             PermissionLevel.BANNED: SharedFileListResponse(permission_level=PermissionLevel.BANNED)
         }
-        self.share_db_paths = {
+        self.share_store_path = os.path.join(config.data_folder_path, "shares.dbn")
+
+        # Databases of previous versions, removed once their file metadata is migrated
+        self.legacy_db_paths = {
             "words": os.path.join(config.data_folder_path, "words.dbn"),
+            "file_metadata": os.path.join(config.data_folder_path, "filemetadata.dbn"),
+            "word_suffixes": os.path.join(config.data_folder_path, "wordsuffixes.dbn"),
+            "word_filter": os.path.join(config.data_folder_path, "wordfilter.dbn"),
+            "file_paths": os.path.join(config.data_folder_path, "filepaths.dbn"),
+            "file_records": os.path.join(config.data_folder_path, "filerecords.dbn"),
             "lowercase_paths": os.path.join(config.data_folder_path, "lowercasepaths.dbn"),
             "public_files": os.path.join(config.data_folder_path, "publicfiles.dbn"),
             "public_mtimes": os.path.join(config.data_folder_path, "publicmtimes.dbn"),
             "public_streams": os.path.join(config.data_folder_path, "publicstreams.dbn"),
+            "public_folders": os.path.join(config.data_folder_path, "publicfolders.dbn"),
             "buddy_files": os.path.join(config.data_folder_path, "buddyfiles.dbn"),
             "buddy_mtimes": os.path.join(config.data_folder_path, "buddymtimes.dbn"),
             "buddy_streams": os.path.join(config.data_folder_path, "buddystreams.dbn"),
+            "buddy_folders": os.path.join(config.data_folder_path, "buddyfolders.dbn"),
             "trusted_files": os.path.join(config.data_folder_path, "trustedfiles.dbn"),
             "trusted_mtimes": os.path.join(config.data_folder_path, "trustedmtimes.dbn"),
-            "trusted_streams": os.path.join(config.data_folder_path, "trustedstreams.dbn")
+            "trusted_streams": os.path.join(config.data_folder_path, "trustedstreams.dbn"),
+            "trusted_folders": os.path.join(config.data_folder_path, "trustedfolders.dbn")
         }
-        self.file_path_index = ()
 
         self._scanner_process = None
         self._scanner_reader = None
         self._rescan_daily_timer_id = None
         self._requested_share_times = {}
+        self._share_watcher = None
 
         for event_name, callback in (
             ("folder-contents-request", self._folder_contents_request),
@@ -801,8 +2114,9 @@ class Shares:
 
     def _quit(self):
 
+        self.stop_share_watcher()
         self.stop_scanner()
-        self.close_shares(self.share_dbs)
+        self.close_shares()
         self.initialized = False
 
     def _server_login(self, msg):
@@ -814,11 +2128,6 @@ class Shares:
 
     # Shares-related Actions #
 
-    @classmethod
-    def create_db_file(cls, db_path):
-        cls.remove_db_file(db_path)
-        return Database(encode_path(db_path))
-
     @staticmethod
     def remove_db_file(db_path):
 
@@ -828,28 +2137,28 @@ class Shares:
             os.remove(db_path_encoded)
 
         elif os.path.isdir(db_path_encoded):
-            import shutil
             shutil.rmtree(db_path_encoded)
 
-    def get_lowercase_path_index(self, virtual_path):
+    def get_lowercase_real_path(self, virtual_path):
+        """Returns the real path of a shared file, given its virtual path in
+        lowercase, or None if no file matches."""
 
-        virtual_folder_path, _separator, basename = virtual_path.rpartition("\\")
-        lowercase_paths = core.shares.share_dbs.get("lowercase_paths", {})
-        index = None
+        if self.share_store is None or virtual_path != virtual_path.lower():
+            return None
 
-        if virtual_folder_path in lowercase_paths:
-            index = lowercase_paths[virtual_folder_path].get(basename)
+        for file_index in self.share_store.iter_matching_files(virtual_path):
+            return self.share_store.get_real_path(file_index)
 
-        return index
+        return None
 
     def virtual2real(self, virtual_path, revert_backslash=False, is_lowercase_path=False):
 
         if is_lowercase_path:
-            real_path_index = self.get_lowercase_path_index(virtual_path)
+            real_path = self.get_lowercase_real_path(virtual_path)
 
-            if real_path_index is not None:
+            if real_path is not None:
                 # Mangled path from a Soulseek NS client (all lowercase)
-                return self.file_path_index[real_path_index]
+                return real_path
 
         share_groups = self.get_shared_folders()
 
@@ -908,53 +2217,41 @@ class Shares:
             except OSError as error:
                 log.add_debug("Failed to remove old share database %s: %s", (file_path, error))
 
-    @classmethod
-    def load_shares(cls, share_dbs, share_db_paths, destinations=None):
-
-        exception = None
-
-        for destination, db_path in share_db_paths.items():
-            if destinations and destination not in destinations:
-                continue
-
-            try:
-                share_dbs[destination] = Database(encode_path(db_path), overwrite=False)
-
-            except Exception as error:
-                exception = error
-                cls.remove_db_file(db_path)
+    def load_shares(self):
 
-        if exception:
-            cls.close_shares(share_dbs)
-            raise exception
+        self.close_shares()
+        self.share_store = ShareStore(encode_path(self.share_store_path))
 
     def file_is_shared(self, username, virtual_path, real_path):
 
         log.add_transfer("Checking if file is shared: %s with real path %s",
                          (virtual_path, real_path))
 
-        public_shared_files = self.share_dbs.get("public_files")
-        buddy_shared_files = self.share_dbs.get("buddy_files")
-        trusted_shared_files = self.share_dbs.get("trusted_files")
+        share_store = self.share_store
         file_is_shared = False
         size = None
 
-        if not real_path.startswith("__INVALID_SHARE__"):
-            if public_shared_files is not None and real_path in public_shared_files:
-                file_is_shared = True
-                _file_name, size, *_unused = public_shared_files[real_path]
-
-            elif (buddy_shared_files is not None and username in core.buddies.users
-                    and real_path in buddy_shared_files):
-                file_is_shared = True
-                _file_name, size, *_unused = buddy_shared_files[real_path]
+        if share_store is not None and not real_path.startswith("__INVALID_SHARE__"):
+            for file_index in share_store.iter_matching_files(virtual_path):
+                if share_store.get_real_path(file_index) != real_path:
+                    continue
 
-            elif trusted_shared_files is not None:
-                user_data = core.buddies.users.get(username)
+                permission_level = share_store.get_file_permission_level(file_index)
 
-                if user_data and user_data.is_trusted and real_path in trusted_shared_files:
+                if permission_level == PermissionLevel.PUBLIC:
                     file_is_shared = True
-                    _file_name, size, *_unused = trusted_shared_files[real_path]
+
+                elif permission_level == PermissionLevel.BUDDY:
+                    file_is_shared = (username in core.buddies.users)
+
+                else:
+                    user_data = core.buddies.users.get(username)
+                    file_is_shared = bool(user_data and user_data.is_trusted)
+
+                if file_is_shared:
+                    size = share_store.get_file_size(file_index)
+
+                break
 
         if not file_is_shared:
             log.add_transfer("File is not present in the database of shared files, not sharing: "
@@ -1083,14 +2380,11 @@ class Shares:
 
         return False
 
-    @staticmethod
-    def close_shares(share_dbs):
-
-        for destination in share_dbs.copy():
-            database = share_dbs.pop(destination, None)
+    def close_shares(self):
 
-            if database is not None:
-                database.close()
+        if self.share_store is not None:
+            self.share_store.close()
+            self.share_store = None
 
     def send_num_shared_folders_files(self):
         """Send number of publicly shared files to the server."""
@@ -1099,16 +2393,20 @@ class Shares:
             return
 
         local_username = core.users.login_username
-        num_shared_folders = len(self.share_dbs.get("public_streams", {}))
-        num_shared_files = len(self.share_dbs.get("public_files", {}))
+        share_store = self.share_store
+        num_shared_folders = num_shared_files = 0
 
-        if config.sections["transfers"]["reveal_buddy_shares"]:
-            num_shared_folders += len(self.share_dbs.get("buddy_streams", {}))
-            num_shared_files += len(self.share_dbs.get("buddy_files", {}))
+        if share_store is not None:
+            num_shared_folders = share_store.get_num_folders(PermissionLevel.PUBLIC)
+            num_shared_files = share_store.get_num_files(PermissionLevel.PUBLIC)
 
-        if config.sections["transfers"]["reveal_trusted_shares"]:
-            num_shared_folders += len(self.share_dbs.get("trusted_streams", {}))
-            num_shared_files += len(self.share_dbs.get("trusted_files", {}))
+            if config.sections["transfers"]["reveal_buddy_shares"]:
+                num_shared_folders += share_store.get_num_folders(PermissionLevel.BUDDY)
+                num_shared_files += share_store.get_num_files(PermissionLevel.BUDDY)
+
+            if config.sections["transfers"]["reveal_trusted_shares"]:
+                num_shared_folders += share_store.get_num_folders(PermissionLevel.TRUSTED)
+                num_shared_files += share_store.get_num_files(PermissionLevel.TRUSTED)
 
         core.send_message_to_server(SharedFoldersFiles(num_shared_folders, num_shared_files))
 
@@ -1135,7 +2433,8 @@ class Shares:
     def rebuild_shares(self, use_thread=True):
         return self.rescan_shares(rebuild=True, use_thread=use_thread)
 
-    def rescan_shares(self, init=False, rescan=True, rebuild=False, use_thread=True, force=False):
+    def rescan_shares(self, init=False, rescan=True, rebuild=False, use_thread=True, force=False,
+                      changed_folder_paths=None):
 
         self.stop_scanner()
 
@@ -1152,13 +2451,14 @@ class Shares:
                 if not init:
                     return None
 
+        self.stop_share_watcher()
+
         # Hand over database control to the scanner process
         share_groups = self.get_shared_folders()
         self._scanner_process, self._scanner_reader, writer = self._build_scanner_process(
-            share_groups, init, rescan, rebuild)
+            share_groups, init, rescan, rebuild, changed_folder_paths)
 
-        self.close_shares(self.share_dbs)
-        self.file_path_index = ()
+        self.close_shares()
 
         events.emit("shares-scanning")
         self._scanner_process.start()
@@ -1202,6 +2502,33 @@ class Shares:
 
             self._scanner_reader = None
 
+    def start_share_watcher(self):
+
+        self.stop_share_watcher()
+
+        if not config.sections["transfers"]["watch_shares"]:
+            return
+
+        self._share_watcher = ShareWatcher(
+            self.share_store_path, callback=partial(events.invoke_main_thread, self._shared_folders_changed))
+        self._share_watcher.start()
+
+    def stop_share_watcher(self):
+
+        if self._share_watcher is not None:
+            self._share_watcher.stop()
+            self._share_watcher = None
+
+    def _shared_folders_changed(self, share_watcher, changed_folder_paths):
+
+        if share_watcher is not self._share_watcher or self.rescanning:
+            # Outdated changes, shares were rescanned in the meantime
+            return
+
+        log.add_debug("Shared folders changed, rescanning %s folders",
+                      len(changed_folder_paths) if changed_folder_paths is not None else "all")
+        self.rescan_shares(changed_folder_paths=changed_folder_paths)
+
     def check_shares_available(self):
 
         share_groups = self.get_shared_folders()
@@ -1233,7 +2560,8 @@ class Shares:
         self._rescan_daily_timer_id = events.schedule_at(
             timestamp=target_time.timestamp(), callback=self.rescan_shares)
 
-    def _build_scanner_process(self, share_groups=None, init=False, rescan=True, rebuild=False):
+    def _build_scanner_process(self, share_groups=None, init=False, rescan=True, rebuild=False,
+                               changed_folder_paths=None):
 
         import multiprocessing
 
@@ -1242,13 +2570,16 @@ class Shares:
         scanner_obj = Scanner(
             writer,
             share_groups,
-            self.share_db_paths,
+            self.share_store_path,
+            self.legacy_db_paths,
             init,
             rescan,
             rebuild,
             reveal_buddy_shares=config.sections["transfers"]["reveal_buddy_shares"],
             reveal_trusted_shares=config.sections["transfers"]["reveal_trusted_shares"],
-            share_filters=config.sections["transfers"]["share_filters"]
+            share_filters=config.sections["transfers"]["share_filters"],
+            metadata_threads=config.sections["transfers"]["scan_metadata_threads"],
+            changed_folder_paths=changed_folder_paths
         )
         scanner = context.Process(target=scanner_obj.run, daemon=True)
         return scanner, reader, writer
@@ -1273,9 +2604,6 @@ class Shares:
             elif isinstance(item, ScannerLogMessage):
                 log.add(item.msg, item.msg_args)
 
-            elif isinstance(item, tuple):
-                self.file_path_index = item
-
             elif isinstance(item, SharedFileListResponse):
                 self.compressed_shares[item.permission_level] = item
 
@@ -1317,11 +2645,7 @@ class Shares:
         # Scanning done, load shares in the main process again
         if successful:
             try:
-                self.load_shares(
-                    self.share_dbs, self.share_db_paths, destinations={
-                        "words", "lowercase_paths", "public_files", "public_streams", "buddy_files",
-                        "buddy_streams", "trusted_files", "trusted_streams"
-                    })
+                self.load_shares()
 
             except Exception:
                 successful = False
@@ -1329,9 +2653,9 @@ class Shares:
         self.start_rescan_daily_timer()
 
         if not successful:
-            self.file_path_index = ()
             return
 
+        self.start_share_watcher()
         self.send_num_shared_folders_files()
 
     # Network Messages #
@@ -1367,18 +2691,20 @@ class Shares:
         permission_level, _reject_reason = self.check_user_permission(username, ip_address)
         folder_data = None
 
-        if permission_level != PermissionLevel.BANNED:
-            folder_data = self.share_dbs.get("public_streams", {}).get(folder_path)
+        if permission_level != PermissionLevel.BANNED and self.share_store is not None:
+            folder_id = self.share_store.find_folder(folder_path)
 
-            if (folder_data is None
-                    and (config.sections["transfers"]["reveal_buddy_shares"]
-                         or permission_level in {PermissionLevel.BUDDY, PermissionLevel.TRUSTED})):
-                folder_data = self.share_dbs.get("buddy_streams", {}).get(folder_path)
+            if folder_id is not None:
+                folder_permission_level = self.share_store.get_folder_permission_level(folder_id)
 
-            if (folder_data is None
-                    and (config.sections["transfers"]["reveal_trusted_shares"]
-                         or permission_level == PermissionLevel.TRUSTED)):
-                folder_data = self.share_dbs.get("trusted_streams", {}).get(folder_path)
+                if (folder_permission_level == PermissionLevel.PUBLIC
+                        or (folder_permission_level == PermissionLevel.BUDDY
+                            and (config.sections["transfers"]["reveal_buddy_shares"]
+                                 or permission_level in {PermissionLevel.BUDDY, PermissionLevel.TRUSTED}))
+                        or (folder_permission_level == PermissionLevel.TRUSTED
+                            and (config.sections["transfers"]["reveal_trusted_shares"]
+                                 or permission_level == PermissionLevel.TRUSTED))):
+                    folder_data = self.share_store.get_folder_stream(folder_id)
 
         core.send_message_to_peer(
             username, FolderContentsResponse(directory=folder_path, token=msg.token, shares=folder_data))
@@ -3297,9 +3297,9 @@ class SharedFileListResponse(PeerMessage):
             msg_list += self.pack_uint32(num_folders)
 
             for shares in share_groups:
-                for key in shares:
-                    msg_list += self.pack_string(key)
-                    msg_list += shares[key]
+                for virtual_folder_path, stream in shares.items():
+                    msg_list += self.pack_string(virtual_folder_path)
+                    msg_list += stream
 
         except Exception as error:
             from pynicotine.logfacility import log
@@ -3458,9 +3458,7 @@ class FileSearchResponse(PeerMessage):
         msg += self.pack_string(self.search_username)
         msg += self.pack_uint32(self.token)
         msg += self.pack_uint32(len(self.list))
-
-        for fileinfo in self.list:
-            msg += FileListMessage.pack_file_info(fileinfo)
+        msg += self._pack_result_list(self.list)
 
         msg += self.pack_bool(self.freeulslots)
         msg += self.pack_uint32(self.ulspeed)
@@ -3469,12 +3467,19 @@ class FileSearchResponse(PeerMessage):
 
         if self.privatelist:
             msg += self.pack_uint32(len(self.privatelist))
-
-            for fileinfo in self.privatelist:
-                msg += FileListMessage.pack_file_info(fileinfo)
+            msg += self._pack_result_list(self.privatelist)
 
         return zlib.compress(msg, ZLIB_COMPRESSION_LEVEL)
 
+    @staticmethod
+    def _pack_result_list(results):
+
+        if results and isinstance(results[0], bytes):
+            # Result records were already packed when scanning shares
+            return b"".join(results)
+
+        return b"".join(FileListMessage.pack_file_info(fileinfo) for fileinfo in results)
+
     def parse_network_message(self):
         decompressor = zlib.decompressobj()
         max_uncompressed_size = 134217728  # 128 MiB
@@ -6,6 +6,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import errno
+import os
 import random
 import selectors
 import socket
@@ -14,6 +15,7 @@ import sys
 import time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from os import strerror
 from queue import Empty, SimpleQueue
 from threading import Thread
@@ -83,8 +85,8 @@ from pynicotine.utils import human_speed
 
 
 class Connection:
-    __slots__ = ("sock", "addr", "io_events", "is_established", "in_buffer", "out_buffer",
-                 "last_active", "recv_size")
+    __slots__ = ("sock", "addr", "io_events", "is_established", "in_buffer", "in_buffer_offset",
+                 "out_buffer", "last_active", "recv_size")
 
     def __init__(self, sock=None, addr=None, io_events=None):
 
@@ -92,11 +94,34 @@ class Connection:
         self.addr = addr
         self.io_events = io_events
         self.in_buffer = bytearray()
+        self.in_buffer_offset = 0
         self.out_buffer = bytearray()
         self.last_active = time.monotonic()
         self.recv_size = 51200
         self.is_established = False
 
+    def consume_in_buffer(self, offset):
+        """Marks data in the input buffer up to the offset as processed.
+
+        Processed data is only removed from the buffer once it's at least as
+        large as the remaining data. Appending to a bytearray after removing
+        data from its start can move all remaining data in memory, which is
+        slow when a large message is being received.
+        """
+
+        in_buffer = self.in_buffer
+        buffer_len = len(in_buffer)
+
+        if offset >= buffer_len:
+            in_buffer.clear()
+            offset = 0
+
+        elif offset >= (buffer_len - offset):
+            del in_buffer[:offset]
+            offset = 0
+
+        self.in_buffer_offset = offset
+
 
 class ServerConnection(Connection):
     __slots__ = ("login",)
@@ -339,6 +364,7 @@ class NetworkThread(Thread):
     MAX_INCOMING_MESSAGE_SIZE_LARGE = 469762048  # 448 MiB, to leave headroom for large shares
     MAX_INCOMING_MESSAGE_SIZE_MEDIUM = 16777216  # 16 MiB
     MAX_INCOMING_MESSAGE_SIZE_SMALL = 16384      # 16 KiB
+    MIN_WORKER_PARSE_MESSAGE_SIZE = 65536        # 64 KiB
     TCP_BUFFER_SIZE_MEDIUM = 208896              # 204 KiB, maximum limit NetBSD accepts by default
     TCP_BUFFER_SIZE_SMALL = 16384                # 16 KiB
     ALLOWED_PEER_CONN_TYPES = {
@@ -349,10 +375,15 @@ class NetworkThread(Thread):
     ERROR_NOT_CONNECTED = OSError(errno.ENOTCONN, strerror(errno.ENOTCONN))
     ERROR_TIMED_OUT = OSError(errno.ETIMEDOUT, strerror(errno.ETIMEDOUT))
 
-    # Looping max ~240 times per second (SLEEP_MIN_IDLE) on high activity
-    # ~20 (SLEEP_MAX_IDLE + SLEEP_MIN_IDLE) by default
-    SLEEP_MAX_IDLE = 0.04584
-    SLEEP_MIN_IDLE = 0.00416
+    # Upload files with sendfile() on Linux, to avoid copying file contents through
+    # Python. Other platforms have different sendfile() semantics for non-blocking sockets.
+    SENDFILE_SUPPORTED = (sys.platform == "linux")
+    SENDFILE_UNSUPPORTED_ERRNOS = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP}
+    SENDFILE_SOCKET_ERRNOS = {errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED, errno.ENOTCONN, errno.ETIMEDOUT}
+
+    # Connection checks and bandwidth accounting happen once per cycle. Between
+    # cycles, the loop sleeps in select() until a socket or the wakeup socket is ready.
+    CYCLE_INTERVAL = 1
 
     try:
         import resource
@@ -393,6 +424,13 @@ class NetworkThread(Thread):
         self._want_abort = False
 
         self._selector = None
+        self._message_parse_pool = None
+        self._parsing_peer_conns = set()
+        self._parsed_peer_messages = SimpleQueue()
+        self._wakeup_socket = None
+        self._wakeup_send_socket = None
+        self._is_wakeup_pending = False
+        self._paused_sockets = set()
         self._listen_socket = None
         self._listen_port = None
         self._interface_name = None
@@ -425,10 +463,12 @@ class NetworkThread(Thread):
 
         self._conns = {}
         self._indirect_token = initial_token()
+        self._recv_buffer = None
 
         self._file_init_msgs = {}
         self._file_download_msgs = {}
         self._file_upload_msgs = {}
+        self._buffered_file_uploads = set()
         self._conns_downloaded = defaultdict(int)
         self._conns_uploaded = defaultdict(int)
         self._calc_upload_limit_function = self._calc_upload_limit_none
@@ -451,6 +491,62 @@ class NetworkThread(Thread):
 
     def _schedule_quit(self):
         self._want_abort = True
+        self._wake_up()
+
+    # Wakeup Socket #
+
+    def _create_wakeup_socket(self):
+
+        self._wakeup_socket, self._wakeup_send_socket = socket.socketpair()
+
+        for sock in (self._wakeup_socket, self._wakeup_send_socket):
+            sock.setblocking(False)
+
+        self._selector.register(self._wakeup_socket, selectors.EVENT_READ)
+
+    def _close_wakeup_socket(self):
+
+        if self._wakeup_socket is None:
+            return
+
+        self._selector.unregister(self._wakeup_socket)
+
+        for sock in (self._wakeup_socket, self._wakeup_send_socket):
+            self._close_socket(sock)
+
+        self._wakeup_socket = self._wakeup_send_socket = None
+
+    def _wake_up(self):
+        """Interrupts the select() call in the networking loop. Called from the
+        main thread."""
+
+        wakeup_send_socket = self._wakeup_send_socket
+
+        if wakeup_send_socket is None or self._is_wakeup_pending:
+            return
+
+        self._is_wakeup_pending = True
+
+        try:
+            wakeup_send_socket.send(b"\0")
+
+        except OSError:
+            # Socket buffer is full (a wakeup is already pending) or the socket is closed
+            pass
+
+    def _clear_wakeup(self):
+
+        try:
+            while self._wakeup_socket.recv(4096):
+                pass
+
+        except OSError:
+            # No more data to read
+            pass
+
+        # Clear flag after reading. If the main thread queues another message meanwhile, it's
+        # processed before the next select() call.
+        self._is_wakeup_pending = False
 
     # Message Queue #
 
@@ -461,6 +557,7 @@ class NetworkThread(Thread):
 
         self._clear_message_queue()
         self._should_process_queue = True
+        self._wake_up()
 
     def _disable_message_queue(self):
 
@@ -481,6 +578,7 @@ class NetworkThread(Thread):
     def _queue_network_message(self, msg):
         if self._should_process_queue:
             self._message_queue.put_nowait(msg)
+            self._wake_up()
 
     def _process_queue_messages(self):
 
@@ -525,8 +623,8 @@ class NetworkThread(Thread):
             self._selector.unregister(self._listen_socket)
 
         except KeyError:
-            # Socket was not registered
-            pass
+            # Socket was not registered, or is paused
+            self._paused_sockets.discard(self._listen_socket)
 
         self._close_socket(self._listen_socket)
         self._listen_socket = None
@@ -770,9 +868,37 @@ class NetworkThread(Thread):
 
     def _modify_connection_events(self, conn, io_events):
 
-        if conn.io_events != io_events:
+        if conn.io_events == io_events:
+            return
+
+        if conn.sock not in self._paused_sockets:
+            # Paused sockets are registered with their current events when resumed
             self._selector.modify(conn.sock, io_events)
-            conn.io_events = io_events
+
+        conn.io_events = io_events
+
+    def _pause_socket_events(self, sock):
+        """Stops watching a socket for I/O events until the next cycle. Used when
+        a bandwidth or socket limit is reached, since select() would otherwise keep
+        returning the socket as ready."""
+
+        if sock in self._paused_sockets:
+            return
+
+        self._selector.unregister(sock)
+        self._paused_sockets.add(sock)
+
+    def _resume_socket_events(self):
+
+        for sock in self._paused_sockets:
+            if sock is self._listen_socket:
+                io_events = selectors.EVENT_READ
+            else:
+                io_events = self._conns[sock].io_events
+
+            self._selector.register(sock, io_events)
+
+        self._paused_sockets.clear()
 
     def _process_conn_messages(self, init):
         """A connection is established with the peer, time to queue up our peer
@@ -987,7 +1113,10 @@ class NetworkThread(Thread):
             # Disconnecting from server, clean up connections and queue
             self._server_disconnect()
 
-        self._selector.unregister(sock)
+        if sock in self._paused_sockets:
+            self._paused_sockets.remove(sock)
+        else:
+            self._selector.unregister(sock)
         self._close_socket(sock)
         self._num_sockets -= 1
 
@@ -995,6 +1124,7 @@ class NetworkThread(Thread):
 
         try:
             conn.in_buffer.clear()
+            conn.in_buffer_offset = 0
             conn.out_buffer.clear()
 
         except BufferError as error:
@@ -1003,6 +1133,8 @@ class NetworkThread(Thread):
         if conn.__class__ is not PeerConnection:
             return
 
+        self._parsing_peer_conns.discard(conn)
+
         init = conn.init
 
         if init is None:
@@ -1054,6 +1186,7 @@ class NetworkThread(Thread):
 
         elif conn in self._file_upload_msgs:
             del self._file_upload_msgs[conn]
+            self._buffered_file_uploads.discard(conn)
             self._total_uploads -= 1
 
             if not self._total_uploads:
@@ -1503,9 +1636,9 @@ class NetworkThread(Thread):
         """Reads messages from the input buffer of a server connection."""
 
         in_buffer = conn.in_buffer
-        buffer_len = len(in_buffer)
+        idx = conn.in_buffer_offset
+        buffer_len = len(in_buffer) - idx
         msg_content_offset = 8
-        idx = 0
 
         # Server messages are 8 bytes or greater in length
         while buffer_len >= msg_content_offset:
@@ -1540,8 +1673,8 @@ class NetworkThread(Thread):
             idx += msg_size_total
             buffer_len -= msg_size_total
 
-        if idx:
-            del in_buffer[:idx]
+        if idx > conn.in_buffer_offset:
+            conn.consume_in_buffer(idx)
 
     def _process_server_output(self, conn, msg):
 
@@ -1715,9 +1848,9 @@ class NetworkThread(Thread):
 
         init = None
         in_buffer = conn.in_buffer
-        buffer_len = len(in_buffer)
+        idx = conn.in_buffer_offset
+        buffer_len = len(in_buffer) - idx
         msg_content_offset = 5
-        idx = 0
 
         # Peer init messages are 5 bytes or greater in length
         while buffer_len >= msg_content_offset and init is None:
@@ -1756,8 +1889,8 @@ class NetworkThread(Thread):
             self._close_connection(conn)
             return None
 
-        if idx:
-            del in_buffer[:idx]
+        if idx > conn.in_buffer_offset:
+            conn.consume_in_buffer(idx)
 
         conn.init = init
 
@@ -1820,6 +1953,10 @@ class NetworkThread(Thread):
 
             log.add_conn("Incoming connection from address %s", (incoming_addr,))
 
+        if self._num_sockets >= self.MAX_SOCKETS:
+            # Leave remaining connections in the backlog until inactive ones are closed
+            self._pause_socket_events(self._listen_socket)
+
     def _init_peer_connection(self, addr, init, pierce_token=None):
 
         if self._num_sockets >= self.MAX_SOCKETS:
@@ -1862,10 +1999,14 @@ class NetworkThread(Thread):
     def _process_peer_input(self, conn):
         """Reads messages from the input buffer of a 'P' connection."""
 
+        if conn in self._parsing_peer_conns:
+            # Keep messages in order, wait until the worker thread has parsed the previous one
+            return
+
         in_buffer = conn.in_buffer
-        buffer_len = len(in_buffer)
+        idx = conn.in_buffer_offset
+        buffer_len = len(in_buffer) - idx
         msg_content_offset = 8
-        idx = 0
         search_result_received = False
 
         # Peer messages are 8 bytes or greater in length
@@ -1907,7 +2048,26 @@ class NetworkThread(Thread):
                 break
 
             # Unpack peer messages
-            if msg_class:
+            if msg_class is SharedFileListResponse and msg_size >= self.MIN_WORKER_PARSE_MESSAGE_SIZE:
+                # Decompressing and parsing large share lists can take seconds. Do it in a worker
+                # thread, to avoid stalling other connections meanwhile. Later messages on this
+                # connection are processed once the worker thread is done.
+                self._parsing_peer_conns.add(conn)
+                self._message_parse_pool.submit(
+                    self._parse_peer_message_worker,
+                    conn,
+                    msg_class,
+                    in_buffer[idx + msg_content_offset:idx + msg_size_total],
+                    msg_size,
+                    sock=conn.sock,
+                    addr=conn.addr,
+                    username=conn.init.target_user,
+                    allowed_responses=self._allowed_message_responses.get(msg_class, set())
+                )
+                idx += msg_size_total
+                break
+
+            elif msg_class:
                 msg = self._unpack_network_message(
                     msg_class,
                     memoryview(in_buffer)[idx + msg_content_offset:idx + msg_size_total],
@@ -1931,8 +2091,8 @@ class NetworkThread(Thread):
             idx += msg_size_total
             buffer_len -= msg_size_total
 
-        if idx:
-            del in_buffer[:idx]
+        if idx > conn.in_buffer_offset:
+            conn.consume_in_buffer(idx)
             conn.has_post_init_activity = True
 
         if search_result_received and not self._is_connection_still_active(conn):
@@ -1941,6 +2101,40 @@ class NetworkThread(Thread):
 
             self._close_connection(conn)
 
+    def _parse_peer_message_worker(self, conn, msg_class, msg_content, msg_size, sock, addr, username,
+                                   allowed_responses):
+        """Runs in a worker thread. The message contents are a copy of the data in
+        the connection's input buffer, which can change in the meantime. The
+        parsed message is passed back to the network thread."""
+
+        msg = self._unpack_network_message(
+            msg_class,
+            msg_content,
+            msg_size,
+            conn_type="peer",
+            sock=sock,
+            addr=addr,
+            username=username,
+            allowed_responses=allowed_responses
+        )
+        self._parsed_peer_messages.put_nowait((conn, msg))
+        self._wake_up()
+
+    def _process_parsed_peer_messages(self):
+
+        while True:
+            try:
+                conn, msg = self._parsed_peer_messages.get_nowait()
+            except Empty:
+                break
+
+            self._parsing_peer_conns.discard(conn)
+            self._emit_network_message_event(msg)
+
+            if conn.sock is not None:
+                # Process messages received while the worker thread was parsing
+                self._process_conn_incoming_messages(conn)
+
     def _process_peer_output(self, conn, msg):
 
         # Pack peer messages
@@ -1995,12 +2189,12 @@ class NetworkThread(Thread):
 
         self._download_limit_split = int(limit)
 
-    def _process_file_init_message(self, conn, in_buffer):
+    def _process_file_init_message(self, conn, in_buffer, idx):
 
-        msg_size = idx = 4
+        msg_size = 4
         msg = self._unpack_network_message(
             FileTransferInit,
-            memoryview(in_buffer)[:msg_size],
+            memoryview(in_buffer)[idx:idx + msg_size],
             msg_size,
             conn_type="file",
             sock=conn.sock,
@@ -2011,21 +2205,21 @@ class NetworkThread(Thread):
             self._file_init_msgs[conn] = msg
             self._emit_network_message_event(msg)
 
-        return idx
+        return msg_size
 
-    def _process_file_offset_message(self, conn, in_buffer):
+    def _process_file_offset_message(self, conn, in_buffer, idx):
 
         file_upload = self._file_upload_msgs[conn]
 
         if file_upload.offset is not None:
             # No more incoming messages on this connection after receiving the
             # file offset. If peer sends something anyway, clear it.
-            return len(in_buffer)
+            return len(in_buffer) - idx
 
-        msg_size = idx = 8
+        msg_size = 8
         msg = self._unpack_network_message(
             FileOffset,
-            memoryview(in_buffer)[:msg_size],
+            memoryview(in_buffer)[idx:idx + msg_size],
             msg_size,
             conn_type="file",
             sock=conn.sock,
@@ -2033,7 +2227,7 @@ class NetworkThread(Thread):
         )
 
         if msg is None or msg.offset is None:
-            return idx
+            return msg_size
 
         file_upload.offset = msg.offset
 
@@ -2055,7 +2249,7 @@ class NetworkThread(Thread):
             self._close_connection(conn)
             return None
 
-        return idx
+        return msg_size
 
     def _write_download_file(self, file_download, data, data_len):
 
@@ -2097,6 +2291,55 @@ class NetworkThread(Thread):
 
         return True
 
+    def _is_sendfile_upload(self, conn):
+        return self.SENDFILE_SUPPORTED and conn not in self._buffered_file_uploads
+
+    def _send_upload_file(self, conn, file_upload, limit):
+        """Sends file contents directly from the file descriptor to the socket,
+        without copying them to the output buffer. Returns None if the file
+        can no longer be read."""
+
+        position = file_upload.offset + file_upload.sentbytes
+        num_bytes = file_upload.size - position
+
+        if limit is not None and num_bytes > limit:  # pylint: disable=consider-using-min-builtin
+            num_bytes = limit
+
+        if num_bytes <= 0:
+            return 0
+
+        try:
+            num_bytes_sent = os.sendfile(  # pylint: disable=no-member
+                conn.sock.fileno(), file_upload.file.fileno(), position, num_bytes)
+
+            if num_bytes_sent:
+                return num_bytes_sent
+
+            file_error = OSError(errno.ENODATA, "File was truncated during upload")
+
+        except BlockingIOError:
+            return 0
+
+        except OSError as error:
+            if error.errno in self.SENDFILE_SOCKET_ERRNOS:
+                raise
+
+            if error.errno in self.SENDFILE_UNSUPPORTED_ERRNOS:
+                # File system doesn't support sendfile(), read the file into the output buffer instead
+                log.add_conn("Cannot use sendfile() for upload to user %s, falling back to regular reads: %s",
+                             (conn.init.target_user, error))
+                self._buffered_file_uploads.add(conn)
+                file_upload.file.seek(position)
+                return 0
+
+            file_error = error
+
+        events.emit_main_thread(
+            "upload-file-error",
+            username=conn.init.target_user, token=file_upload.token, error=file_error
+        )
+        return None
+
     def _process_upload(self, conn, num_sent_bytes, current_time):
 
         file_upload = self._file_upload_msgs[conn]
@@ -2111,7 +2354,7 @@ class NetworkThread(Thread):
         size = file_upload.size
 
         try:
-            if total_read_bytes < size:
+            if total_read_bytes < size and not self._is_sendfile_upload(conn):
                 num_bytes_to_read = int(
                     (max(4096, num_sent_bytes * 1.25) / max(1, current_time - conn.last_active))
                     - out_buffer_len
@@ -2143,16 +2386,17 @@ class NetworkThread(Thread):
         """Reads file messages from the input buffer of a 'F' connection."""
 
         in_buffer = conn.in_buffer
-        idx = 0
+        idx = conn.in_buffer_offset
+        msg_size = 0
 
         if conn not in self._file_init_msgs:
-            idx = self._process_file_init_message(conn, in_buffer)
+            msg_size = self._process_file_init_message(conn, in_buffer, idx)
 
         elif conn in self._file_upload_msgs:
-            idx = self._process_file_offset_message(conn, in_buffer)
+            msg_size = self._process_file_offset_message(conn, in_buffer, idx)
 
-        if idx:
-            del in_buffer[:idx]
+        if msg_size:
+            conn.consume_in_buffer(idx + msg_size)
             conn.has_post_init_activity = True
 
     def _process_file_output(self, conn, msg):
@@ -2489,9 +2733,9 @@ class NetworkThread(Thread):
         """Reads messages from the input buffer of a 'D' connection."""
 
         in_buffer = conn.in_buffer
-        buffer_len = len(in_buffer)
+        idx = conn.in_buffer_offset
+        buffer_len = len(in_buffer) - idx
         msg_content_offset = 5
-        idx = 0
 
         # Distributed messages are 5 bytes or greater in length
         while buffer_len >= msg_content_offset:
@@ -2527,8 +2771,8 @@ class NetworkThread(Thread):
             idx += msg_size_total
             buffer_len -= msg_size_total
 
-        if idx:
-            del in_buffer[:idx]
+        if idx > conn.in_buffer_offset:
+            conn.consume_in_buffer(idx)
             conn.has_post_init_activity = True
 
     def _process_distrib_output(self, conn, msg, msg_content=None):
@@ -2628,6 +2872,7 @@ class NetworkThread(Thread):
         if (self._download_limit_split
                 and conn in self._conns_downloaded
                 and self._conns_downloaded[conn] >= self._download_limit_split):
+            self._pause_socket_events(sock)
             return
 
         conn_error = None
@@ -2673,6 +2918,7 @@ class NetworkThread(Thread):
         if (self._upload_limit_split
                 and conn in self._conns_uploaded
                 and self._conns_uploaded[conn] >= self._upload_limit_split):
+            self._pause_socket_events(sock)
             return
 
         try:
@@ -2685,16 +2931,16 @@ class NetworkThread(Thread):
 
         self._close_connection(conn)
 
-    def _process_ready_sockets(self, current_time):
-
-        if self._listen_socket is None:
-            # We can't call select() when no sockets are registered (WinError 10022)
-            return
+    def _process_ready_sockets(self, current_time, timeout):
 
-        for key, io_events in self._selector.select(timeout=self.SLEEP_MAX_IDLE):
+        for key, io_events in self._selector.select(timeout=timeout):
             sock = key.fileobj
 
             if io_events & selectors.EVENT_READ:
+                if sock is self._wakeup_socket:
+                    self._clear_wakeup()
+                    continue
+
                 if sock is self._listen_socket:
                     self._accept_incoming_peer_connections()
                     continue
@@ -2813,12 +3059,20 @@ class NetworkThread(Thread):
             if current_recv_size > download_limit:  # pylint: disable=consider-using-min-builtin
                 current_recv_size = download_limit
 
-        data = sock.recv(current_recv_size)
-        data_len = len(data)
+        recv_buffer = self._recv_buffer
 
-        if not data:
+        if recv_buffer is None or len(recv_buffer) < current_recv_size:
+            # Data is consumed before the next read, so a single buffer can be reused for all
+            # connections. Only allocate a new one when a connection needs a larger one.
+            self._recv_buffer = recv_buffer = memoryview(bytearray(current_recv_size))
+
+        data_len = sock.recv_into(recv_buffer, current_recv_size)
+
+        if not data_len:
             return False  # Close the connection
 
+        data = recv_buffer[:data_len]
+
         # An intermediate buffer is useless when downloading a file. Write to the
         # file immediately, and let the OS handle buffering when necessary.
         if not is_file_download:
@@ -2844,26 +3098,42 @@ class NetworkThread(Thread):
 
         sock = conn.sock
         out_buffer = conn.out_buffer
-        is_file_upload = (conn in self._file_upload_msgs)
+        file_upload = self._file_upload_msgs.get(conn)
+        is_file_upload = (file_upload is not None)
+        is_sending_file = False
+        limit = None
 
         if is_file_upload and self._upload_limit_split:
             limit = (self._upload_limit_split - self._conns_uploaded[conn])
 
-            if len(out_buffer) > limit:
+        if (is_file_upload and not out_buffer and file_upload.offset is not None
+                and self._is_sendfile_upload(conn)):
+            num_bytes_sent = self._send_upload_file(conn, file_upload, limit)
+
+            if num_bytes_sent is None:
+                return False  # Close the connection
+
+            is_sending_file = self._is_sendfile_upload(conn)
+
+        else:
+            if limit is not None and len(out_buffer) > limit:
                 num_bytes_sent = sock.send(memoryview(out_buffer)[:limit])
             else:
                 num_bytes_sent = sock.send(out_buffer)
 
-            self._conns_uploaded[conn] += num_bytes_sent
-        else:
-            num_bytes_sent = sock.send(out_buffer)
+            del out_buffer[:num_bytes_sent]
 
-        del out_buffer[:num_bytes_sent]
+        if limit is not None:
+            self._conns_uploaded[conn] += num_bytes_sent
 
         if is_file_upload and not self._process_upload(conn, num_bytes_sent, current_time):
             return False  # Close the connection
 
-        if not out_buffer:
+        if is_sending_file:
+            # Keep watching connection for writes until the whole file is sent
+            is_sending_file = (file_upload.offset + file_upload.sentbytes) < file_upload.size
+
+        if not out_buffer and not is_sending_file:
             # Nothing else to send, stop watching connection for writes
             self._modify_connection_events(conn, selectors.EVENT_READ)
 
@@ -2877,7 +3147,8 @@ class NetworkThread(Thread):
         while not self._want_abort:
             current_time = time.monotonic()
 
-            if (current_time - self._last_cycle_time) >= 1:
+            if (current_time - self._last_cycle_time) >= self.CYCLE_INTERVAL:
+                self._resume_socket_events()
                 self._check_connections(current_time)
                 self._check_indirect_request_timeouts(current_time)
 
@@ -2896,25 +3167,35 @@ class NetworkThread(Thread):
 
                 self._last_cycle_time = current_time
 
+            # Process messages parsed by the worker thread
+            self._process_parsed_peer_messages()
+
+            # Sleep until the next cycle, unless woken up earlier
+            timeout = (self._last_cycle_time + self.CYCLE_INTERVAL - current_time)
+
             if not self._should_process_queue:
-                if self._server_timeout_time and (self._server_timeout_time - current_time) <= 0:
-                    self._server_timeout_time = None
-                    events.emit_main_thread(
-                        "server-reconnect",
-                        ServerReconnect(manual_reconnect=self._manual_server_reconnect)
-                    )
+                if self._server_timeout_time:
+                    server_timeout = (self._server_timeout_time - current_time)
 
-                time.sleep(self.SLEEP_MAX_IDLE + self.SLEEP_MIN_IDLE)
+                    if server_timeout <= 0:
+                        self._server_timeout_time = None
+                        events.emit_main_thread(
+                            "server-reconnect",
+                            ServerReconnect(manual_reconnect=self._manual_server_reconnect)
+                        )
+                        continue
+
+                    timeout = min(timeout, server_timeout)
+
+                # Only the wakeup socket is registered at this point
+                self._process_ready_sockets(current_time, timeout)
                 continue
 
             # Process queue messages
             self._process_queue_messages()
 
-            # Check which connections are ready to send/receive data
-            self._process_ready_sockets(current_time)
-
-            # Don't exhaust the CPU
-            time.sleep(self.SLEEP_MIN_IDLE)
+            # Wait until connections are ready to send/receive data, or messages are queued
+            self._process_ready_sockets(current_time, timeout)
 
     def run(self):
 
@@ -2923,6 +3204,8 @@ class NetworkThread(Thread):
         # Watch sockets for I/0 readiness with the selectors module. Only call register() after a socket
         # is bound, otherwise watching the socket not guaranteed to work (breaks on OpenBSD at least)
         self._selector = selectors.DefaultSelector()
+        self._create_wakeup_socket()
+        self._message_parse_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MessageParser")
 
         try:
             self._loop()
@@ -2931,7 +3214,11 @@ class NetworkThread(Thread):
             # Networking thread aborted
             self._manual_server_disconnect = True
             self._close_connection(self._server_conn)
+            self._close_wakeup_socket()
             self._selector.close()
 
+            # Messages parsed after this point are dropped
+            self._message_parse_pool.shutdown(wait=False, cancel_futures=True)
+
             # We're ready to quit
             events.emit_main_thread("quit")
@@ -0,0 +1,366 @@
+# SPDX-FileCopyrightText: 2026 Nicotine+ Contributors
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Benchmark for serving incoming search requests, without a network
+connection.
+
+Generates a synthetic share of audio files with tags, builds the share
+store using the regular scanner, and replays a mix of search requests
+through the search code. Responses are packed, but not sent.
+
+Usage: python3 -m pynicotine.tests.benchmarks.search_benchmark --num-files 100000
+"""
+
+import argparse
+import os
+import random
+import shutil
+import struct
+import sys
+import time
+
+from pynicotine.config import config
+from pynicotine.core import core
+from pynicotine.events import events
+from pynicotine.search import SearchRequestStatistics
+from pynicotine.slskmessages import FileSearchResponse
+
+CURRENT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
+DATA_FOLDER_PATH = os.path.join(CURRENT_FOLDER_PATH, "temp_data")
+SHARES_FOLDER_PATH = os.path.join(CURRENT_FOLDER_PATH, "temp_shares")
+SYLLABLES = (
+    "ba", "be", "bo", "da", "de", "di", "do", "ka", "ke", "ki", "ko", "la", "le", "li", "lo", "lu", "ma",
+    "me", "mi", "mo", "na", "ne", "ni", "no", "ra", "re", "ri", "ro", "sa", "se", "si", "so", "ta", "te",
+    "ti", "to", "va", "ve", "vi", "vo", "za", "ze", "zo"
+)
+GENRES = ("Ambient", "Blues", "Classical", "Electronic", "Folk", "Hip-Hop", "Jazz", "Metal", "Pop", "Rock")
+TRACKS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 4
+QUERY_TYPES = ("common", "multi", "excluded", "partial", "missing")
+
+
+class SyntheticShares:
+    """Writes a folder tree of small audio files, containing only the
+    headers needed to read their duration, bitrate, sample rate and bit
+    depth."""
+
+    def __init__(self, num_files, seed):
+
+        self.num_files = num_files
+        self.random = random.Random(seed)
+
+        # Word frequencies follow a power law, like in real file names
+        vocabulary_size = max(num_files // 20, 500)
+        self.vocabulary = sorted({self._create_word() for _ in range(vocabulary_size)})
+        self.word_weights = [1 / (rank + 1) for rank in range(len(self.vocabulary))]
+        self.titles = []
+
+    def _create_word(self):
+        return "".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(2, 4)))
+
+    def _create_phrase(self, min_words, max_words):
+
+        num_words = self.random.randint(min_words, max_words)
+        return " ".join(self.random.choices(self.vocabulary, weights=self.word_weights, k=num_words))
+
+    @staticmethod
+    def _write_mp3(file_path, bitrate, duration):
+        """MPEG-1 Layer III frame with a Xing header (VBR)."""
+
+        frame_length = (144 * 128000) // 44100
+        num_frames = int(duration * 44100 / 1152)
+        num_bytes = (bitrate * 1000 // 8 * duration)
+        frame = b"\xFF\xFB\x90\x64" + bytes(32) + b"Xing" + struct.pack(">III", 3, num_frames, num_bytes)
+
+        with open(file_path, "wb") as file_handle:
+            file_handle.write(frame + bytes(frame_length - len(frame)))
+
+    @staticmethod
+    def _write_flac(file_path, samplerate, bitdepth, duration):
+        """FLAC stream with only a STREAMINFO metadata block."""
+
+        channels = 2
+        stream_info = (
+            (samplerate << 44) | ((channels - 1) << 41) | ((bitdepth - 1) << 36) | (samplerate * duration))
+        block = struct.pack(">HH", 4096, 4096) + bytes(6) + stream_info.to_bytes(8, "big") + bytes(16)
+
+        with open(file_path, "wb") as file_handle:
+            file_handle.write(b"fLaC" + b"\x80" + len(block).to_bytes(3, "big") + block)
+
+    @staticmethod
+    def _write_wav(file_path, samplerate, bitdepth, duration):
+        """WAV header with a data chunk size, but no audio data."""
+
+        channels = 2
+        byte_rate = (samplerate * channels * bitdepth // 8)
+        data_size = (byte_rate * duration)
+
+        with open(file_path, "wb") as file_handle:
+            file_handle.write(b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE")
+            file_handle.write(b"fmt " + struct.pack(
+                "<IHHIIHH", 16, 1, channels, samplerate, byte_rate, channels * bitdepth // 8, bitdepth))
+            file_handle.write(b"data" + struct.pack("<I", data_size))
+
+    def _write_track(self, folder_path, track_number, artist):
+
+        title = self._create_phrase(1, 4)
+        duration = self.random.randint(90, 600)
+        file_type = self.random.choices(("mp3", "flac", "wav"), weights=(70, 25, 5))[0]
+        basename = f"{track_number:02d} - {artist} - {title}.{file_type}"
+        file_path = os.path.join(folder_path, basename)
+
+        if file_type == "mp3":
+            self._write_mp3(file_path, self.random.choice((128, 192, 245, 256, 320)), duration)
+
+        elif file_type == "flac":
+            self._write_flac(
+                file_path, self.random.choice((44100, 48000, 96000)), self.random.choice((16, 24)), duration)
+
+        else:
+            self._write_wav(file_path, 44100, 16, duration)
+
+        self.titles.append((artist, title))
+
+    def write(self, folder_path):
+
+        num_written = 0
+        artist_number = 0
+
+        while num_written < self.num_files:
+            artist = self._create_phrase(1, 2).title()
+            genre = GENRES[artist_number % len(GENRES)]
+            artist_number += 1
+
+            for _ in range(ALBUMS_PER_ARTIST):
+                album = self._create_phrase(1, 3).title()
+                year = self.random.randint(1960, 2025)
+                album_folder_path = os.path.join(folder_path, genre, artist, f"{year} - {album}")
+                os.makedirs(album_folder_path, exist_ok=True)
+
+                # Non-audio files without metadata
+                for basename in ("cover.jpg", f"{artist} - {album}.cue"):
+                    with open(os.path.join(album_folder_path, basename), "wb"):
+                        pass
+
+                num_written += 2
+
+                for track_number in range(1, TRACKS_PER_ALBUM + 1):
+                    self._write_track(album_folder_path, track_number, artist)
+                    num_written += 1
+
+                if num_written >= self.num_files:
+                    break
+
+    def create_queries(self, num_queries):
+        """Returns a mix of search terms of different types."""
+
+        queries = []
+
+        for query_number in range(num_queries):
+            query_type = QUERY_TYPES[query_number % len(QUERY_TYPES)]
+            artist, title = self.random.choice(self.titles)
+            words = title.split()
+
+            if query_type == "common":
+                # Among the most common words in file names
+                term = self.vocabulary[self.random.randrange(min(10, len(self.vocabulary)))]
+
+            elif query_type == "multi":
+                term = f"{artist} {title}"
+
+            elif query_type == "excluded":
+                term = f"{words[0]} -{self.random.choice(self.vocabulary)}"
+
+            elif query_type == "partial":
+                term = f"{words[0]} *{self.random.choice(self.vocabulary)[-3:]}"
+
+            else:
+                term = f"{self._create_word()}x {words[0]}"
+
+            queries.append((query_type, term))
+
+        return queries
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of the process and its waited-for
+    child processes, in MiB."""
+
+    try:
+        import resource
+
+    except ImportError:
+        # Not available on Windows
+        return None, None
+
+    # Kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+
+    return tuple(
+        resource.getrusage(who).ru_maxrss * unit / 1048576
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+
+def format_percentiles(percentiles):
+
+    if percentiles is None:
+        return "-"
+
+    return " / ".join(f"{duration:.3f}" for duration in percentiles.values())
+
+
+class SearchBenchmark:
+
+    def __init__(self, arguments):
+
+        self.arguments = arguments
+        self.shares_ready = False
+        self.request_start_times = {}
+        self.response_latencies = []
+        self.pack_latencies = []
+        self.num_responses = 0
+        self.num_results = 0
+
+    def _shares_ready(self, _successful):
+        self.shares_ready = True
+
+    def _queue_network_message(self, msg):
+        """Replaces sending messages to the network thread."""
+
+        if not isinstance(msg, FileSearchResponse):
+            return
+
+        start_time = time.perf_counter()
+        msg.make_network_message()
+        end_time = time.perf_counter()
+
+        self.pack_latencies.append(end_time - start_time)
+        self.response_latencies.append(end_time - self.request_start_times.pop(msg.token))
+        self.num_responses += 1
+        self.num_results += len(msg.list) + len(msg.privatelist or ())
+
+    @staticmethod
+    def _process_events_until(condition):
+
+        while not condition():
+            events.process_thread_events()
+            time.sleep(0.0005)
+
+    def build_shares(self):
+
+        synthetic_shares = SyntheticShares(self.arguments.num_files, self.arguments.seed)
+        shutil.rmtree(SHARES_FOLDER_PATH, ignore_errors=True)
+
+        start_time = time.perf_counter()
+        synthetic_shares.write(SHARES_FOLDER_PATH)
+        print(f"Wrote synthetic shares in {time.perf_counter() - start_time:.1f} s")
+
+        # Shares are scanned on startup
+        config.sections["transfers"]["shared"] = [("Music", SHARES_FOLDER_PATH)]
+        config.sections["transfers"]["rescanonstartup"] = True
+
+        start_time = time.perf_counter()
+        core.start()
+        self._process_events_until(lambda: self.shares_ready)
+
+        num_files = core.shares.share_store.get_num_files()
+        store_size = os.path.getsize(core.shares.share_store_path) / 1048576
+
+        print(f"Scanned {num_files} files in {time.perf_counter() - start_time:.1f} s, "
+              f"share store size: {store_size:.1f} MiB")
+
+        return synthetic_shares
+
+    def replay_queries(self, queries):
+
+        search = core.search
+        max_pending = max(config.sections["searches"]["search_request_threads"] * 2, 1)
+
+        search.search_request_statistics.clear()
+        start_time = time.perf_counter()
+
+        # pylint: disable=protected-access
+        for token, (_query_type, search_term) in enumerate(queries, start=1):
+            if not self.arguments.cache:
+                search._clear_search_response_cache()
+
+            self.request_start_times[token] = time.perf_counter()
+            search._process_search_request(search_term, "benchmark_user", token)
+
+            self._process_events_until(lambda: search._num_pending_search_requests < max_pending)
+
+        self._process_events_until(lambda: not search._num_pending_search_requests)
+        return time.perf_counter() - start_time
+
+    def report(self, queries, duration):
+
+        statistics = core.search.search_request_statistics.as_dict()
+        counters = statistics["counters"]
+        peak_rss, peak_scanner_rss = get_peak_rss()
+
+        print(f"\n{len(queries)} search requests ({', '.join(QUERY_TYPES)}) in {duration:.2f} s, "
+              f"{len(queries) / duration:.0f} requests per second")
+        print(f"{self.num_responses} responses, {self.num_results} results, "
+              f"{counters['unmatched_words']} rejected early, {counters['cache_hits']} cache hits")
+
+        print("\nLatency in milliseconds (50th / 90th / 99th percentile):")
+
+        for stage, durations in statistics["latencies"].items():
+            print(f"  {stage:<10} {format_percentiles(durations)}")
+
+        print(f"  {'pack':<10} {format_percentiles(SearchRequestStatistics.get_percentiles(self.pack_latencies))}")
+        print(f"  {'response':<10} "
+              f"{format_percentiles(SearchRequestStatistics.get_percentiles(self.response_latencies))}")
+
+        if peak_rss is not None:
+            print(f"\nPeak RSS: {peak_rss:.1f} MiB (scanner process: {peak_scanner_rss:.1f} MiB)")
+
+    def run(self):
+
+        arguments = self.arguments
+
+        config.set_data_folder(DATA_FOLDER_PATH)
+        config.set_config_file(os.path.join(DATA_FOLDER_PATH, "temp_config"))
+
+        core.init_components(enabled_components={
+            "pluginhandler", "shares", "users", "network_filter", "buddies", "search", "uploads"
+        })
+        events.connect("shares-ready", self._shares_ready)
+        events.connect("queue-network-message", self._queue_network_message)
+        core.users.login_username = "benchmark"
+
+        searches_config = config.sections["searches"]
+        searches_config["search_results"] = True
+        searches_config["maxresults"] = arguments.max_results
+        searches_config["min_search_chars"] = 0
+        searches_config["search_request_threads"] = arguments.threads
+        searches_config["user_search_work_rate"] = searches_config["total_search_work_rate"] = 0
+
+        try:
+            synthetic_shares = self.build_shares()
+            queries = synthetic_shares.create_queries(arguments.num_queries)
+            duration = self.replay_queries(queries)
+            self.report(queries, duration)
+
+        finally:
+            core.quit()
+            shutil.rmtree(DATA_FOLDER_PATH, ignore_errors=True)
+            shutil.rmtree(SHARES_FOLDER_PATH, ignore_errors=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark serving incoming search requests")
+    parser.add_argument("--num-files", type=int, default=10000, help="number of shared files (default: 10000)")
+    parser.add_argument("--num-queries", type=int, default=5000, help="number of search requests (default: 5000)")
+    parser.add_argument("--max-results", type=int, default=100, help="results per response (default: 100)")
+    parser.add_argument("--threads", type=int, default=2, help="search request threads (default: 2)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for synthetic shares and queries")
+    parser.add_argument("--cache", action="store_true", help="enable the search response cache")
+
+    SearchBenchmark(parser.parse_args()).run()
+
+
+if __name__ == "__main__":
+    main()
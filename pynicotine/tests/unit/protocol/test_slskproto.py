@@ -2,13 +2,19 @@
 # SPDX-FileCopyrightText: 2020 Lene Preuss <lene.preuss@gmail.com>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import errno
 import os
 import pickle
 import selectors
 import shutil
 import socket
+import struct
 import sys
+import tempfile
+import time
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from unittest import TestCase
 from unittest.mock import MagicMock
@@ -18,7 +24,15 @@ from unittest.mock import patch
 from pynicotine.config import config
 from pynicotine.core import core
 from pynicotine.events import events
+from pynicotine.slskmessages import ConnectionType
+from pynicotine.slskmessages import PEER_MESSAGE_CODES
 from pynicotine.slskmessages import ServerConnect, SetWaitPort
+from pynicotine.slskmessages import SharedFileListResponse
+from pynicotine.slskmessages import UploadFile
+from pynicotine.slskmessages import UserInfoRequest
+from pynicotine.slskproto import Connection
+from pynicotine.slskproto import NetworkThread
+from pynicotine.slskproto import PeerConnection
 from pynicotine.utils import encode_path
 
 DATA_FOLDER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "temp_data")
@@ -59,6 +73,326 @@ class MockSocket(Mock):
         return b""
 
 
+class ConnectionTest(TestCase):
+
+    def test_consume_in_buffer(self):
+
+        conn = Connection()
+        conn.in_buffer += b"a" * 10 + b"b" * 90
+
+        # Keep large unprocessed data in place
+        conn.consume_in_buffer(10)
+        self.assertEqual(conn.in_buffer_offset, 10)
+        self.assertEqual(len(conn.in_buffer), 100)
+
+        # Remove processed data once it's at least as large as the remaining data
+        conn.consume_in_buffer(60)
+        self.assertEqual(conn.in_buffer_offset, 0)
+        self.assertEqual(conn.in_buffer, b"b" * 40)
+
+        conn.consume_in_buffer(40)
+        self.assertEqual(conn.in_buffer_offset, 0)
+        self.assertEqual(conn.in_buffer, b"")
+
+
+class NetworkThreadWakeupTest(TestCase):
+
+    def setUp(self):
+
+        with patch("pynicotine.slskproto.events"):
+            self.network_thread = NetworkThread()
+
+        self.network_thread._selector = selectors.SelectSelector()   # pylint: disable=protected-access
+        self.network_thread._create_wakeup_socket()                  # pylint: disable=protected-access
+        self.network_thread._should_process_queue = True             # pylint: disable=protected-access
+
+    def tearDown(self):
+
+        # pylint: disable=protected-access
+        self.network_thread._close_wakeup_socket()
+        self.network_thread._selector.close()
+
+    def test_wake_up_while_clearing(self):
+        """Verify that messages queued while the network thread clears a
+        wakeup still wake up the network thread, instead of waiting for the
+        cycle timeout."""
+
+        # pylint: disable=protected-access
+        network_thread = self.network_thread
+        wakeup_socket = network_thread._wakeup_socket
+
+        def recv(bufsize):
+            data = wakeup_socket.recv(bufsize)
+
+            if data:
+                # Main thread queues a message while the wakeup socket is read
+                network_thread._queue_network_message(SetWaitPort(1))
+
+            return data
+
+        network_thread._queue_network_message(SetWaitPort(2))
+        self.assertEqual(len(network_thread._selector.select(timeout=0)), 1)
+
+        network_thread._wakeup_socket = Mock(recv=recv)
+        network_thread._clear_wakeup()
+        network_thread._wakeup_socket = wakeup_socket
+
+        # Both messages are processed before the next select() call
+        self.assertEqual(network_thread._message_queue.qsize(), 2)
+        self.assertEqual(network_thread._selector.select(timeout=0), [])
+
+        with patch.object(network_thread, "_process_outgoing_messages") as process_outgoing_messages:
+            network_thread._process_queue_messages()
+
+        self.assertEqual(len(process_outgoing_messages.call_args.args[0]), 2)
+
+        # Messages queued later wake up the network thread immediately
+        network_thread._queue_network_message(SetWaitPort(3))
+        self.assertEqual(len(network_thread._selector.select(timeout=0)), 1)
+
+
+class FileUploadTest(TestCase):
+
+    FILE_CONTENT = bytes(range(256)) * 40
+    OFFSET = 1000
+
+    def setUp(self):
+
+        for patcher in (
+            patch("pynicotine.slskproto.os.sendfile", create=True),
+            patch.object(NetworkThread, "SENDFILE_SUPPORTED", True)
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        events_patcher = patch("pynicotine.slskproto.events")
+        self.mock_events = events_patcher.start()
+        self.addCleanup(events_patcher.stop)
+
+        self.network_thread = NetworkThread()
+        self.network_thread._selector = Mock()  # pylint: disable=protected-access
+        self.sent_data = bytearray()
+
+        file_handle = self.file_handle = tempfile.TemporaryFile()
+        file_handle.write(self.FILE_CONTENT)
+        file_handle.seek(self.OFFSET)
+        self.addCleanup(file_handle.close)
+
+        sock = Mock()
+        sock.fileno.return_value = 100
+        sock.send.side_effect = self._send
+
+        self.conn = PeerConnection(
+            sock=sock, io_events=(selectors.EVENT_READ | selectors.EVENT_WRITE), init=Mock(target_user="user"))
+        self.file_upload = UploadFile(
+            sock=sock, token=1, file=file_handle, size=len(self.FILE_CONTENT), offset=self.OFFSET)
+        self.network_thread._file_upload_msgs[self.conn] = self.file_upload  # pylint: disable=protected-access
+
+    def _send(self, data):
+
+        data = bytes(data[:3000])
+        self.sent_data += data
+        return len(data)
+
+    def _sendfile(self, out_fd, in_fd, offset, count):
+
+        self.assertEqual(out_fd, 100)
+        self.assertEqual(in_fd, self.file_handle.fileno())
+
+        data = self.FILE_CONTENT[offset:offset + min(count, 4096)]
+        self.sent_data += data
+        return len(data)
+
+    def _write_file(self):
+
+        for _ in range(100):
+            if not self.network_thread._write_data(self.conn, time.monotonic()):  # pylint: disable=protected-access
+                break
+
+            if self.conn.io_events == selectors.EVENT_READ:
+                # Upload finished
+                break
+
+    def test_sendfile_upload(self):
+        """Verify that file uploads are sent directly from the file with
+        sendfile(), and that progress is accounted for."""
+
+        # pylint: disable=no-member,protected-access
+        os.sendfile.side_effect = self._sendfile
+        self._write_file()
+
+        self.assertEqual(
+            [call.args[2:] for call in os.sendfile.call_args_list],
+            [(1000, 9240), (5096, 5144), (9192, 1048)]
+        )
+        self.assertEqual(self.sent_data, self.FILE_CONTENT[self.OFFSET:])
+        self.assertEqual(self.conn.out_buffer, b"")
+        self.conn.sock.send.assert_not_called()
+
+        self.assertEqual(self.file_upload.sentbytes, 9240)
+        self.assertEqual(self.file_upload.speed, 9240)
+        self.assertEqual(self.network_thread._total_upload_bandwidth, 9240)
+        self.mock_events.emit_main_thread.assert_called_once_with(
+            "file-upload-progress", username="user", token=1, offset=self.OFFSET, bytes_sent=9240)
+
+    def test_sendfile_fallback(self):
+        """Verify that file uploads fall back to regular reads at the current
+        file position when the file system doesn't support sendfile()."""
+
+        # pylint: disable=no-member,protected-access
+        os.sendfile.side_effect = [
+            self._sendfile(100, self.file_handle.fileno(), self.OFFSET, 2000),
+            OSError(errno.EINVAL, "Invalid argument")
+        ]
+        self._write_file()
+
+        self.assertIn(self.conn, self.network_thread._buffered_file_uploads)
+        self.assertEqual(os.sendfile.call_count, 2)
+        self.conn.sock.send.assert_called()
+        self.assertEqual(self.sent_data, self.FILE_CONTENT[self.OFFSET:])
+        self.assertEqual(self.file_upload.sentbytes, 9240)
+        self.assertEqual(self.file_upload.speed, 9240)
+
+    def test_sendfile_truncated_file(self):
+        """Verify that an upload error is reported when the file is truncated
+        while being sent with sendfile()."""
+
+        # pylint: disable=no-member,protected-access
+        os.sendfile.side_effect = [self._sendfile(100, self.file_handle.fileno(), self.OFFSET, 2000), 0]
+
+        self.assertTrue(self.network_thread._write_data(self.conn, time.monotonic()))
+        self.assertFalse(self.network_thread._write_data(self.conn, time.monotonic()))
+
+        self.assertEqual(self.file_upload.sentbytes, 2000)
+        (event_name, *_args), kwargs = self.mock_events.emit_main_thread.call_args
+
+        self.assertEqual(event_name, "upload-file-error")
+        self.assertEqual(kwargs["username"], "user")
+        self.assertEqual(kwargs["token"], 1)
+        self.assertEqual(kwargs["error"].errno, errno.ENODATA)
+
+    def test_sendfile_errors(self):
+        """Verify that file read errors during sendfile() are reported as
+        upload errors, while socket errors are left to the caller."""
+
+        # pylint: disable=no-member,protected-access
+        os.sendfile.side_effect = OSError(errno.EIO, "Input/output error")
+
+        self.assertFalse(self.network_thread._write_data(self.conn, time.monotonic()))
+        self.mock_events.emit_main_thread.assert_called_once_with(
+            "upload-file-error", username="user", token=1, error=os.sendfile.side_effect)
+
+        self.mock_events.emit_main_thread.reset_mock()
+        os.sendfile.side_effect = BrokenPipeError(errno.EPIPE, "Broken pipe")
+
+        with self.assertRaises(BrokenPipeError):
+            self.network_thread._write_data(self.conn, time.monotonic())
+
+        self.mock_events.emit_main_thread.assert_not_called()
+
+    def test_sendfile_upload_limit(self):
+        """Verify that file uploads sent with sendfile() respect the upload
+        speed limit of each connection."""
+
+        # pylint: disable=no-member,protected-access
+        os.sendfile.side_effect = self._sendfile
+        self.network_thread._upload_limit_split = 1500
+
+        self.assertTrue(self.network_thread._write_data(self.conn, time.monotonic()))
+        self.assertTrue(self.network_thread._write_data(self.conn, time.monotonic()))
+
+        os.sendfile.assert_called_once_with(100, self.file_handle.fileno(), self.OFFSET, 1500)
+        self.assertEqual(self.network_thread._conns_uploaded[self.conn], 1500)
+        self.assertEqual(self.file_upload.sentbytes, 1500)
+
+        # Connection is watched for writes until the next cycle resets the limit
+        self.assertEqual(self.conn.io_events, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+
+class PeerMessageWorkerTest(TestCase):
+
+    def setUp(self):
+
+        events_patcher = patch("pynicotine.slskproto.events")
+        self.mock_events = events_patcher.start()
+        self.addCleanup(events_patcher.stop)
+
+        # pylint: disable=protected-access
+        self.network_thread = NetworkThread()
+        self.network_thread._message_parse_pool = ThreadPoolExecutor(max_workers=1)
+        self.network_thread._allowed_message_responses[SharedFileListResponse].add("user")
+        self.addCleanup(self.network_thread._message_parse_pool.shutdown)
+
+        sock = Mock()
+        init = Mock(target_user="user", conn_type=ConnectionType.PEER, sock=sock)
+        self.conn = PeerConnection(sock=sock, addr=("127.0.0.1", 2234), init=init)
+
+    @staticmethod
+    def _pack_peer_message(msg_class, msg_content):
+        return struct.pack("<II", len(msg_content) + 4, PEER_MESSAGE_CODES[msg_class]) + msg_content
+
+    def _pack_share_list(self, folder_path):
+        return zlib.compress(
+            SharedFileListResponse.pack_uint32(1) + SharedFileListResponse.pack_string(folder_path)
+            + SharedFileListResponse.pack_uint32(0)
+        )
+
+    def _get_emitted_messages(self):
+        return [
+            (call.args[0], call.args[1]) for call in self.mock_events.emit_main_thread.call_args_list
+            if call.args[0] in {"shared-file-list-response", "user-info-request"}
+        ]
+
+    def test_parse_large_share_list(self):
+        """Verify that large share lists are parsed in a worker thread, and
+        that later messages on the same connection are processed in order
+        once the worker thread is done."""
+
+        # pylint: disable=protected-access
+        network_thread = self.network_thread
+        folder_path = os.urandom(65536).hex()
+        share_list = self._pack_share_list(folder_path)
+        self.assertGreaterEqual(len(share_list), network_thread.MIN_WORKER_PARSE_MESSAGE_SIZE)
+
+        self.conn.in_buffer += (
+            self._pack_peer_message(SharedFileListResponse, share_list)
+            + self._pack_peer_message(UserInfoRequest, b"")
+        )
+        network_thread._process_peer_input(self.conn)
+
+        # Wait for the worker thread. Parsed messages are only emitted by the network thread.
+        network_thread._message_parse_pool.shutdown()
+        self.assertEqual(self._get_emitted_messages(), [])
+
+        network_thread._process_parsed_peer_messages()
+        (event_name, msg), (next_event_name, _next_msg) = self._get_emitted_messages()
+
+        self.assertEqual(event_name, "shared-file-list-response")
+        self.assertEqual(next_event_name, "user-info-request")
+        self.assertEqual(msg.list, [(folder_path, [])])
+        self.assertEqual(msg.username, "user")
+        self.assertEqual(self.conn.in_buffer, b"")
+        self.assertFalse(network_thread._parsing_peer_conns)
+
+    def test_parse_small_share_list(self):
+        """Verify that small share lists are parsed by the network thread."""
+
+        # pylint: disable=protected-access
+        network_thread = self.network_thread
+        share_list = self._pack_share_list("Music")
+
+        self.conn.in_buffer += self._pack_peer_message(SharedFileListResponse, share_list)
+
+        with patch.object(network_thread, "_message_parse_pool") as message_parse_pool:
+            network_thread._process_peer_input(self.conn)
+
+        message_parse_pool.submit.assert_not_called()
+        (event_name, msg), = self._get_emitted_messages()
+
+        self.assertEqual(event_name, "shared-file-list-response")
+        self.assertEqual(msg.list, [("Music", [])])
+
+
 class SoulseekNetworkTest(TestCase):
 
     def setUp(self):
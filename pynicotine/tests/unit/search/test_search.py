@@ -3,15 +3,24 @@
 
 import os
 import shutil
+import time
 
-from collections import UserDict
+from array import array
 from unittest import TestCase
+from unittest.mock import Mock
+from unittest.mock import patch
 
 from pynicotine.config import config
 from pynicotine.core import core
+from pynicotine.events import events
 from pynicotine.search import ResultFilterMode
+from pynicotine.search import SearchRequestStatistics
 from pynicotine.shares import PermissionLevel
+from pynicotine.shares import ShareStore
+from pynicotine.shares import ShareStoreWriter
+from pynicotine.slskmessages import FileListMessage
 from pynicotine.slskmessages import increment_token
+from pynicotine.utils import encode_path
 
 CURRENT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 DATA_FOLDER_PATH = os.path.join(CURRENT_FOLDER_PATH, "temp_data")
@@ -183,7 +192,6 @@ class SearchTest(TestCase):
     def test_create_search_result_list(self):
         """Test creating search result lists from the word index."""
 
-        max_results = 1500
         word_index = {
             "iso": [34, 35, 36, 37, 38],
             "lts": [63, 68, 73],
@@ -195,52 +203,292 @@ class SearchTest(TestCase):
         excluded_words = {"linux", "game"}
         partial_words = {"stem"}
 
-        results = core.search._create_search_result_list(
-            included_words, excluded_words, partial_words, max_results, word_index)
-        self.assertEqual(results, {37, 38})
+        results = core.search._create_search_result_list(included_words, excluded_words, partial_words, word_index)
+        self.assertEqual(list(results), [37, 38])
+
+        included_words = {"iso"}
+        excluded_words = {"system"}
+        partial_words = set()
+
+        results = core.search._create_search_result_list(included_words, excluded_words, partial_words, word_index)
+        self.assertEqual(list(results), [34, 35, 36])
 
         included_words = {"lts", "iso"}
         excluded_words = {"linux", "game", "music", "cd"}
         partial_words = set()
 
-        results = core.search._create_search_result_list(
-            included_words, excluded_words, partial_words, max_results, word_index)
+        results = core.search._create_search_result_list(included_words, excluded_words, partial_words, word_index)
         self.assertIsNone(results)
 
         included_words = {"iso"}
         excluded_words = {"system"}
         partial_words = {"ibberish"}
 
-        results = core.search._create_search_result_list(
-            included_words, excluded_words, partial_words, max_results, word_index)
+        results = core.search._create_search_result_list(included_words, excluded_words, partial_words, word_index)
         self.assertIsNone(results)
 
+    @staticmethod
+    def create_share_store(fileinfos, word_index=None):
+        """Returns a share store of public files. Each file is added to a
+        separate folder, keeping the order of files."""
+
+        file_path = os.path.join(DATA_FOLDER_PATH, "test_shares.dbn")
+        store_writer = ShareStoreWriter(encode_path(file_path))
+
+        for virtual_path, *fileinfo in fileinfos:
+            virtual_folder_path, _separator, basename = virtual_path.rpartition("\\")
+            store_writer.add_folder(
+                PermissionLevel.PUBLIC, virtual_folder_path.replace("\\", os.sep), virtual_folder_path,
+                files=[(FileListMessage.pack_file_info([basename, *fileinfo]), 0, None)]
+            )
+
+        store_writer.close(word_index or {})
+        return ShareStore(encode_path(file_path))
+
     def test_exclude_server_phrases(self):
         """Verify that results containing excluded phrases are not included."""
 
-        core.search.excluded_phrases = ["linux distro", "netbsd"]
-        results = {0, 1, 2, 3, 4, 5}
-        public_share_db = core.shares.share_dbs["public_files"] = UserDict({
-            "real\\isos\\freebsd.iso": ["virtual\\isos\\freebsd.iso", 1000, None, None],
-            "real\\isos\\linux.iso": ["virtual\\isos\\linux.iso", 2000, None, None],
-            "real\\isos\\linux distro.iso": ["virtual\\isos\\linux distro.iso", 3000, None, None],
-            "real\\isos\\Linux Distro.iso": ["virtual\\isos\\Linux Distro.iso", 4000, None, None],
-            "real\\isos\\NetBSD.iso": ["virtual\\isos\\NetBSD.iso", 5000, None, None],
-            "real\\isos\\openbsd.iso": ["virtual\\isos\\openbsd.iso", 6000, None, None]
-        })
-        core.shares.share_dbs["buddy_files"] = core.shares.share_dbs["trusted_files"] = UserDict()
-        core.shares.file_path_index = list(public_share_db)
-
-        for share_db in core.shares.share_dbs.values():
-            share_db.close = lambda: None
-
-        num_results, fileinfos, private_fileinfos = core.search._create_file_info_list(
-            results, max_results=100, permission_level=PermissionLevel.PUBLIC
-        )
-        self.assertEqual(num_results, 3)
-        self.assertEqual(fileinfos, [
+        core.search._set_excluded_phrases(["Linux Distro", "", "netbsd"])
+        results = array("I", range(7))
+        core.shares.close_shares()
+        core.shares.share_store = self.create_share_store([
             ["virtual\\isos\\freebsd.iso", 1000, None, None],
             ["virtual\\isos\\linux.iso", 2000, None, None],
-            ["virtual\\isos\\openbsd.iso", 6000, None, None]
+            ["virtual\\isos\\linux distro.iso", 3000, None, None],
+            ["virtual\\isos\\Linux Distro.iso", 4000, None, None],
+            ["virtual\\isos\\NetBSD.iso", 5000, None, None],
+            ["virtual\\isos\\openbsd.iso", 6000, None, None],
+            ["virtual\\isos\\netbſd.iso", 7000, None, None]     # Not a case variant
+        ])
+
+        num_results, records, private_records = core.search._create_file_record_list(
+            results, max_results=100, permission_level=PermissionLevel.PUBLIC, share_store=core.shares.share_store)
+        self.assertEqual(num_results, 4)
+        self.assertEqual(records, [
+            FileListMessage.pack_file_info(["virtual\\isos\\freebsd.iso", 1000, None, None]),
+            FileListMessage.pack_file_info(["virtual\\isos\\linux.iso", 2000, None, None]),
+            FileListMessage.pack_file_info(["virtual\\isos\\netbſd.iso", 7000, None, None]),
+            FileListMessage.pack_file_info(["virtual\\isos\\openbsd.iso", 6000, None, None])
+        ])
+        self.assertEqual(private_records, [])
+
+        # The configured phrase is logged, not the matched text
+        with patch("pynicotine.search.log") as mock_log:
+            self.assertTrue(core.search._is_excluded_file("virtual\\isos\\LINUX DISTRO.iso"))
+
+        self.assertEqual(mock_log.add_search.call_args.args[1]["phrase"], "Linux Distro")
+
+        # Excluded files don't count towards the maximum number of results
+        num_results, records, private_records = core.search._create_file_record_list(
+            results, max_results=3, permission_level=PermissionLevel.PUBLIC, share_store=core.shares.share_store)
+        self.assertEqual(num_results, 3)
+        self.assertEqual(records, [
+            FileListMessage.pack_file_info(["virtual\\isos\\freebsd.iso", 1000, None, None]),
+            FileListMessage.pack_file_info(["virtual\\isos\\linux.iso", 2000, None, None]),
+            FileListMessage.pack_file_info(["virtual\\isos\\openbsd.iso", 6000, None, None])
         ])
-        self.assertEqual(private_fileinfos, [])
+
+    def test_search_request_queue(self):
+        """Verify that search requests are processed by worker threads, and
+        dropped when too many requests are pending."""
+
+        # Shares finishing loading on startup clear cached responses, wait for them first
+        timeout_time = time.monotonic() + 10
+
+        while core.shares.rescanning:
+            if time.monotonic() > timeout_time:
+                self.fail("Shares did not finish loading")
+
+            time.sleep(0.05)
+            events.process_thread_events()
+
+        core.shares.close_shares()
+        core.shares.share_store = self.create_share_store([])
+        cache_key = (core.search._parse_search_term("iso"), PermissionLevel.PUBLIC, 100, False, False)
+
+        self.assertTrue(core.search._queue_search_request("iso", "user", 1, cache_key, core.shares.share_store))
+        self.assertEqual(core.search._num_pending_search_requests, 1)
+
+        # Wait for the worker thread, and pass the response to the main thread
+        core.search._search_request_pool.shutdown()
+        events.process_thread_events()
+
+        self.assertEqual(core.search._num_pending_search_requests, 0)
+        self.assertEqual(core.search._search_response_cache, {cache_key: (0, None, None)})
+        self.assertEqual(len(core.search.search_request_statistics.latencies["intersect"]), 1)
+
+        # Cached responses are cleared once shares are rescanned
+        events.emit("shares-ready", True)
+        self.assertEqual(core.search._search_response_cache, {})
+
+        core.search._num_pending_search_requests = config.sections["searches"]["max_pending_search_requests"]
+
+        self.assertFalse(core.search._queue_search_request("iso", "user", 2, cache_key, core.shares.share_store))
+        self.assertEqual(core.search.search_request_statistics.counters["dropped"], 1)
+
+    def test_outdated_search_response(self):
+        """Verify that search responses are dropped if shares changed while
+        looking up results, since file indices differ between share stores."""
+
+        search = core.search
+        search.search_request_statistics.clear()
+        search._search_response_cache.clear()
+
+        share_store = Mock()
+        cache_key = (search._parse_search_term("iso"), PermissionLevel.PUBLIC, 100, False, False)
+        search_response = (1, [b"record"], [])
+        generation = search._search_response_cache_generation
+        search._num_pending_search_requests = 3
+
+        with patch.object(type(search), "_send_search_response") as mock_send_search_response:
+            # Shares were rescanned
+            with patch.object(core.shares, "share_store", Mock()):
+                search._search_results_found("iso", "user", 1, cache_key, share_store, generation, search_response)
+
+            with patch.object(core.shares, "share_store", share_store):
+                # Excluded phrases changed
+                search._search_results_found("iso", "user", 2, cache_key, share_store, generation - 1, search_response)
+
+                # Unchanged
+                search._search_results_found("iso", "user", 3, cache_key, share_store, generation, search_response)
+
+        self.assertEqual(search.search_request_statistics.counters["outdated"], 2)
+        self.assertEqual(search._num_pending_search_requests, 0)
+        self.assertEqual(search._search_response_cache, {cache_key: search_response})
+        mock_send_search_response.assert_called_once_with("iso", "user", 3, *search_response)
+
+    def test_rank_search_results(self):
+        """Verify that the highest scoring search results are returned, instead
+        of the first ones in the file index, and that only records of returned
+        results are decoded."""
+
+        share_store = self.create_share_store([
+            ["Music\\Misc\\Old\\artist - other song.mp3", 1000, (128, False, None, None), 200],
+            ["Music\\Misc\\Old\\my song mix.mp3", 1000, (128, False, None, None), 200],
+            ["Music\\Song\\mix.mp3", 1000, (128, False, None, None), 200],
+            ["Music\\Misc\\Old\\song mix.mp3", 1000, (128, False, None, None), 200],
+            ["Music\\Misc\\Old\\mix song.mp3", 1000, (128, False, None, None), 200],
+            ["Music\\Misc\\Old\\song mix.flac", 1000, (1411, False, 44100, 16), 200],
+            ["Music\\song mix.mp3", 1000, (320, False, None, None), 200]
+        ])
+        self.addCleanup(share_store.close)
+
+        # Audio quality first, followed by folder depth. Results with equal scores keep their order.
+        with patch.object(ShareStore, "get_file_record", autospec=True,
+                          side_effect=ShareStore.get_file_record) as mock_get_file_record:
+            ranked_results = core.search._rank_search_results(range(7), max_results=5, share_store=share_store)
+
+        self.assertEqual([index for index, _record in ranked_results], [5, 6, 2, 0, 1])
+        self.assertEqual(ranked_results[0][1], share_store.get_file_record(5))
+        self.assertEqual(mock_get_file_record.call_count, 5)
+
+        ranked_results = core.search._rank_search_results(range(5), max_results=10, share_store=share_store)
+        self.assertEqual([index for index, _record in ranked_results], [2, 0, 1, 3, 4])
+
+    def test_duplicate_search_requests(self):
+        """Verify that copies of a recent search request are detected."""
+
+        core.search._recent_search_requests.clear()
+        core.search.search_request_statistics.clear()
+
+        self.assertFalse(core.search._is_duplicate_search_request("iso", "user", 1))
+        self.assertTrue(core.search._is_duplicate_search_request("iso", "user", 1))
+        self.assertFalse(core.search._is_duplicate_search_request("iso", "user", 2))
+        self.assertFalse(core.search._is_duplicate_search_request("iso", "user2", 1))
+        self.assertFalse(core.search._is_duplicate_search_request("linux iso", "user", 1))
+        self.assertEqual(core.search.search_request_statistics.counters["duplicate"], 1)
+
+        # Requests are forgotten after the time window
+        for request_key in core.search._recent_search_requests:
+            core.search._recent_search_requests[request_key] = 0
+
+        self.assertFalse(core.search._is_duplicate_search_request("iso", "user", 1))
+        self.assertEqual(len(core.search._recent_search_requests), 1)
+
+    def test_search_request_statistics(self):
+        """Verify that counters and latency percentiles of incoming search
+        requests are reported."""
+
+        statistics = SearchRequestStatistics()
+
+        for _ in range(3):
+            statistics.add_request()
+
+        for duration in range(1, 101):
+            statistics.add_latency("fetch", duration / 1000)
+
+        statistics.counters["cache_hits"] += 1
+        search_request_statistics = statistics.as_dict()
+
+        self.assertEqual(search_request_statistics["counters"]["received"], 3)
+        self.assertEqual(search_request_statistics["counters"]["cache_hits"], 1)
+        self.assertEqual(search_request_statistics["requests_per_second"], 3 / statistics.REQUEST_RATE_INTERVAL)
+        self.assertIsNone(search_request_statistics["latencies"]["parse"])
+        fetch_latencies = search_request_statistics["latencies"]["fetch"]
+
+        self.assertEqual({percentile: round(duration) for percentile, duration in fetch_latencies.items()},
+                         {50: 51, 90: 90, 99: 99})
+
+        statistics.clear()
+        self.assertEqual(statistics.as_dict()["counters"]["received"], 0)
+        self.assertEqual(statistics.get_requests_per_second(), 0)
+
+    def test_ignored_search_request_counters(self):
+        """Verify that requests ignored because search results are disabled
+        are counted separately from requests ignored while waiting to quit."""
+
+        statistics = core.search.search_request_statistics
+        statistics.clear()
+
+        config.sections["searches"]["search_results"] = False
+        core.search._process_search_request("iso", "user", 1)
+
+        config.sections["searches"]["search_results"] = True
+
+        with patch.object(core, "uploads", Mock(pending_shutdown=True)):
+            core.search._process_search_request("iso", "user", 2)
+            core.search._process_search_request("iso", "user", 3)
+
+        self.assertEqual(statistics.counters["disabled"], 1)
+        self.assertEqual(statistics.counters["shutting_down"], 2)
+
+    def test_search_work_admission(self):
+        """Verify that search requests are rate limited by estimated work
+        units, per user and for all users."""
+
+        share_store = self.create_share_store(
+            [], word_index={"iso": array("I", range(5000)), "linux": array("I", range(2000))})
+        word_index = share_store.word_index
+        self.addCleanup(share_store.close)
+
+        for search_term, num_units in (
+            ("iso", 6),
+            ("iso linux", 5),
+            ("linux *so", 23)
+        ):
+            self.assertEqual(
+                core.search._estimate_search_work(core.search._parse_search_term(search_term), word_index), num_units)
+
+        config.sections["searches"]["user_search_work_rate"] = 1
+        config.sections["searches"]["total_search_work_rate"] = 2
+
+        # Each budget allows a burst of requests before running out
+        self.assertTrue(core.search._admit_search_request("user", 6))
+        self.assertTrue(core.search._admit_search_request("user", 4))
+        self.assertFalse(core.search._admit_search_request("user", 1))
+
+        self.assertTrue(core.search._admit_search_request("user2", 10))
+        self.assertFalse(core.search._admit_search_request("user3", 1))
+
+        # Requests exceeding the budget are allowed when it is full
+        config.sections["searches"]["total_search_work_rate"] = 0
+
+        self.assertTrue(core.search._admit_search_request("user3", 100))
+        self.assertFalse(core.search._admit_search_request("user3", 1))
+
+        # Budgets of the least recently active users are forgotten once there are too many
+        with patch.object(type(core.search), "USER_SEARCH_WORK_BUDGETS_LIMIT", 3):
+            self.assertFalse(core.search._admit_search_request("user", 1))
+            self.assertTrue(core.search._admit_search_request("user4", 1))
+
+        self.assertEqual(list(core.search._user_search_work_budgets), ["user3", "user", "user4"])
@@ -2,14 +2,24 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import os
+import pickle
 import shutil
 import struct
 import wave
 
+from array import array
+from queue import SimpleQueue
 from unittest import TestCase
 
 from pynicotine.config import config
 from pynicotine.core import core
+from pynicotine.shares import DatabaseError
+from pynicotine.shares import PermissionLevel
+from pynicotine.shares import ShareStore
+from pynicotine.shares import ShareStoreWriter
+from pynicotine.shares import ShareWatcher
+from pynicotine.slskmessages import FileListMessage
+from pynicotine.utils import encode_path
 
 CURRENT_FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 DATA_FOLDER_PATH = os.path.join(CURRENT_FOLDER_PATH, "temp_data")
@@ -62,7 +72,7 @@ class SharesTest(TestCase):
 
         # Rescan shares
         core.shares.rescan_shares(rebuild=True, use_thread=False)
-        core.shares.load_shares(core.shares.share_dbs, core.shares.share_db_paths)
+        core.shares.load_shares()
 
     def tearDown(self):
         core.quit()
@@ -71,55 +81,76 @@ class SharesTest(TestCase):
     def tearDownClass(cls):
         shutil.rmtree(DATA_FOLDER_PATH)
 
+    @staticmethod
+    def get_shared_files(permission_level=None):
+        """Returns the packed search result record of each shared file, by
+        real path."""
+
+        share_store = core.shares.share_store
+        return {
+            share_store.get_real_path(file_index): share_store.get_file_record(file_index)
+            for file_index in range(share_store.get_num_files())
+            if permission_level in {None, share_store.get_file_permission_level(file_index)}
+        }
+
     def test_shares_scan(self):
         """Test a full shares scan."""
 
-        # Verify that modification times were saved
-        public_mtimes = list(core.shares.share_dbs["public_mtimes"])
-        buddy_mtimes = list(core.shares.share_dbs["buddy_mtimes"])
-        trusted_mtimes = list(core.shares.share_dbs["trusted_mtimes"])
+        share_store = core.shares.share_store
 
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "dummy_file"), public_mtimes)
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "audiofile.wav"), public_mtimes)
-        self.assertIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "audiofile2.wav"), buddy_mtimes)
-        self.assertIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "something2", "nothing2"), buddy_mtimes)
-        self.assertIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, "audiofile3.wav"), trusted_mtimes)
-        self.assertIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, "folder", "folder2", "folder3", "folder4", "nothing"),
-                      trusted_mtimes)
+        # Verify that shares were written to a single file, replacing databases of previous versions
+        self.assertTrue(os.path.isfile(core.shares.share_store_path))
+        self.assertFalse(os.path.exists(core.shares.share_store_path + ".new"))
+
+        for legacy_db_path in core.shares.legacy_db_paths.values():
+            self.assertFalse(os.path.exists(legacy_db_path))
 
         # Verify that shared files were added
-        public_files = core.shares.share_dbs["public_files"]
-        buddy_files = core.shares.share_dbs["buddy_files"]
-        trusted_files = core.shares.share_dbs["trusted_files"]
+        public_files = self.get_shared_files(PermissionLevel.PUBLIC)
+        buddy_files = self.get_shared_files(PermissionLevel.BUDDY)
+        trusted_files = self.get_shared_files(PermissionLevel.TRUSTED)
 
         self.assertEqual(
-            ["Shares\\dummy_file", 0, None, None],
+            FileListMessage.pack_file_info(["Shares\\dummy_file", 0, None, None]),
             public_files[os.path.join(SHARES_FOLDER_PATH, "dummy_file")]
         )
         self.assertEqual(
-            ["Shares\\audiofile.wav", 100044, (706, 0, 44100, 16), 1],
+            FileListMessage.pack_file_info(["Shares\\audiofile.wav", 100044, (706, 0, 44100, 16), 1]),
             public_files[os.path.join(SHARES_FOLDER_PATH, "audiofile.wav")]
         )
         self.assertEqual(
-            ["Secrets\\audiofile2.wav", 300044, (706, 0, 44100, 16), 3],
+            FileListMessage.pack_file_info(["Secrets\\audiofile2.wav", 300044, (706, 0, 44100, 16), 3]),
             buddy_files[os.path.join(BUDDY_SHARES_FOLDER_PATH, "audiofile2.wav")]
         )
         self.assertEqual(
-            ["Secrets\\something2\\nothing2", 0, None, None],
+            FileListMessage.pack_file_info(["Secrets\\something2\\nothing2", 0, None, None]),
             buddy_files[os.path.join(BUDDY_SHARES_FOLDER_PATH, "something2", "nothing2")]
         )
         self.assertEqual(
-            ["Trusted\\audiofile3.wav", 400044, (706, 0, 44100, 16), 4],
+            FileListMessage.pack_file_info(["Trusted\\audiofile3.wav", 400044, (706, 0, 44100, 16), 4]),
             trusted_files[os.path.join(TRUSTED_SHARES_FOLDER_PATH, "audiofile3.wav")]
         )
+        self.assertIn(
+            os.path.join(TRUSTED_SHARES_FOLDER_PATH, "folder", "folder2", "folder3", "folder4", "nothing"),
+            trusted_files
+        )
+
+        # Verify that folders can be looked up by virtual path
+        self.assertEqual(share_store.get_num_folders(PermissionLevel.PUBLIC), 5)
+        self.assertEqual(share_store.get_folder_path(share_store.find_folder("Secrets\\something2")),
+                         os.path.join(BUDDY_SHARES_FOLDER_PATH, "something2"))
+        self.assertEqual(share_store.get_folder_permission_level(share_store.find_folder("Trusted")),
+                         PermissionLevel.TRUSTED)
+        self.assertIsNone(share_store.find_folder("shares"))
+        self.assertIsNone(share_store.find_folder("invalid"))
 
         # Verify that expected folders are empty
-        self.assertEqual(core.shares.share_dbs["public_streams"]["Shares\\folder2"], b"\x00\x00\x00\x00")
-        self.assertEqual(core.shares.share_dbs["buddy_streams"]["Secrets\\folder3"], b"\x00\x00\x00\x00")
-        self.assertEqual(core.shares.share_dbs["trusted_streams"]["Trusted\\folder\\folder2"], b"\x00\x00\x00\x00")
+        for virtual_folder_path in ("Shares\\folder2", "Secrets\\folder3", "Trusted\\folder\\folder2"):
+            self.assertEqual(
+                share_store.get_folder_stream(share_store.find_folder(virtual_folder_path)), b"\x00\x00\x00\x00")
 
         # Verify that search index was updated
-        word_index = core.shares.share_dbs["words"]
+        word_index = share_store.word_index
         audiofile_indexes = list(word_index["audiofile"])
         audiofile2_indexes = list(word_index["audiofile2"])
         audiofile3_indexes = list(word_index["audiofile3"])
@@ -131,6 +162,26 @@ class SharesTest(TestCase):
             "something", "something2", "file2", "audiofile", "somefile",
             "audiofile2", "txt", "folder1", "buddies", "audiofile3", "shares"
         })
+        self.assertNotIn("xyz", word_index)
+        self.assertEqual(word_index.get_num_indices("wav"), 3)
+
+        # Verify that words can be looked up by suffix
+        word_suffixes = share_store.word_suffixes
+
+        self.assertEqual(len(word_suffixes), len(set(word_index)))
+        self.assertEqual(set(word_suffixes.iter_words("file")), {"file", "somefile", "audiofile"})
+        self.assertEqual(set(word_suffixes.iter_words("2")), {"folder2", "nothing2", "test2", "something2", "file2",
+                                                              "audiofile2"})
+        self.assertEqual(list(word_suffixes.iter_words("xyz")), [])
+
+        # Verify that the word filter contains every word, and rejects others
+        word_filter = share_store.word_filter
+
+        for word in word_index:
+            self.assertIn(word, word_filter)
+
+        self.assertNotIn("xyz", word_filter)
+        self.assertNotIn("audiofile4", word_filter)
 
         self.assertEqual(len(audiofile_indexes), 1)
         self.assertEqual(len(audiofile2_indexes), 1)
@@ -141,58 +192,332 @@ class SharesTest(TestCase):
         self.assertIn(wav_indexes[0], audiofile_indexes)
         self.assertIn(wav_indexes[1], audiofile2_indexes)
         self.assertIn(wav_indexes[2], audiofile3_indexes)
+        self.assertEqual(share_store.get_real_path(wav_indexes[0]), os.path.join(SHARES_FOLDER_PATH, "audiofile.wav"))
+        self.assertEqual(ShareStore.get_virtual_path(share_store.get_file_record(wav_indexes[1])),
+                         "Secrets\\audiofile2.wav")
+        self.assertEqual(share_store.get_file_size(wav_indexes[2]), 400044)
+
+        # Lossless files rank higher than other files in folders of the same depth
+        dummy_file_index = next(share_store.iter_matching_files("Shares\\dummy_file"))
+        self.assertGreater(share_store.get_file_score(wav_indexes[0]), share_store.get_file_score(dummy_file_index))
+
+    def test_lowercase_paths(self):
+        """Test looking up the real path of files requested with a lowercase
+        virtual path by Soulseek NS clients."""
+
+        self.assertEqual(core.shares.get_lowercase_real_path("secrets\\audiofile2.wav"),
+                         os.path.join(BUDDY_SHARES_FOLDER_PATH, "audiofile2.wav"))
+        self.assertIsNone(core.shares.get_lowercase_real_path("Secrets\\audiofile2.wav"))
+        self.assertIsNone(core.shares.get_lowercase_real_path("secrets\\missing.wav"))
+
         self.assertEqual(
-            core.shares.share_dbs["public_files"][core.shares.file_path_index[wav_indexes[0]]][0],
-            "Shares\\audiofile.wav"
+            core.shares.file_is_shared("user", "Shares\\dummy_file", os.path.join(SHARES_FOLDER_PATH, "dummy_file")),
+            (True, 0)
         )
         self.assertEqual(
-            core.shares.share_dbs["buddy_files"][core.shares.file_path_index[wav_indexes[1]]][0],
-            "Secrets\\audiofile2.wav"
+            core.shares.file_is_shared(
+                "user", "Secrets\\missing.wav", os.path.join(BUDDY_SHARES_FOLDER_PATH, "missing.wav")),
+            (False, None)
+        )
+
+    @classmethod
+    def get_shares_data(cls):
+
+        share_store = core.shares.share_store
+        return (
+            [share_store.get_real_path(file_index) for file_index in range(share_store.get_num_files())],
+            {word: list(share_store.word_index[word]) for word in share_store.word_index},
+            cls.get_shared_files(),
+            {
+                permission_level: list(share_store.iter_folder_streams(permission_level))
+                for permission_level in ShareStore.PERMISSION_LEVELS
+            }
         )
+
+    def test_shares_scan_metadata_threads(self):
+        """Verify that reading metadata in worker threads results in the same
+        file index as reading it serially."""
+
+        shares_data = []
+
+        for num_threads in (1, 4):
+            config.sections["transfers"]["scan_metadata_threads"] = num_threads
+            core.shares.rescan_shares(rebuild=True, use_thread=False)
+            core.shares.load_shares()
+
+            shares_data.append(self.get_shares_data())
+
+        serial_shares_data, threaded_shares_data = shares_data
+        self.assertEqual(serial_shares_data, threaded_shares_data)
+
+    def test_shares_rescan_unchanged_folders(self):
+        """Verify that a rescan reusing data of unchanged folders results in
+        the same shares as a rebuild, and that changed folders are scanned."""
+
+        rebuilt_shares_data = self.get_shares_data()
+
+        core.shares.rescan_shares(use_thread=False)
+        core.shares.load_shares()
+
+        self.assertEqual(self.get_shares_data(), rebuilt_shares_data)
+
+        # Adding a file updates the modification time of its folder
+        new_file_path = os.path.join(SHARES_FOLDER_PATH, "folder1", "new_file")
+
+        with open(new_file_path, "wb"):
+            self.addCleanup(os.remove, new_file_path)
+
+        core.shares.rescan_shares(use_thread=False)
+        core.shares.load_shares()
+
+        public_files = self.get_shared_files(PermissionLevel.PUBLIC)
+
+        self.assertEqual(FileListMessage.pack_file_info(["Shares\\folder1\\new_file", 0, None, None]),
+                         public_files[new_file_path])
+        self.assertEqual(len(public_files), 6)
+
+    def test_shares_rescan_modified_file(self):
+        """Verify that files of a folder with an unchanged modification time
+        are reused without checking them, and that a file edited in place is
+        scanned again once its folder is reported as changed."""
+
+        file_path = os.path.join(SHARES_FOLDER_PATH, "audiofile.wav")
+        folder_stat = os.stat(SHARES_FOLDER_PATH)
+
+        with open(file_path, "ab") as file_handle:
+            file_handle.write(b"\0" * 100)
+
+        os.utime(SHARES_FOLDER_PATH, ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+
+        core.shares.rescan_shares(use_thread=False)
+        core.shares.load_shares()
+
+        file_index = next(core.shares.share_store.iter_matching_files("Shares\\audiofile.wav"))
+        self.assertEqual(core.shares.share_store.get_file_size(file_index), 100044)
+
+        core.shares.rescan_shares(use_thread=False, changed_folder_paths={SHARES_FOLDER_PATH})
+        core.shares.load_shares()
+
+        file_index = next(core.shares.share_store.iter_matching_files("Shares\\audiofile.wav"))
+        self.assertEqual(core.shares.share_store.get_file_size(file_index), 100144)
+
+    def test_shares_rescan_moved_files(self):
+        """Verify that metadata of files moved between shared folders is
+        reused, even if the file name changes."""
+
+        old_file_path = os.path.join(SHARES_FOLDER_PATH, "audiofile.wav")
+        new_file_path = os.path.join(BUDDY_SHARES_FOLDER_PATH, "moved_audiofile")
+
+        os.rename(old_file_path, new_file_path)
+        self.addCleanup(os.rename, new_file_path, old_file_path)
+
+        core.shares.rescan_shares(use_thread=False)
+        core.shares.load_shares()
+
+        # Audio metadata would be missing if the file was read again, since there
+        # is no file extension
+        self.assertNotIn(old_file_path, self.get_shared_files())
         self.assertEqual(
-            core.shares.share_dbs["trusted_files"][core.shares.file_path_index[wav_indexes[2]]][0],
-            "Trusted\\audiofile3.wav"
+            FileListMessage.pack_file_info(["Secrets\\moved_audiofile", 100044, (706, 0, 44100, 16), 1]),
+            self.get_shared_files(PermissionLevel.BUDDY)[new_file_path]
         )
 
-    def test_hidden_file_folder_scan(self):
-        """Test that hidden files and folders are excluded."""
+        # Rebuilding shares reads the metadata again
+        core.shares.rebuild_shares(use_thread=False)
+        core.shares.load_shares()
 
-        # Check modification times
-        public_mtimes = list(core.shares.share_dbs["public_mtimes"])
-        buddy_mtimes = list(core.shares.share_dbs["buddy_mtimes"])
-        trusted_mtimes = list(core.shares.share_dbs["trusted_mtimes"])
+        self.assertEqual(
+            FileListMessage.pack_file_info(["Secrets\\moved_audiofile", 100044, None, None]),
+            self.get_shared_files(PermissionLevel.BUDDY)[new_file_path]
+        )
 
-        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".abc", "nothing"), public_mtimes)
-        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".xyz", "nothing"), public_mtimes)
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "folder1", "nothing"), public_mtimes)
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "folder2", "test", "nothing"), public_mtimes)
-        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, "folder2", ".poof", "nothing"), public_mtimes)
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "folder2", "test", "nothing"), public_mtimes)
-        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "something", "nothing"), public_mtimes)
+    def test_share_watcher(self):
+        """Verify that the share watcher reports changed folders, and that
+        rescanning only the changed folders picks up new files."""
 
-        self.assertNotIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "folder3", ".poof2", "nothing2"), buddy_mtimes)
-        self.assertIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "folder3", "test2", "nothing2"), buddy_mtimes)
-        self.assertNotIn(os.path.join(INVALID_SHARES_FOLDER_PATH, "file.txt"), buddy_mtimes)
+        changes = SimpleQueue()
+        share_watcher = ShareWatcher(
+            core.shares.share_store_path, callback=lambda watcher, folder_paths: changes.put(folder_paths))
+        share_watcher.QUIET_DELAY = 0
+        share_watcher.POLL_INTERVAL = 0.1
+        share_watcher.start()
+        self.addCleanup(share_watcher.stop)
 
-        self.assertNotIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, ".hidden_folder", "nothing"), trusted_mtimes)
-        self.assertIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, "folder", "folder2", "folder3", "folder4", "nothing"),
-                      trusted_mtimes)
+        folder_path = os.path.join(SHARES_FOLDER_PATH, "folder1")
+        new_file_path = os.path.join(folder_path, "watched_file")
+
+        with open(new_file_path, "wb"):
+            self.addCleanup(os.remove, new_file_path)
+
+        changed_folder_paths = changes.get(timeout=10)
+        self.assertIn(folder_path, changed_folder_paths)
+
+        core.shares.rescan_shares(use_thread=False, changed_folder_paths=changed_folder_paths)
+        core.shares.load_shares()
+
+        public_files = self.get_shared_files(PermissionLevel.PUBLIC)
 
-        # Check file data
-        public_files = core.shares.share_dbs["public_files"]
-        buddy_files = core.shares.share_dbs["buddy_files"]
-        trusted_files = core.shares.share_dbs["trusted_files"]
+        self.assertEqual(FileListMessage.pack_file_info(["Shares\\folder1\\watched_file", 0, None, None]),
+                         public_files[new_file_path])
+        self.assertEqual(len(public_files), 6)
 
+    def test_hidden_file_folder_scan(self):
+        """Test that hidden files and folders are excluded."""
+
+        public_files = self.get_shared_files(PermissionLevel.PUBLIC)
+        buddy_files = self.get_shared_files(PermissionLevel.BUDDY)
+        trusted_files = self.get_shared_files(PermissionLevel.TRUSTED)
+
+        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".abc", "nothing"), public_files)
+        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".xyz", "nothing"), public_files)
+        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "folder1", "nothing"), public_files)
+        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "folder2", "test", "nothing"), public_files)
+        self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, "folder2", ".poof", "nothing"), public_files)
+        self.assertIn(os.path.join(SHARES_FOLDER_PATH, "something", "nothing"), public_files)
         self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".abc_file"), public_files)
         self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".hidden_file"), public_files)
         self.assertNotIn(os.path.join(SHARES_FOLDER_PATH, ".xyz_file"), public_files)
         self.assertIn(os.path.join(SHARES_FOLDER_PATH, "dummy_file"), public_files)
         self.assertEqual(len(public_files), 5)
 
+        self.assertNotIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "folder3", ".poof2", "nothing2"), buddy_files)
+        self.assertIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "folder3", "test2", "nothing2"), buddy_files)
+        self.assertNotIn(os.path.join(INVALID_SHARES_FOLDER_PATH, "file.txt"), buddy_files)
         self.assertNotIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, ".uvw_file"), buddy_files)
         self.assertIn(os.path.join(BUDDY_SHARES_FOLDER_PATH, "dummy_file2"), buddy_files)
         self.assertEqual(len(buddy_files), 6)
 
         self.assertNotIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, ".hidden_folder", "nothing"), trusted_files)
+        self.assertIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, "folder", "folder2", "folder3", "folder4", "nothing"),
+                      trusted_files)
         self.assertIn(os.path.join(TRUSTED_SHARES_FOLDER_PATH, "dummy_file3"), trusted_files)
         self.assertEqual(len(trusted_files), 3)
+
+    def test_share_store(self):
+        """Test writing a share store, and looking up folders and files in
+        it."""
+
+        store_path = os.path.join(DATA_FOLDER_PATH, "test_store.dbn")
+        entry = FileListMessage.pack_file_info(["song.flac", 1000, (None, None, 44100, 16), 60])
+        store_writer = ShareStoreWriter(encode_path(store_path))
+
+        root_folder_id = store_writer.add_folder(
+            PermissionLevel.PUBLIC, os.path.join(os.sep, "music"), "Music", files=[(entry, 5, 123)])
+        store_writer.add_folder(
+            PermissionLevel.PUBLIC, os.path.join(os.sep, "music", "Album"), "Music\\Album",
+            parent_folder_id=root_folder_id, mtime_ns=9, device=7, is_complete=False,
+            files=[(ShareStore.rename_entry(entry, "other.flac"), 6, 124)]
+        )
+        store_writer.add_folder(
+            PermissionLevel.BUDDY, os.path.join(os.sep, "music", "Nested"), "Nested",
+            parent_folder_id=root_folder_id
+        )
+
+        with self.assertRaises(DatabaseError):
+            store_writer.add_folder(PermissionLevel.PUBLIC, os.path.join(os.sep, "other"), "Other")
+
+        store_writer.close({"song": array("I", [0]), "flac": array("I", [0, 1])})
+
+        share_store = ShareStore(encode_path(store_path))
+        self.addCleanup(share_store.close)
+
+        self.assertEqual(share_store.get_num_folders(), 3)
+        self.assertEqual(share_store.get_num_folders(PermissionLevel.PUBLIC), 2)
+        self.assertEqual(share_store.get_num_files(PermissionLevel.BUDDY), 0)
+        self.assertEqual(share_store.get_file_permission_level(1), PermissionLevel.PUBLIC)
+
+        album_folder_id = share_store.find_folder("Music\\Album")
+        self.assertEqual(share_store.get_folder(album_folder_id), (9, 7, 0, False))
+        self.assertEqual(share_store.get_folder_mtime(album_folder_id), 9)
+        self.assertEqual(share_store.get_folder_path(album_folder_id), os.path.join(os.sep, "music", "Album"))
+        self.assertEqual(share_store.get_virtual_folder_path(share_store.find_folder("Nested")), "Nested")
+        self.assertEqual(
+            [folder_path for _folder_id, _parent_folder_id, folder_path in share_store.iter_folders()],
+            [os.path.join(os.sep, "music"), os.path.join(os.sep, "music", "Album"),
+             os.path.join(os.sep, "music", "Nested")]
+        )
+
+        self.assertEqual(list(share_store.iter_matching_files("music\\album\\OTHER.flac")), [1])
+        self.assertEqual(share_store.get_real_path(1), os.path.join(os.sep, "music", "Album", "other.flac"))
+        self.assertEqual(
+            share_store.get_file_record(1),
+            FileListMessage.pack_file_info(["Music\\Album\\other.flac", 1000, (None, None, 44100, 16), 60])
+        )
+        self.assertEqual(list(share_store.iter_folder_streams(PermissionLevel.PUBLIC)), [
+            ("Music", FileListMessage.pack_uint32(1) + entry),
+            ("Music\\Album", FileListMessage.pack_uint32(1) + ShareStore.rename_entry(entry, "other.flac"))
+        ])
+
+        self.assertEqual(share_store.find_moved_file(0, 123, 1000, 5), entry)
+        self.assertIsNone(share_store.find_moved_file(0, 123, 1000, 6))
+        self.assertEqual(list(share_store.word_index["flac"]), [0, 1])
+        self.assertEqual(list(share_store.word_suffixes.iter_words("ng")), ["song"])
+
+        # Incomplete store (e.g. scanner process terminated while writing)
+        share_store.close()
+
+        with open(store_path, "rb+") as file_handle:
+            file_handle.truncate(os.path.getsize(store_path) - 1)
+
+        with self.assertRaises(DatabaseError):
+            ShareStore(encode_path(store_path))
+
+    def test_database_migration(self):
+        """Test that file metadata in pickle-based databases (version 3) is
+        reused when rescanning shares, and that the databases are removed."""
+
+        audio_file_path = os.path.join(SHARES_FOLDER_PATH, "audiofile.wav")
+        legacy_items = {
+            "public_files": {audio_file_path: ["Shares\\audiofile.wav", 100044, (320, 1, 44100, 24), 5]},
+            "public_mtimes": {audio_file_path: os.stat(audio_file_path).st_mtime},
+            "words": {"audiofile": [0]}
+        }
+        core.shares.close_shares()
+
+        # Previous versions stored each database in a separate file
+        os.remove(core.shares.share_store_path)
+
+        for destination, items in legacy_items.items():
+            with open(core.shares.legacy_db_paths[destination], "wb") as file_handle:
+                file_handle.write(b"DBN+\x03")
+
+                for key, value in items.items():
+                    encoded_key = key.encode("utf-8")
+                    pickled_value = pickle.dumps(value)
+
+                    file_handle.write(struct.pack("!II", len(encoded_key), len(pickled_value)))
+                    file_handle.write(encoded_key + pickled_value)
+
+        core.shares.rescan_shares(init=True, rescan=False, use_thread=False)
+        core.shares.load_shares()
+
+        for legacy_db_path in core.shares.legacy_db_paths.values():
+            self.assertFalse(os.path.exists(legacy_db_path))
+
+        self.assertEqual(
+            FileListMessage.pack_file_info(["Shares\\audiofile.wav", 100044, (320, 1, 44100, 24), 5]),
+            self.get_shared_files(PermissionLevel.PUBLIC)[audio_file_path]
+        )
+        self.assertEqual(core.shares.share_store.get_num_files(PermissionLevel.PUBLIC), 5)
+        self.assertEqual(core.shares.share_store.get_num_files(PermissionLevel.BUDDY), 6)
+
+    def test_corrupted_share_store(self):
+        """Test that a corrupted share store is rescanned, without migrating
+        databases of previous versions."""
+
+        audio_file_path = os.path.join(SHARES_FOLDER_PATH, "audiofile.wav")
+        legacy_db_path = core.shares.legacy_db_paths["public_files"]
+        record = self.get_shared_files()[audio_file_path]
+        core.shares.close_shares()
+
+        with open(core.shares.share_store_path, "wb") as file_handle:
+            file_handle.write(b"SHR+\x01")
+
+        with open(legacy_db_path, "wb") as file_handle:
+            file_handle.write(b"DBN+\x03")
+
+        core.shares.rescan_shares(init=True, rescan=False, use_thread=False)
+        core.shares.load_shares()
+
+        self.assertFalse(os.path.exists(legacy_db_path))
+        self.assertEqual(record, self.get_shared_files()[audio_file_path])
@@ -926,12 +926,12 @@ class Uploads(Transfers):
         is_lowercase_path = False
 
         if reason == TransferRejectReason.FILE_NOT_SHARED:
-            real_path_index = core.shares.get_lowercase_path_index(virtual_path)
+            lowercase_real_path = core.shares.get_lowercase_real_path(virtual_path)
 
-            if real_path_index is not None:
+            if lowercase_real_path is not None:
                 # Soulseek NS client erroneously converted the virtual path to lowercase.
                 # Retrieve the real path anyway.
-                real_path = core.shares.file_path_index[real_path_index]
+                real_path = lowercase_real_path
                 allowed, size = core.shares.file_is_shared(username, virtual_path, real_path)
                 is_lowercase_path = True
 